@@ -0,0 +1,283 @@
+"""Offline benchmarks of the storytelling pipeline.
+
+End-to-end runs of `generate_story` go against the local mock backend of
+`goat_storytelling_agent.mock_server`, so no model is needed. Parsers and
+`utils` are timed on canned outlines and scenes of the same mock. Inputs,
+mock replies and error injection are seeded, so runs on one machine are
+comparable across commits.
+
+    python benchmarks/bench.py run
+    python benchmarks/bench.py compare benchmarks/results/OLD.json NEW.json
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import datetime
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from goat_storytelling_agent import utils, prompts  # noqa: E402
+from goat_storytelling_agent.plan import Plan  # noqa: E402
+from goat_storytelling_agent.mock_server import MockBackend  # noqa: E402
+from goat_storytelling_agent.instrumentation import AgentLogger  # noqa: E402
+from goat_storytelling_agent.storytelling_agent import (  # noqa: E402
+    StoryAgent, generate_prompt_parts)
+
+
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+MOCK_OPTIONS = dict(latency=0.005, tokens_per_second=4000, scene_words=300,
+                    chapters_per_act=3, scenes_per_chapter=2)
+E2E_SCENARIOS = {
+    'llama.cpp': (dict(backend='llama.cpp'), {}),
+    'llama.cpp-prompt-cache': (
+        dict(backend='llama.cpp', prompt_cache=True, slot_id=0), {}),
+    'llama.cpp-parallel': (
+        dict(backend='llama.cpp', max_in_flight=3,
+             scene_dependency='chapter', scene_parallelism=4), {}),
+    'llama.cpp-errors': (
+        dict(backend='llama.cpp'),
+        dict(error_rate=0.05, stream_error_rate=0.05)),
+    'hf': (dict(backend='hf'), {}),
+    # the model runs on past the scene and the act, stopped early or not
+    'llama.cpp-overrun': (dict(backend='llama.cpp'),
+                          dict(overrun_words=300)),
+    'llama.cpp-overrun-no-early-stop': (
+        dict(backend='llama.cpp', early_stop=False),
+        dict(overrun_words=300)),
+    # concurrent prompts of the story share /v1/completions requests
+    'openai': (dict(backend='openai'), {}),
+    'openai-parallel': (
+        dict(backend='openai', max_in_flight=3,
+             scene_dependency='chapter', scene_parallelism=4), {}),
+    # a third of the free-text planning answers do not parse
+    'llama.cpp-malformed': (dict(backend='llama.cpp'),
+                            dict(malformed_rate=0.3)),
+    'llama.cpp-structured-malformed': (
+        dict(backend='llama.cpp', structured=True),
+        dict(malformed_rate=0.3)),
+    'llama.cpp-race-malformed': (
+        dict(backend='llama.cpp', race_samples=3),
+        dict(malformed_rate=0.3)),
+}
+
+
+def git_revision():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=ROOT, stderr=subprocess.DEVNULL).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return commit, dirty
+
+
+def run_story(agent_options, mock_options, seed):
+    with MockBackend(seed=seed, **{**MOCK_OPTIONS, **mock_options}) as mock:
+        agent = StoryAgent(mock.url, token_counter='estimate',
+                           logger=AgentLogger(), **agent_options)
+        # the mock fails fast, do not wait out real-server backoffs
+        agent.endpoints.backoff_base = 0.01
+        start = time.monotonic()
+        scenes = agent.generate_story('treasure hunt in a jungle')
+        elapsed = time.monotonic() - start
+        agent.transport.close()
+        server_tokens = mock.stats()['completion_tokens']
+    stages = {record['stage']: record['wall_time']
+              for record in agent.metrics.records
+              if record['type'] == 'stage'}
+    calls = [record for record in agent.metrics.records
+             if record['type'] == 'call']
+    parse_failures = sum(1 for record in agent.metrics.records
+                         if record['type'] == 'parse' and not record['ok'])
+    return {
+        'elapsed': elapsed,
+        'scenes': len(scenes),
+        'requests': agent.usage['requests'],
+        'retries': sum(call['retries'] for call in calls),
+        'server_tokens': server_tokens,
+        'parse_failures': parse_failures,
+        'tokens_per_second': agent.usage['completion_tokens'] / elapsed,
+        'stories_per_hour': 3600 / elapsed,
+        'stages': stages,
+    }
+
+
+def bench_e2e(repeat):
+    results = {}
+    for name, (agent_options, mock_options) in E2E_SCENARIOS.items():
+        runs = [run_story(agent_options, mock_options, seed)
+                for seed in range(repeat)]
+        results[name] = {
+            key: statistics.median(run[key] for run in runs)
+            for key in ('elapsed', 'requests', 'retries', 'server_tokens',
+                        'parse_failures', 'tokens_per_second',
+                        'stories_per_hour')}
+        results[name]['scenes'] = runs[0]['scenes']
+        results[name]['stages'] = {
+            stage: statistics.median(run['stages'][stage] for run in runs)
+            for stage in runs[0]['stages']}
+        print(f"e2e {name}: {results[name]['elapsed']:.3f}s, "
+              f"{results[name]['tokens_per_second']:.0f} tokens/sec, "
+              f"{results[name]['server_tokens']:.0f} server tokens, "
+              f"{results[name]['requests']:.0f} requests, "
+              f"{results[name]['parse_failures']:.0f} parse failures")
+    return results
+
+
+def micro_inputs():
+    mock = MockBackend(**MOCK_OPTIONS)
+    mock.server.server_close()
+    text_plan = mock.reply(''.join(generate_prompt_parts(
+        prompts.create_plot_chapters_messages('spec', 'novel'))))
+    plan = Plan.parse_text_plan(text_plan)
+    text_act, act_chapters = Plan.act_2_str(plan, 2)
+    act_scenes = mock.reply(''.join(generate_prompt_parts(
+        prompts.split_chapters_into_scenes_messages(2, text_act, 'novel'))))
+    text_spec = mock.reply(''.join(generate_prompt_parts(
+        prompts.init_book_spec_messages('jungle', 'novel'))))
+    scene = "Chapter 4, Scene 1\n" + mock._prose('scene', 3000)
+    return {'text_plan': text_plan, 'plan': plan, 'act_scenes': act_scenes,
+            'act_chapters': act_chapters, 'text_spec': text_spec,
+            'scene': scene}
+
+
+def stream_tail(text, n=400, delta_chars=16):
+    tail = utils.RollingTail(n)
+    for idx in range(0, len(text), delta_chars):
+        tail.append(text[idx:idx + delta_chars])
+    return tail.text()
+
+
+def bench_micro():
+    inputs = micro_inputs()
+    agent = StoryAgent('http://127.0.0.1:1', backend='llama.cpp',
+                       token_counter='estimate', logger=AgentLogger())
+    messages = agent.scene_messages(
+        inputs['plan'][0]['chapters'][0], 1, 1, inputs['plan'],
+        inputs['scene'], prompts.prev_scene_intro)
+    cases = {
+        'Plan.parse_text_plan': lambda: Plan.parse_text_plan(
+            inputs['text_plan']),
+        'Plan.plan_2_str': lambda: Plan.plan_2_str(inputs['plan']),
+        'Plan.from_json': lambda: Plan.from_json(inputs['plan'].to_json()),
+        'Plan.text(uncached)': lambda: Plan.from_json(
+            inputs['plan'].to_json()).text(),
+        'Plan.act_2_str': lambda: Plan.act_2_str(inputs['plan'], 2),
+        'StoryAgent.parse_act_scenes': lambda: StoryAgent.parse_act_scenes(
+            inputs['act_scenes'], inputs['act_chapters']),
+        'StoryAgent.parse_book_spec': lambda: agent.parse_book_spec(
+            inputs['text_spec']),
+        'StoryAgent.prepare_scene_text': lambda: StoryAgent.prepare_scene_text(
+            inputs['scene']),
+        'StoryAgent.scene_messages': lambda: agent.scene_messages(
+            inputs['plan'][0]['chapters'][0], 1, 1, inputs['plan'],
+            inputs['scene'], prompts.prev_scene_intro),
+        'generate_prompt_parts': lambda: ''.join(
+            generate_prompt_parts(messages)),
+        'utils.keep_last_n_words': lambda: utils.keep_last_n_words(
+            inputs['scene'], 400),
+        'utils.remove_last_n_words': lambda: utils.remove_last_n_words(
+            inputs['scene'], 400),
+        'utils.RollingTail.append': lambda: stream_tail(inputs['scene']),
+    }
+    results = {}
+    for name, func in cases.items():
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=5, number=number))
+        results[name] = {'us_per_call': best / number * 1e6}
+        print(f"micro {name}: {results[name]['us_per_call']:.1f}us")
+    return results
+
+
+def flatten(results):
+    """Benchmark values by dotted name, with True if higher is better"""
+    values = {}
+    for name, scenario in results.get('e2e', {}).items():
+        for key in ('elapsed', 'tokens_per_second', 'stories_per_hour'):
+            values[f'e2e.{name}.{key}'] = (scenario[key], key != 'elapsed')
+        for key in ('server_tokens', 'parse_failures'):
+            if key in scenario:
+                values[f'e2e.{name}.{key}'] = (scenario[key], False)
+        for stage, wall_time in scenario['stages'].items():
+            values[f'e2e.{name}.stage.{stage}'] = (wall_time, False)
+    for name, case in results.get('micro', {}).items():
+        values[f'micro.{name}'] = (case['us_per_call'], False)
+    return values
+
+
+def compare(old_path, new_path, threshold):
+    with open(old_path) as fp:
+        old = flatten(json.load(fp))
+    with open(new_path) as fp:
+        new = flatten(json.load(fp))
+    n_regressions = 0
+    print(f"{'benchmark':60} {'old':>12} {'new':>12} {'change':>8}")
+    for name in sorted(old.keys() & new.keys()):
+        (old_value, higher_better), (new_value, _) = old[name], new[name]
+        change = (new_value - old_value) / old_value if old_value else 0.0
+        worse = -change if higher_better else change
+        flag = ''
+        if worse > threshold:
+            flag = ' REGRESSION'
+            n_regressions += 1
+        elif worse < -threshold:
+            flag = ' improved'
+        print(f"{name:60} {old_value:12.4g} {new_value:12.4g} "
+              f"{change:+8.1%}{flag}")
+    return 1 if n_regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="run benchmarks")
+    run_parser.add_argument('--suite', choices=['all', 'e2e', 'micro'],
+                            default='all')
+    run_parser.add_argument('--repeat', type=int, default=3,
+                            help="end-to-end runs per scenario")
+    run_parser.add_argument('--output', default=None,
+                            help="result file, results/<commit>.json if unset")
+    compare_parser = commands.add_parser(
+        'compare', help="compare two result files")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help="relative change reported as regression")
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        return compare(args.old, args.new, args.threshold)
+
+    commit, dirty = git_revision()
+    results = {'meta': {
+        'commit': commit, 'dirty': dirty,
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat, 'mock': MOCK_OPTIONS}}
+    if args.suite in ('all', 'e2e'):
+        results['e2e'] = bench_e2e(args.repeat)
+    if args.suite in ('all', 'micro'):
+        results['micro'] = bench_micro()
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as fp:
+        json.dump(results, fp, indent=4)
+    print(f"Saved {output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,704 @@
+"""Asyncio-native StoryAgent running on a non-blocking HTTP client.
+
+Requires `aiohttp` (`pip install goat_storytelling_agent[async]`).
+"""
+import os
+import time
+import json
+import asyncio
+import contextlib
+
+from goat_storytelling_agent.steps import (
+    Query, Backend, Race, Stream, Call, Emit)
+from goat_storytelling_agent.transport import EndpointPool
+from goat_storytelling_agent.completions import AsyncCompletionBatcher
+from goat_storytelling_agent.instrumentation import ConsoleLogger
+from goat_storytelling_agent.storytelling_agent import (
+    StoryAgent, generate_prompt_parts, _join_response,
+    _llamacpp_prompt_stats)
+
+
+async def _astream_chat_hf(session, endpoint, messages, token_counter,
+                           retries=3, request_timeout=120, max_tokens=4096,
+                           extra_options={'do_sample': True}, call_stats=None,
+                           logger=None):
+    """Async version of `storytelling_agent._stream_chat_hf`"""
+    import aiohttp
+
+    endpoints = EndpointPool.wrap(endpoint)
+    logger = logger or ConsoleLogger()
+    call_stats = {} if call_stats is None else call_stats
+    call_start = time.monotonic()
+    prompt_parts = list(generate_prompt_parts(messages))
+    prompt = ''.join(prompt_parts)
+    n_prompt_tokens = token_counter.count_parts(prompt_parts)
+    call_stats['prompt_tokens'] = n_prompt_tokens
+    data = {
+        "inputs": prompt,
+        "parameters": {
+            'max_new_tokens': max_tokens - n_prompt_tokens,
+            **extra_options
+        }
+    }
+    headers = {'Content-Type': 'application/json'}
+    timeout = aiohttp.ClientTimeout(total=request_timeout)
+
+    for attempt in range(retries):
+        call_stats['attempts'] = attempt + 1
+        n_deltas = 0
+        ok = False
+        endpoint = endpoints.acquire()
+        start = time.monotonic()
+        try:
+            async with session.post(
+                    f"{endpoint.url}/generate_stream", headers=headers,
+                    data=json.dumps(data), timeout=timeout) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    parsed = json.loads(line[5:])
+                    if parsed.get("error"):
+                        raise ValueError(parsed["error"])
+                    token = parsed.get("token") or {}
+                    if token.get("special"):
+                        continue
+                    if 'ttft' not in call_stats:
+                        call_stats['ttft'] = time.monotonic() - call_start
+                    n_deltas += 1
+                    yield token.get("text", "")
+            ok = True
+            return
+        except GeneratorExit:
+            # the caller stopped reading, not a fault of the endpoint
+            ok = True
+            raise
+        except Exception:
+            logger.error('Timeout error, retrying...', exc_info=True)
+        finally:
+            endpoints.release(endpoint, ok=ok,
+                              latency=time.monotonic() - start)
+        if n_deltas:
+            yield None
+        if attempt + 1 < retries:
+            await asyncio.sleep(endpoints.backoff(attempt))
+
+
+async def _aquery_chat_hf(session, endpoint, messages, token_counter,
+                          retries=3, request_timeout=120, max_tokens=4096,
+                          extra_options={'do_sample': True}, call_stats=None,
+                          logger=None, guard=None):
+    import aiohttp
+
+    call_stats = {} if call_stats is None else call_stats
+    if guard is not None:
+        # streamed, so that the generation can be stopped early
+        stream = _astream_chat_hf(
+            session, endpoint, messages, token_counter, retries=retries,
+            request_timeout=request_timeout, max_tokens=max_tokens,
+            extra_options=extra_options, call_stats=call_stats,
+            logger=logger)
+        deltas = await _areceive(_aguard_stream(stream, guard, call_stats))
+        return _join_response(messages, deltas) if deltas else ''
+    endpoints = EndpointPool.wrap(endpoint)
+    logger = logger or ConsoleLogger()
+    prompt_parts = list(generate_prompt_parts(messages))
+    prompt = ''.join(prompt_parts)
+    n_prompt_tokens = token_counter.count_parts(prompt_parts)
+    call_stats['prompt_tokens'] = n_prompt_tokens
+    data = {
+        "inputs": prompt,
+        "parameters": {
+            'max_new_tokens': max_tokens - n_prompt_tokens,
+            **extra_options
+        }
+    }
+    headers = {'Content-Type': 'application/json'}
+    timeout = aiohttp.ClientTimeout(total=request_timeout)
+
+    for attempt in range(retries):
+        call_stats['attempts'] = attempt + 1
+        endpoint = endpoints.acquire()
+        start = time.monotonic()
+        try:
+            async with session.post(
+                    f"{endpoint.url}/generate", headers=headers,
+                    data=json.dumps(data), timeout=timeout) as response:
+                response.raise_for_status()
+                text = await response.text()
+            generated_text = _join_response(
+                messages, [json.loads(text)['generated_text']])
+        except Exception:
+            endpoints.release(endpoint, ok=False)
+            logger.error('Timeout error, retrying...', exc_info=True)
+            if attempt + 1 < retries:
+                await asyncio.sleep(endpoints.backoff(attempt))
+            continue
+        endpoints.release(endpoint, ok=True,
+                          latency=time.monotonic() - start)
+        return generated_text
+    return ''
+
+
+async def _astream_chat_llamacpp(session, endpoint, messages, retries=3,
+                                 request_timeout=120, max_tokens=4096,
+                                 extra_options={}, call_stats=None,
+                                 token_counter=None, logger=None):
+    """Async version of `storytelling_agent._stream_chat_llamacpp`"""
+    import aiohttp
+
+    endpoints = EndpointPool.wrap(endpoint)
+    logger = logger or ConsoleLogger()
+    call_stats = {} if call_stats is None else call_stats
+    call_start = time.monotonic()
+    headers = {'Content-Type': 'application/json'}
+    timeout = aiohttp.ClientTimeout(total=request_timeout)
+    prompt_parts = list(generate_prompt_parts(messages))
+    if token_counter is None:
+        for attempt in range(max(retries, 1)):
+            endpoint = endpoints.acquire()
+            try:
+                async with session.post(
+                        f"{endpoint.url}/tokenize", headers=headers,
+                        data=json.dumps({"content": ''.join(prompt_parts)}),
+                        timeout=timeout) as response:
+                    response.raise_for_status()
+                    tokens = (await response.json(content_type=None))["tokens"]
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                endpoints.release(endpoint, ok=False)
+                if attempt + 1 == max(retries, 1):
+                    raise
+                await asyncio.sleep(endpoints.backoff(attempt))
+                continue
+            endpoints.release(endpoint, ok=True)
+            break
+        prompt = [1, *tokens]
+        n_prompt_tokens = len(prompt)
+    else:
+        prompt = ''.join(prompt_parts)
+        n_prompt_tokens = token_counter.count_parts(prompt_parts)
+    # replaced by the server count of the last chunk
+    call_stats['prompt_tokens'] = n_prompt_tokens
+    data = {
+        "prompt": prompt,
+        "stream": True,
+        "n_predict": max_tokens - n_prompt_tokens,
+        **extra_options,
+    }
+    jdata = json.dumps(data)
+
+    n_deltas = 0
+    attempt = 0
+    while True:
+        call_stats['attempts'] = attempt + 1
+        failed = True
+        endpoint = endpoints.acquire()
+        start = time.monotonic()
+        try:
+            async with session.post(
+                    f"{endpoint.url}/completion", headers=headers,
+                    data=jdata, timeout=timeout) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if line.startswith(b"error:"):
+                        logger.error(f"\nError(retry={retries - attempt - 1}): "
+                                     f"{line!r}")
+                        break
+                    if not line.startswith(b"data: "):
+                        raise ValueError(
+                            f"Got unexpected response: {line!r}")
+                    parsed = json.loads(line[6:])
+                    if 'ttft' not in call_stats:
+                        call_stats['ttft'] = time.monotonic() - call_start
+                    n_deltas += 1
+                    yield parsed.get("content", "")
+                    if parsed.get("stop") is True:
+                        call_stats.update(_llamacpp_prompt_stats(parsed))
+                        failed = False
+                        break
+                else:
+                    # stream ended without an error line
+                    failed = False
+        except GeneratorExit:
+            # the caller stopped reading, not a fault of the endpoint
+            failed = False
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.error(f"\nConnection error(retry={retries - attempt - 1})",
+                         exc_info=True)
+        finally:
+            endpoints.release(endpoint, ok=not failed,
+                              latency=time.monotonic() - start)
+        attempt += 1
+        if not failed or attempt > retries:
+            return
+        if n_deltas:
+            n_deltas = 0
+            yield None
+        await asyncio.sleep(endpoints.backoff(attempt - 1))
+
+
+async def _aquery_chat_llamacpp(session, endpoint, messages, retries=3,
+                                request_timeout=120, max_tokens=4096,
+                                extra_options={}, call_stats=None,
+                                token_counter=None, logger=None, guard=None):
+    logger = logger or ConsoleLogger()
+    call_stats = {} if call_stats is None else call_stats
+    logger.prompt(''.join(generate_prompt_parts(messages)))
+    stream = _astream_chat_llamacpp(
+        session, endpoint, messages, retries=retries,
+        request_timeout=request_timeout, max_tokens=max_tokens,
+        extra_options=extra_options, call_stats=call_stats,
+        token_counter=token_counter, logger=logger)
+    if guard is not None:
+        stream = _aguard_stream(stream, guard, call_stats)
+    deltas = await _areceive(stream, logger)
+    logger.response(call_stats)
+    return _join_response(messages, deltas).strip()
+
+
+async def _astream_chat_openai(batcher, messages, token_counter,
+                               max_tokens=4096, extra_options={},
+                               call_stats=None):
+    """Async version of `storytelling_agent._stream_chat_openai`"""
+    call_stats = {} if call_stats is None else call_stats
+    call_start = time.monotonic()
+    prompt_parts = list(generate_prompt_parts(messages))
+    n_prompt_tokens = token_counter.count_parts(prompt_parts)
+    call_stats['prompt_tokens'] = n_prompt_tokens
+    call_stats['attempts'] = 1
+    stream = batcher.stream(''.join(prompt_parts),
+                            max_tokens - n_prompt_tokens, extra_options)
+    try:
+        async for delta in stream:
+            if delta is None:
+                call_stats['attempts'] += 1
+            elif 'ttft' not in call_stats:
+                call_stats['ttft'] = time.monotonic() - call_start
+            yield delta
+    finally:
+        # takes the prompt out of its batch
+        await stream.aclose()
+
+
+async def _aquery_chat_openai(batcher, messages, token_counter,
+                              max_tokens=4096, extra_options={},
+                              call_stats=None, logger=None, guard=None):
+    logger = logger or ConsoleLogger()
+    call_stats = {} if call_stats is None else call_stats
+    logger.prompt(''.join(generate_prompt_parts(messages)))
+    stream = _astream_chat_openai(
+        batcher, messages, token_counter, max_tokens=max_tokens,
+        extra_options=extra_options, call_stats=call_stats)
+    if guard is not None:
+        stream = _aguard_stream(stream, guard, call_stats)
+    deltas = await _areceive(stream, logger)
+    logger.response(call_stats)
+    return _join_response(messages, deltas).strip()
+
+
+async def _aguard_stream(stream, guard, call_stats):
+    """Async version of `storytelling_agent._guard_stream`"""
+    try:
+        async for delta in stream:
+            if delta is None:
+                guard.reset()
+                yield None
+                continue
+            text = guard.feed(delta)
+            if text:
+                yield text
+            if guard.stopped:
+                call_stats['early_stop'] = guard.reason
+                return
+        text = guard.finish()
+        if text:
+            yield text
+    finally:
+        # closing drops the generation on the server
+        await stream.aclose()
+
+
+async def _areceive(stream, logger=None):
+    """Deltas of a stream after its last restart, logged if logger is set"""
+    deltas = []
+    is_first = True
+    try:
+        async for content in stream:
+            if content is None:
+                is_first = True
+                deltas.clear()
+                continue
+            deltas.append(content)
+            if logger is not None:
+                logger.delta(content, is_first)
+            is_first = False
+    finally:
+        await stream.aclose()
+    return deltas
+
+
+class AsyncStoryAgent(StoryAgent):
+    """StoryAgent whose pipeline methods are coroutines.
+
+    The stages are the step generators of `StoryAgent`, see `steps`, and
+    only their backend calls and concurrency are awaited here, so one
+    event loop can keep many stories in flight. Use as
+    `async with AsyncStoryAgent(...) as writer` or call `aclose()` when
+    done to release the HTTP connections.
+    Token counting runs in the event loop, so prefer the estimate or a
+    local tokenizer over token_counter='server'.
+    """
+    def __init__(self, backend_uri, backend="hf", request_timeout=120,
+                 max_tokens=4096, n_crop_previous=400,
+                 prompt_engine=None, form='novel',
+                 extra_options={}, scene_extra_options={},
+                 pool_size=100, max_in_flight=1,
+                 cache=None, cache_sampling=False,
+                 prompt_cache=False, slot_id=None,
+                 scene_parallelism=1, scene_dependency='story',
+                 token_counter=None, request_limiter=None, story_id=None,
+                 metrics=None, logger=None, retry_policy=None,
+                 min_scene_tokens=1024, max_scene_prompt_tokens=None,
+                 stop=(), validators=None, early_stop=True,
+                 batcher=None, max_batch_size=16, batch_wait=0.01,
+                 structured=False, race_samples=1, recorder=None):
+        self.pool_size = pool_size
+        super().__init__(
+            backend_uri, backend=backend, request_timeout=request_timeout,
+            max_tokens=max_tokens, n_crop_previous=n_crop_previous,
+            prompt_engine=prompt_engine, form=form,
+            extra_options=extra_options,
+            scene_extra_options=scene_extra_options, pool_size=pool_size,
+            max_in_flight=max_in_flight, cache=cache,
+            cache_sampling=cache_sampling, prompt_cache=prompt_cache,
+            slot_id=slot_id, scene_parallelism=scene_parallelism,
+            scene_dependency=scene_dependency, token_counter=token_counter,
+            request_limiter=request_limiter, story_id=story_id,
+            metrics=metrics, logger=logger, retry_policy=retry_policy,
+            min_scene_tokens=min_scene_tokens,
+            max_scene_prompt_tokens=max_scene_prompt_tokens,
+            stop=stop, validators=validators, early_stop=early_stop,
+            batcher=batcher, max_batch_size=max_batch_size,
+            batch_wait=batch_wait, structured=structured,
+            race_samples=race_samples, recorder=recorder)
+        self._session = None
+        # a shared batcher is closed by its owner
+        self._owns_batcher = batcher is None
+
+    def make_batcher(self, max_batch_size, batch_wait):
+        """`AsyncCompletionBatcher` of the endpoints"""
+        return AsyncCompletionBatcher(
+            self.endpoints, max_batch_size=max_batch_size,
+            max_wait=batch_wait, request_timeout=self.request_timeout,
+            api_key=os.environ.get('OPENAI_API_KEY'), logger=self.logger,
+            pool_size=self.pool_size)
+
+    def _get_session(self):
+        import aiohttp
+
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self.batcher is not None and self._owns_batcher:
+            await self.batcher.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def map_concurrent(self, func, items, max_workers=None):
+        """Awaits func on items with up to max_in_flight calls at once"""
+        items = list(items)
+        max_workers = max_workers or self.max_in_flight
+        if max_workers <= 1 or len(items) <= 1:
+            return [await func(item) for item in items]
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def bounded(item):
+            async with semaphore:
+                return await func(item)
+        return await asyncio.gather(*[bounded(item) for item in items])
+
+    async def query_chat(self, messages, retries=3, use_cache=True,
+                         refresh=False, stage=None, retry_loop=None,
+                         validators=(), schema=None, cancel=None,
+                         options=None):
+        """Async version of `StoryAgent.query_chat`, cancel is an
+        asyncio.Event"""
+        return await self.run_steps(self.query_chat_steps(
+            messages, retries=retries, use_cache=use_cache, refresh=refresh,
+            stage=stage, retry_loop=retry_loop, validators=validators,
+            schema=schema, cancel=cancel, options=options))
+
+    async def race_chat(self, messages, accept, stage, retry_loop,
+                        schema=None):
+        """Async version of `StoryAgent.race_chat`"""
+        while True:
+            first = retry_loop.attempts + 1
+            n_samples = retry_loop.start(self.race_samples)
+            if not n_samples:
+                return None
+            cancel = asyncio.Event()
+            tasks = [asyncio.ensure_future(self.query_chat(
+                messages, refresh=first + idx > 1, stage=stage,
+                retry_loop=retry_loop, schema=schema, cancel=cancel,
+                options=self.sample_options(stage, schema, first + idx)))
+                for idx in range(n_samples)]
+            try:
+                for answer in asyncio.as_completed(tasks):
+                    value = accept(await answer)
+                    if value:
+                        return value
+            finally:
+                # the other samples stop at their next delta
+                cancel.set()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    @contextlib.asynccontextmanager
+    async def request_slot(self, call_stats=None, stage=None):
+        """Async version of `StoryAgent.request_slot`, for AsyncFairLimiter"""
+        if self.request_limiter is None:
+            yield
+            return
+        call_stats = {} if call_stats is None else call_stats
+        start = time.monotonic()
+        await self.request_limiter.acquire(self.story_id,
+                                           self.request_priority(stage))
+        call_stats['queue_time'] = time.monotonic() - start
+        start = time.monotonic()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            await self.request_limiter.release(
+                self.story_id, latency=time.monotonic() - start,
+                ttft=call_stats.get('ttft'),
+                failed=failed or call_stats.get('attempts', 1) > 1)
+
+    async def query_backend(self, messages, retries=3, call_stats=None,
+                            guard=None, schema=None, stage=None,
+                            options=None, max_tokens=None):
+        """Async version of `StoryAgent.query_backend`"""
+        session = self._get_session()
+        call_stats = {} if call_stats is None else call_stats
+        if options is None:
+            options = self.backend_options(schema, stage)
+        max_tokens = max_tokens or self.max_tokens
+        async with self.request_slot(call_stats, stage):
+            if self.backend == "hf":
+                result = await _aquery_chat_hf(
+                    session, self.endpoints, messages, self.token_counter,
+                    retries=retries, request_timeout=self.request_timeout,
+                    max_tokens=max_tokens, extra_options=options,
+                    call_stats=call_stats, logger=self.logger, guard=guard)
+            elif self.backend == "llama.cpp":
+                result = await _aquery_chat_llamacpp(
+                    session, self.endpoints, messages, retries=retries,
+                    request_timeout=self.request_timeout,
+                    max_tokens=max_tokens, extra_options=options,
+                    call_stats=call_stats, token_counter=self.token_counter,
+                    logger=self.logger, guard=guard)
+            elif self.backend == "openai":
+                result = await _aquery_chat_openai(
+                    self.batcher, messages, self.token_counter,
+                    max_tokens=max_tokens, extra_options=options,
+                    call_stats=call_stats, logger=self.logger, guard=guard)
+        self.record_usage(messages, result, call_stats)
+        return result
+
+    async def run_steps(self, steps):
+        """Async version of `StoryAgent.run_steps`"""
+        send, value = steps.send, None
+        while True:
+            try:
+                step = send(value)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                send, value = steps.send, await self.run_step(step)
+            except BaseException as exc:
+                send, value = steps.throw, exc
+
+    async def iter_steps(self, steps):
+        """Async version of `StoryAgent.iter_steps`, an async generator"""
+        send, value = steps.send, None
+        while True:
+            try:
+                step = send(value)
+            except StopIteration:
+                return
+            try:
+                if isinstance(step, Emit):
+                    value = None
+                    yield step.event
+                elif isinstance(step, Stream):
+                    deltas = []
+                    stream = self.stream_chat(step.messages, **step.kwargs)
+                    try:
+                        async for delta in stream:
+                            if delta is None:
+                                deltas.clear()
+                                yield step.make_event('', reset=True)
+                            else:
+                                deltas.append(delta)
+                                yield step.make_event(delta)
+                    finally:
+                        await stream.aclose()
+                    value = self.join_stream(step.messages, deltas)
+                else:
+                    value = await self.run_step(step)
+                send = steps.send
+            except BaseException as exc:
+                send, value = steps.throw, exc
+
+    async def run_step(self, step):
+        """Async version of `StoryAgent.run_step`"""
+        if isinstance(step, Query):
+            return await self.query_chat(step.messages, **step.kwargs)
+        if isinstance(step, Backend):
+            return await self.query_backend(step.messages, **step.kwargs)
+        if isinstance(step, Stream):
+            return await self.query_chat(step.messages, **step.kwargs)
+        if isinstance(step, Emit):
+            return None
+        if isinstance(step, Call):
+            # SQLite lookups of the cache must not block the event loop
+            return await asyncio.to_thread(step.func, *step.args)
+        if isinstance(step, Race):
+            return await self.race_chat(step.messages, step.accept,
+                                        step.stage, step.retry_loop,
+                                        step.schema)
+        return await self.map_concurrent(
+            lambda item: self.run_steps(step.steps(item)), step.items,
+            step.max_workers)
+
+    async def stream_chat(self, messages, retries=3, use_cache=True,
+                          stage=None, validators=()):
+        """Async version of `StoryAgent.stream_chat`, an async generator"""
+        start_time, start = time.time(), time.monotonic()
+        key = self.cache_key(messages, use_cache, stage)
+        if key is not None:
+            cached = self.cached_delta(
+                messages, await self.run_step(Call(self.cache.get, key)),
+                stage, start_time, start)
+            if cached is not None:
+                yield cached
+                return
+
+        call_stats = {}
+        stream = self.open_stream(messages, retries, stage, call_stats)
+        guard = self.make_guard(messages, stage, validators)
+        if guard is not None:
+            stream = _aguard_stream(stream, guard, call_stats)
+        deltas = []
+        try:
+            async with self.request_slot(call_stats, stage):
+                async for delta in stream:
+                    if delta is None:
+                        deltas.clear()
+                    else:
+                        deltas.append(delta)
+                    yield delta
+        finally:
+            await stream.aclose()
+        result = self.finish_stream(messages, deltas, stage, start_time,
+                                    start, call_stats)
+        if key is not None and deltas:
+            await self.run_step(Call(self.cache.put, key, result))
+
+    def open_stream(self, messages, retries, stage, call_stats):
+        """Async version of `StoryAgent.open_stream`, an async generator"""
+        options = self.backend_options(stage=stage)
+        if self.backend == "hf":
+            return _astream_chat_hf(
+                self._get_session(), self.endpoints, messages,
+                self.token_counter, retries=retries,
+                request_timeout=self.request_timeout,
+                max_tokens=self.max_tokens, extra_options=options,
+                call_stats=call_stats, logger=self.logger)
+        elif self.backend == "llama.cpp":
+            return _astream_chat_llamacpp(
+                self._get_session(), self.endpoints, messages,
+                retries=retries, request_timeout=self.request_timeout,
+                max_tokens=self.max_tokens, extra_options=options,
+                call_stats=call_stats, token_counter=self.token_counter,
+                logger=self.logger)
+        elif self.backend == "openai":
+            return _astream_chat_openai(
+                self.batcher, messages, self.token_counter,
+                max_tokens=self.max_tokens, extra_options=options,
+                call_stats=call_stats)
+
+    def stream_story(self, topic):
+        """Async version of `StoryAgent.stream_story`, an async generator
+
+        Use as `async for event in writer.stream_story(topic)`.
+        """
+        return self.iter_steps(self.stream_story_steps(topic))
+
+    async def init_book_spec(self, topic):
+        """Async version of `StoryAgent.init_book_spec`"""
+        return await self.run_steps(self.init_book_spec_steps(topic))
+
+    async def enhance_book_spec(self, book_spec):
+        """Async version of `StoryAgent.enhance_book_spec`"""
+        return await self.run_steps(self.enhance_book_spec_steps(book_spec))
+
+    async def create_plot_chapters(self, book_spec):
+        """Async version of `StoryAgent.create_plot_chapters`"""
+        return await self.run_steps(
+            self.create_plot_chapters_steps(book_spec))
+
+    async def enhance_plot_chapters(self, book_spec, plan):
+        """Async version of `StoryAgent.enhance_plot_chapters`"""
+        return await self.run_steps(
+            self.enhance_plot_chapters_steps(book_spec, plan))
+
+    async def split_chapters_into_scenes(self, plan, done_acts={}):
+        """Async version of `StoryAgent.split_chapters_into_scenes`"""
+        return await self.run_steps(
+            self.split_chapters_into_scenes_steps(plan, done_acts))
+
+    async def write_a_scene(
+            self, scene, sc_num, ch_num, plan, previous_scene=None):
+        """Async version of `StoryAgent.write_a_scene`"""
+        return await self.run_steps(self.scene_steps(
+            scene, sc_num, ch_num, plan, previous_scene,
+            self.prompt_engine.prev_scene_intro))
+
+    async def continue_a_scene(self, scene, sc_num, ch_num,
+                               plan, current_scene=None):
+        """Async version of `StoryAgent.continue_a_scene`"""
+        return await self.run_steps(self.scene_steps(
+            scene, sc_num, ch_num, plan, current_scene,
+            self.prompt_engine.cur_scene_intro))
+
+    async def generate_story(self, topic, run_id=None, run_dir='runs'):
+        """Async version of `StoryAgent.generate_story`"""
+        return await self.run_steps(self.story_steps(topic, run_id, run_dir))
+
+    async def recompute(self, run_id, run_dir='runs'):
+        """Async version of `StoryAgent.recompute`"""
+        return await self.run_steps(self.recompute_steps(run_id, run_dir))
+
+    async def write_scenes(self, plan, done_scenes=[], checkpoint=None,
+                           recompute=False):
+        """Async version of `StoryAgent.write_scenes`"""
+        return await self.run_steps(self.write_scenes_steps(
+            plan, done_scenes, checkpoint, recompute))
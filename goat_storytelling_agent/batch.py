@@ -0,0 +1,685 @@
+"""Batch generation of many stories over a pool of workers.
+
+Stories run in threads, processes or one asyncio event loop. The backend
+requests of all stories share one cap on requests in flight, and a free
+slot goes to the waiting story with the fewest requests in flight, so a
+story writing many scenes at once cannot starve the others. With
+`--adaptive` the cap follows the load of the backend instead (AIMD) and
+free slots go to planning calls first, then to the scenes of the stories
+closest to completion. With the
+openai backend the stories of a thread or async batch also share one
+batcher, so prompts of different stories go out in the same request.
+
+Every finished story is written to `<output_dir>/<story_id>.json`, call
+and stage metrics of all stories to `<output_dir>/metrics.jsonl` and the
+aggregate throughput to `<output_dir>/report.json`. With `--record` the
+backend calls go to the replayable trace `<output_dir>/traffic.jsonl`,
+see `traffic`. Stories are also
+checkpointed under `<output_dir>/runs/`, so a rerun of the same topics file
+skips finished stories and resumes the interrupted ones.
+
+Usage: python -m goat_storytelling_agent.batch topics.txt --backend-uri URL
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import itertools
+import threading
+import traceback
+from multiprocessing.managers import BaseManager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from goat_storytelling_agent.transport import Transport, EndpointPool
+from goat_storytelling_agent.completions import (
+    CompletionBatcher, AsyncCompletionBatcher)
+from goat_storytelling_agent.instrumentation import Metrics, AgentLogger
+from goat_storytelling_agent.traffic import TrafficRecorder
+from goat_storytelling_agent.storytelling_agent import (
+    StoryAgent, SUPPORTED_BACKENDS)
+
+
+MODES = ["thread", "process", "async"]
+
+
+class AIMDController:
+    """Concurrency limit that follows the load of the backend
+
+    The limit grows by increase for every limit of requests that finish
+    fine while it is in use, and is cut to backoff times itself when a
+    request fails or is retried, takes longer than max_latency or waits
+    for its first token over ttft_tolerance times the lowest recent time
+    to first token plus ttft_slack. It is cut at most once per typical
+    request latency, as the requests in flight still see the old load.
+
+    Parameters
+    ----------
+    max_limit : int
+        Ceiling of the limit
+    initial : int, optional
+        Starting limit, half of max_limit by default
+    min_limit : int
+        Floor of the limit
+    increase : float
+        Additive increase per limit of requests
+    backoff : float
+        Multiplicative decrease
+    ttft_tolerance, ttft_slack : float
+        Time to first token over tolerance * lowest + slack is overload
+    max_latency : float, optional
+        Request seconds counted as overload, e.g. near the request timeout
+    """
+    def __init__(self, max_limit, initial=None, min_limit=1, increase=1.0,
+                 backoff=0.75, ttft_tolerance=2.0, ttft_slack=0.05,
+                 max_latency=None):
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError("Limits must satisfy 1 <= min_limit <= max_limit")
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial if initial is not None
+                           else max(min_limit, max_limit // 2))
+        self.increase = increase
+        self.backoff = backoff
+        self.ttft_tolerance = ttft_tolerance
+        self.ttft_slack = ttft_slack
+        self.max_latency = max_latency
+        self.decreases = 0
+        self._ttft_floor = None
+        self._latency = None
+        self._last_decrease = float('-inf')
+
+    @property
+    def current(self):
+        return max(self.min_limit, int(self.limit))
+
+    def update(self, in_flight, latency=None, ttft=None, failed=False):
+        """Adapts the limit to a finished request and returns it
+
+        Parameters
+        ----------
+        in_flight : int
+            Requests in flight when it finished, itself included
+        latency : float, optional
+            Seconds of the request
+        ttft : float, optional
+            Seconds to its first token
+        failed : bool
+            The request failed or was retried
+        """
+        now = time.monotonic()
+        overloaded = failed
+        if latency is not None:
+            self._latency = latency if self._latency is None \
+                else 0.9 * self._latency + 0.1 * latency
+            if self.max_latency is not None and latency > self.max_latency:
+                overloaded = True
+        if ttft is not None:
+            # the floor creeps up to follow a server that got slower
+            self._ttft_floor = ttft if self._ttft_floor is None \
+                else min(ttft, self._ttft_floor * 1.01)
+            if ttft > self.ttft_tolerance * self._ttft_floor + self.ttft_slack:
+                overloaded = True
+        if overloaded:
+            if now - self._last_decrease >= (self._latency or 0.0):
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._last_decrease = now
+                self.decreases += 1
+        elif in_flight >= self.current:
+            self.limit = min(self.max_limit,
+                             self.limit + self.increase / self.limit)
+        return self.current
+
+    def stats(self):
+        return {'limit': self.current, 'max_limit': self.max_limit,
+                'decreases': self.decreases, 'ttft_floor': self._ttft_floor,
+                'latency': self._latency}
+
+
+class _FairQueue:
+    """Admission bookkeeping shared by the sync and async limiters
+
+    Every waiter has its own condition on the lock of the limiter, and a
+    change of the queue wakes only the waiter next in line.
+    """
+    def __init__(self, max_in_flight, controller=None):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be positive")
+        self.max_in_flight = max_in_flight
+        # adapts max_in_flight to the load, requests are then admitted by
+        # their priority before fairness
+        self.controller = controller
+        if controller is not None:
+            self.max_in_flight = controller.current
+        self._in_flight = {}
+        self._waiting = {}
+        self._tickets = itertools.count()
+        self._n_in_flight = 0
+        self._n_requests = 0
+        self._n_waits = 0
+        self._max_observed = 0
+
+    def _enqueue(self, story_id, priority, cond):
+        entry = (next(self._tickets), story_id,
+                 priority if self.controller is not None else ())
+        self._waiting[entry] = cond
+        return entry
+
+    def _head(self):
+        """The waiter to admit next, None if there is no free slot"""
+        if not self._waiting or self._n_in_flight >= self.max_in_flight:
+            return None
+        # by priority, fewest requests in flight first, then the longest
+        # waiting
+        return min(self._waiting, key=lambda waiting: (
+            waiting[2], self._in_flight.get(waiting[1], 0), waiting[0]))
+
+    def _can_admit(self, entry):
+        return entry == self._head()
+
+    def _wake(self):
+        head = self._head()
+        if head is not None:
+            self._waiting[head].notify()
+
+    def _admit(self, entry, waited):
+        story_id = entry[1]
+        del self._waiting[entry]
+        self._in_flight[story_id] = self._in_flight.get(story_id, 0) + 1
+        self._n_in_flight += 1
+        self._n_requests += 1
+        self._n_waits += waited
+        self._max_observed = max(self._max_observed, self._n_in_flight)
+        # the next waiting story may fit as well
+        self._wake()
+
+    def _cancel(self, entry):
+        del self._waiting[entry]
+        self._wake()
+
+    def _release(self, story_id, feedback):
+        if self.controller is not None:
+            self.max_in_flight = self.controller.update(
+                self._n_in_flight, **feedback)
+        self._in_flight[story_id] -= 1
+        if not self._in_flight[story_id]:
+            del self._in_flight[story_id]
+        self._n_in_flight -= 1
+        self._wake()
+
+    def _stats(self):
+        stats = {'max_in_flight': self.max_in_flight,
+                 'in_flight': self._n_in_flight,
+                 'waiting': len(self._waiting),
+                 'requests': self._n_requests,
+                 'waited': self._n_waits,
+                 'max_observed_in_flight': self._max_observed}
+        if self.controller is not None:
+            stats['controller'] = self.controller.stats()
+        return stats
+
+
+class FairLimiter(_FairQueue):
+    """Caps backend requests in flight over the threads of all stories
+
+    Parameters
+    ----------
+    max_in_flight : int
+        Max number of requests of all stories sent at once
+    controller : AIMDController, optional
+        Adapts the cap, see `AdaptiveLimiter`
+    """
+    def __init__(self, max_in_flight, controller=None):
+        super().__init__(max_in_flight, controller)
+        self._lock = threading.Lock()
+
+    def acquire(self, story_id, priority=()):
+        """Waits for a slot, lowest priority first with a controller"""
+        with self._lock:
+            entry = self._enqueue(story_id, priority,
+                                  threading.Condition(self._lock))
+            waited = not self._can_admit(entry)
+            try:
+                while not self._can_admit(entry):
+                    self._waiting[entry].wait()
+            except BaseException:
+                self._cancel(entry)
+                raise
+            self._admit(entry, waited)
+
+    def release(self, story_id, latency=None, ttft=None, failed=False):
+        """Frees the slot, the outcome of the request feeds the controller"""
+        with self._lock:
+            self._release(story_id, {'latency': latency, 'ttft': ttft,
+                                     'failed': failed})
+
+    def stats(self):
+        with self._lock:
+            return self._stats()
+
+
+class AsyncFairLimiter(_FairQueue):
+    """`FairLimiter` for the stories of one event loop"""
+    def __init__(self, max_in_flight, controller=None):
+        super().__init__(max_in_flight, controller)
+        self._lock = None
+
+    async def acquire(self, story_id, priority=()):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            entry = self._enqueue(story_id, priority,
+                                  asyncio.Condition(self._lock))
+            waited = not self._can_admit(entry)
+            try:
+                while not self._can_admit(entry):
+                    await self._waiting[entry].wait()
+            except BaseException:
+                self._cancel(entry)
+                raise
+            self._admit(entry, waited)
+
+    async def release(self, story_id, latency=None, ttft=None,
+                      failed=False):
+        async with self._lock:
+            self._release(story_id, {'latency': latency, 'ttft': ttft,
+                                     'failed': failed})
+
+    def stats(self):
+        return self._stats()
+
+
+class AdaptiveLimiter(FairLimiter):
+    """`FairLimiter` whose cap follows the load, AIMD-style
+
+    The cap starts at half of max_in_flight and is kept by an
+    `AIMDController` between min_in_flight and max_in_flight. Waiting
+    requests are admitted by the priority the agents give them, see
+    `StoryAgent.request_priority`, and the stories with the fewest
+    requests in flight go first among equals.
+
+    Admission is not tied to `BatchRunner`: every backend call of an agent
+    given the limiter as request_limiter holds a slot for its duration,
+    see `StoryAgent.request_slot`. Async agents take
+    `AsyncAdaptiveLimiter`.
+
+    Parameters
+    ----------
+    max_in_flight : int
+        Ceiling of the requests of all stories sent at once
+    min_in_flight : int
+        Floor of the cap
+    **kwargs
+        Other `AIMDController` parameters
+    """
+    def __init__(self, max_in_flight, min_in_flight=1, **kwargs):
+        super().__init__(max_in_flight, AIMDController(
+            max_in_flight, min_limit=min_in_flight, **kwargs))
+
+
+class AsyncAdaptiveLimiter(AsyncFairLimiter):
+    """`AdaptiveLimiter` for the stories of one event loop"""
+    def __init__(self, max_in_flight, min_in_flight=1, **kwargs):
+        super().__init__(max_in_flight, AIMDController(
+            max_in_flight, min_limit=min_in_flight, **kwargs))
+
+
+class LimiterManager(BaseManager):
+    """Serves one limiter to the worker processes of a batch"""
+
+
+LimiterManager.register('FairLimiter', FairLimiter)
+LimiterManager.register('AdaptiveLimiter', AdaptiveLimiter)
+
+
+def read_topics(fpath):
+    """Topics from a text file, one per line, blank lines and # skipped"""
+    with open(fpath) as fp:
+        return [line.strip() for line in fp
+                if line.strip() and not line.lstrip().startswith('#')]
+
+
+def _write_json(fpath, output):
+    tmp_path = fpath + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(output, fp, indent=4)
+    os.replace(tmp_path, fpath)
+
+
+def _story_result(story_id, topic, start, agent, scenes=None, error=None):
+    return {'story_id': story_id, 'topic': topic,
+            'elapsed': time.monotonic() - start,
+            'requests': agent.usage['requests'],
+            'completion_tokens': agent.usage['completion_tokens'],
+            'retry_budget': agent.retry_stats(),
+            'scenes': scenes, 'error': error}
+
+
+def _shared_kwargs(output_dir, record=False):
+    """Metrics and trace recorder the stories of a batch write to"""
+    kwargs = {'metrics': Metrics(os.path.join(output_dir, 'metrics.jsonl'))}
+    if record:
+        kwargs['recorder'] = TrafficRecorder(
+            os.path.join(output_dir, 'traffic.jsonl'))
+    return kwargs
+
+
+# shared by the stories of a worker process, see `BatchRunner._run_processes`
+_process_kwargs = {}
+
+
+def _init_process(output_dir, record):
+    _process_kwargs.update(_shared_kwargs(output_dir, record))
+
+
+def _agent_kwargs(agent_kwargs, shared):
+    # interleaved prompts of concurrent stories are of no use on stdout
+    return {'logger': AgentLogger(), **shared, **agent_kwargs}
+
+
+def _run_story(story_id, topic, output_dir, backend_uri, agent_kwargs,
+               request_limiter, shared):
+    start = time.monotonic()
+    agent = StoryAgent(backend_uri, request_limiter=request_limiter,
+                       story_id=story_id,
+                       **_agent_kwargs(agent_kwargs, shared))
+    try:
+        scenes = agent.generate_story(
+            topic, run_id=story_id, run_dir=os.path.join(output_dir, 'runs'))
+        result = _story_result(story_id, topic, start, agent, scenes=scenes)
+    except Exception as exc:
+        traceback.print_exc()
+        result = _story_result(story_id, topic, start, agent, error=repr(exc))
+    finally:
+        agent.transport.close()
+    _write_json(os.path.join(output_dir, f'{story_id}.json'), result)
+    return result
+
+
+def _run_process_story(story_id, topic, output_dir, backend_uri, agent_kwargs,
+                       request_limiter):
+    return _run_story(story_id, topic, output_dir, backend_uri, agent_kwargs,
+                      request_limiter, _process_kwargs)
+
+
+async def _arun_story(story_id, topic, output_dir, backend_uri, agent_kwargs,
+                      request_limiter, shared):
+    from goat_storytelling_agent.async_agent import AsyncStoryAgent
+
+    start = time.monotonic()
+    async with AsyncStoryAgent(
+            backend_uri, request_limiter=request_limiter, story_id=story_id,
+            **_agent_kwargs(agent_kwargs, shared)) as agent:
+        try:
+            scenes = await agent.generate_story(
+                topic, run_id=story_id,
+                run_dir=os.path.join(output_dir, 'runs'))
+            result = _story_result(story_id, topic, start, agent,
+                                   scenes=scenes)
+        except Exception as exc:
+            traceback.print_exc()
+            result = _story_result(story_id, topic, start, agent,
+                                   error=repr(exc))
+    _write_json(os.path.join(output_dir, f'{story_id}.json'), result)
+    return result
+
+
+class BatchRunner:
+    """Generates a story for every topic with a shared request budget
+
+    Parameters
+    ----------
+    backend_uri : str or List[str]
+        Backend endpoint or replicas, as for `StoryAgent`
+    output_dir : str
+        Directory for story outputs, checkpoints and the report
+    mode : str
+        'thread', 'process' or 'async' worker pool
+    workers : int
+        Number of stories generated at once
+    max_in_flight : int
+        Max number of backend requests of all stories at once
+    adaptive : bool
+        Adapt the cap to the backend load up to max_in_flight and admit
+        requests by priority, see `AdaptiveLimiter`
+    record : bool
+        Write the backend calls of all stories to output_dir/traffic.jsonl
+        with a `traffic.TrafficRecorder`
+    agent_kwargs : Dict
+        Other `StoryAgent` arguments, e.g. backend and scene_parallelism.
+        Must be picklable in process mode. Agents log nothing by default.
+
+    Attributes
+    ----------
+    metrics : Metrics
+        Call and stage records of all stories of the last run, in thread
+        and async mode. Worker processes keep one `Metrics` each.
+    recorder : TrafficRecorder
+        Trace recorder of the last run if record is set
+    """
+    def __init__(self, backend_uri, output_dir='stories', mode='thread',
+                 workers=4, max_in_flight=8, adaptive=False, record=False,
+                 agent_kwargs={}):
+        if mode not in MODES:
+            raise ValueError("Unknown batch mode")
+        self.backend_uri = backend_uri
+        self.output_dir = output_dir
+        self.mode = mode
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.adaptive = adaptive
+        self.record = record
+        self.agent_kwargs = agent_kwargs
+        self.metrics = None
+        self.recorder = None
+
+    @staticmethod
+    def story_id(idx):
+        return f"story-{idx:05d}"
+
+    def load_finished(self, story_id, topic):
+        """Output of a story finished by an earlier run, None otherwise"""
+        fpath = os.path.join(self.output_dir, f'{story_id}.json')
+        if not os.path.exists(fpath):
+            return None
+        with open(fpath) as fp:
+            result = json.load(fp)
+        if result['topic'] != topic or result['error'] is not None:
+            return None
+        return result
+
+    def run(self, topics):
+        """Generates all stories, writing each output as it finishes
+
+        Parameters
+        ----------
+        topics : List[str]
+            Story topics, ids are assigned by position in the list
+
+        Returns
+        -------
+        Dict
+            Throughput report, also saved to output_dir/report.json
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        jobs = []
+        skipped = []
+        for idx, topic in enumerate(topics):
+            story_id = self.story_id(idx)
+            if self.load_finished(story_id, topic) is not None:
+                skipped.append(story_id)
+                continue
+            jobs.append((story_id, topic))
+
+        self.metrics = self.recorder = None
+        if self.mode != 'process':
+            shared = _shared_kwargs(self.output_dir, self.record)
+            self.metrics = shared['metrics']
+            self.recorder = shared.get('recorder')
+        start = time.monotonic()
+        if self.mode == 'thread':
+            results, limiter_stats, batcher_stats = self._run_threads(
+                jobs, shared)
+        elif self.mode == 'process':
+            results, limiter_stats, batcher_stats = self._run_processes(jobs)
+        else:
+            results, limiter_stats, batcher_stats = asyncio.run(
+                self._run_async(jobs, shared))
+        elapsed = time.monotonic() - start
+
+        finished = [result for result in results if result['error'] is None]
+        n_tokens = sum(result['completion_tokens'] for result in results)
+        report = {
+            'mode': self.mode,
+            'workers': self.workers,
+            'adaptive': self.adaptive,
+            'stories': len(topics),
+            'finished': len(finished),
+            'failed': len(results) - len(finished),
+            'skipped': len(skipped),
+            'elapsed': elapsed,
+            'requests': sum(result['requests'] for result in results),
+            'completion_tokens': n_tokens,
+            'stories_per_hour': (3600 * len(finished) / elapsed
+                                 if elapsed else 0.0),
+            'tokens_per_second': n_tokens / elapsed if elapsed else 0.0,
+            'limiter': limiter_stats,
+            'batcher': batcher_stats,
+            'failed_stories': [result['story_id'] for result in results
+                               if result['error'] is not None],
+        }
+        _write_json(os.path.join(self.output_dir, 'report.json'), report)
+        return report
+
+    def shared_batcher(self, batcher_cls, endpoints, **kwargs):
+        """Batcher for the prompts of all stories, None if not needed"""
+        if (self.agent_kwargs.get('backend', 'hf').lower() != 'openai'
+                or self.agent_kwargs.get('batcher') is not None):
+            return None
+        return batcher_cls(
+            endpoints,
+            max_batch_size=self.agent_kwargs.get('max_batch_size', 16),
+            max_wait=self.agent_kwargs.get('batch_wait', 0.01),
+            request_timeout=self.agent_kwargs.get('request_timeout', 120),
+            api_key=os.environ.get('OPENAI_API_KEY'), logger=AgentLogger(),
+            **kwargs)
+
+    def _run_threads(self, jobs, shared):
+        limiter_cls = AdaptiveLimiter if self.adaptive else FairLimiter
+        limiter = limiter_cls(self.max_in_flight)
+        # the stories share endpoint health and load
+        endpoints = EndpointPool.wrap(self.backend_uri)
+        agent_kwargs = self.agent_kwargs
+        batcher = self.shared_batcher(
+            CompletionBatcher, endpoints,
+            transport=Transport(pool_size=self.max_in_flight))
+        if batcher is not None:
+            agent_kwargs = {**agent_kwargs, 'batcher': batcher}
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = [pool.submit(
+                    _run_story, story_id, topic, self.output_dir,
+                    endpoints, agent_kwargs, limiter, shared)
+                    for story_id, topic in jobs]
+                results = [future.result() for future in futures]
+        finally:
+            if batcher is not None:
+                batcher.transport.close()
+        return (results, limiter.stats(),
+                batcher.stats() if batcher is not None else None)
+
+    def _run_processes(self, jobs):
+        with LimiterManager() as manager:
+            limiter = (manager.AdaptiveLimiter if self.adaptive
+                       else manager.FairLimiter)(self.max_in_flight)
+            # the stories of a worker process share its metrics and
+            # recorder
+            with ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=_init_process,
+                    initargs=(self.output_dir, self.record)) as pool:
+                futures = [pool.submit(
+                    _run_process_story, story_id, topic, self.output_dir,
+                    self.backend_uri, self.agent_kwargs, limiter)
+                    for story_id, topic in jobs]
+                results = [future.result() for future in futures]
+            # every story batches its own prompts
+            return results, limiter.stats(), None
+
+    async def _run_async(self, jobs, shared):
+        limiter_cls = AsyncAdaptiveLimiter if self.adaptive \
+            else AsyncFairLimiter
+        limiter = limiter_cls(self.max_in_flight)
+        semaphore = asyncio.Semaphore(self.workers)
+        endpoints = EndpointPool.wrap(self.backend_uri)
+        agent_kwargs = self.agent_kwargs
+        batcher = self.shared_batcher(
+            AsyncCompletionBatcher, endpoints, pool_size=self.max_in_flight)
+        if batcher is not None:
+            agent_kwargs = {**agent_kwargs, 'batcher': batcher}
+
+        async def bounded(story_id, topic):
+            async with semaphore:
+                return await _arun_story(
+                    story_id, topic, self.output_dir, endpoints,
+                    agent_kwargs, limiter, shared)
+        try:
+            results = await asyncio.gather(
+                *[bounded(story_id, topic) for story_id, topic in jobs])
+        finally:
+            if batcher is not None:
+                await batcher.aclose()
+        return (list(results), limiter.stats(),
+                batcher.stats() if batcher is not None else None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate a story for every topic of a file")
+    parser.add_argument('topics', help="text file with one topic per line")
+    parser.add_argument('--backend-uri', action='append', required=True,
+                        help="backend endpoint, repeat for replicas")
+    parser.add_argument('--backend', default='hf', choices=SUPPORTED_BACKENDS)
+    parser.add_argument('--form', default='novel')
+    parser.add_argument('--output-dir', default='stories')
+    parser.add_argument('--mode', default='thread', choices=MODES)
+    parser.add_argument('--workers', type=int, default=4,
+                        help="stories generated at once")
+    parser.add_argument('--max-in-flight', type=int, default=8,
+                        help="backend requests of all stories at once")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="adapt the requests in flight to the backend "
+                             "load, up to --max-in-flight")
+    parser.add_argument('--record', action='store_true',
+                        help="write the backend calls to a replayable "
+                             "trace, output_dir/traffic.jsonl")
+    parser.add_argument('--scene-parallelism', type=int, default=1)
+    parser.add_argument('--scene-dependency', default='story')
+    parser.add_argument('--token-counter', default=None)
+    parser.add_argument('--max-batch-size', type=int, default=16,
+                        help="prompts per request of the openai backend")
+    args = parser.parse_args(argv)
+
+    backend_uri = args.backend_uri
+    if len(backend_uri) == 1:
+        backend_uri = backend_uri[0]
+    runner = BatchRunner(
+        backend_uri, output_dir=args.output_dir, mode=args.mode,
+        workers=args.workers, max_in_flight=args.max_in_flight,
+        adaptive=args.adaptive, record=args.record,
+        agent_kwargs={'backend': args.backend, 'form': args.form,
+                      'scene_parallelism': args.scene_parallelism,
+                      'scene_dependency': args.scene_dependency,
+                      'token_counter': args.token_counter,
+                      'max_batch_size': args.max_batch_size})
+    report = runner.run(read_topics(args.topics))
+    print(f"Finished {report['finished']} of {report['stories']} stories "
+          f"({report['failed']} failed, {report['skipped']} skipped) "
+          f"in {report['elapsed']:.1f}s: "
+          f"{report['stories_per_hour']:.2f} stories/hour, "
+          f"{report['tokens_per_second']:.1f} tokens/sec")
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""Content-addressed cache of backend responses.
+
+Responses are keyed on everything that determines the generation: the
+rendered prompt, backend name, max_tokens and extra options. Recent
+entries are kept in an in-memory LRU, optionally backed by an SQLite file
+that survives restarts.
+"""
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """Two-level (memory LRU + SQLite) response cache with eviction
+
+    Parameters
+    ----------
+    path : str, optional
+        SQLite file for the persistent level, memory only if None
+    max_memory_entries : int
+        Size of the in-memory LRU
+    max_disk_entries : int
+        Max number of entries kept on disk, least recently used are dropped
+    max_age : float, optional
+        Entries older than max_age seconds are treated as missing and evicted
+    """
+    def __init__(self, path=None, max_memory_entries=1024,
+                 max_disk_entries=100000, max_age=None):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.max_age = max_age
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0,
+                       'misses': 0, 'stores': 0, 'evictions': 0}
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT, "
+                "created REAL, accessed REAL)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(prompt, backend, max_tokens, extra_options):
+        payload = json.dumps(
+            [prompt, backend, max_tokens, extra_options], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def is_sampling(extra_options, backend='hf'):
+        """Whether a call with the generation options samples its answer
+
+        TGI decodes greedily unless do_sample or a temperature is set,
+        llama.cpp and OpenAI-compatible servers sample by default and are
+        only greedy with an explicit temperature of 0 or do_sample false.
+        """
+        temperature = extra_options.get('temperature')
+        if backend == 'hf':
+            return bool(extra_options.get('do_sample')) or (
+                (temperature or 0) > 0)
+        if extra_options.get('do_sample') is False:
+            return False
+        return temperature is None or temperature > 0
+
+    def _expired(self, created, now):
+        return self.max_age is not None and now - created > self.max_age
+
+    def get(self, key):
+        """Returns cached response or None"""
+        now = time.time()
+        with self._lock:
+            if key in self._memory:
+                value, created = self._memory[key]
+                if not self._expired(created, now):
+                    self._memory.move_to_end(key)
+                    self._stats['hits'] += 1
+                    self._stats['memory_hits'] += 1
+                    return value
+                del self._memory[key]
+                self._stats['evictions'] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM responses WHERE key = ?",
+                    (key,)).fetchone()
+                if row is not None and not self._expired(row[1], now):
+                    self._db.execute(
+                        "UPDATE responses SET accessed = ? WHERE key = ?",
+                        (now, key))
+                    self._db.commit()
+                    self._remember(key, row[0], row[1])
+                    self._stats['hits'] += 1
+                    self._stats['disk_hits'] += 1
+                    return row[0]
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            self._stats['stores'] += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, value, now, now))
+                self._db.commit()
+                self._evict_disk(now)
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def _evict_disk(self, now):
+        n_deleted = 0
+        if self.max_age is not None:
+            n_deleted += self._db.execute(
+                "DELETE FROM responses WHERE created < ?",
+                (now - self.max_age,)).rowcount
+        n_entries = self._db.execute(
+            "SELECT COUNT(*) FROM responses").fetchone()[0]
+        if n_entries > self.max_disk_entries:
+            n_deleted += self._db.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                (n_entries - self.max_disk_entries,)).rowcount
+        if n_deleted:
+            self._db.commit()
+            self._stats['evictions'] += n_deleted
+
+    def stats(self):
+        """Hit/miss counters and current sizes of both levels"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+            if self._db is not None:
+                stats['disk_entries'] = self._db.execute(
+                    "SELECT COUNT(*) FROM responses").fetchone()[0]
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,162 @@
+"""Run directory with stage outputs and scenes of a generate_story run.
+
+Layout of `<run_dir>/<run_id>/`:
+    meta.json           topic of the run
+    <stage>.json        output of every finished pipeline stage
+    fingerprints.json   fingerprint of the inputs of every saved stage
+    scenes.jsonl        one line per finished scene with the fingerprint
+                        of its inputs, appended as they finish
+
+The fingerprints let `StoryAgent.recompute` tell which saved outputs were
+made from the current inputs after an edit, see `fingerprint`.
+"""
+import os
+import json
+import hashlib
+import threading
+
+from goat_storytelling_agent.plan import Plan
+
+
+PLAN_STAGES = ('create_plot_chapters', 'enhance_plot_chapters',
+               'split_chapters_into_scenes')
+
+
+def fingerprint(*inputs):
+    """Short hash of JSON-serializable inputs"""
+    data = json.dumps(inputs, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+class RunCheckpoint:
+    def __init__(self, run_dir, run_id):
+        self.run_id = run_id
+        self.path = os.path.join(run_dir, run_id)
+        os.makedirs(self.path, exist_ok=True)
+        self.scenes_path = os.path.join(self.path, 'scenes.jsonl')
+        self.fingerprints_path = os.path.join(self.path, 'fingerprints.json')
+        self._lock = threading.Lock()
+
+    def _stage_path(self, stage):
+        return os.path.join(self.path, f'{stage}.json')
+
+    def _write_atomic(self, fpath, write):
+        tmp_path = fpath + '.tmp'
+        write(tmp_path)
+        os.replace(tmp_path, fpath)
+
+    def check_topic(self, topic):
+        """Stores the topic of a new run, fails if a resumed run differs"""
+        meta_path = os.path.join(self.path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as fp:
+                meta = json.load(fp)
+            if meta['topic'] != topic:
+                raise ValueError(
+                    f"Run {self.run_id} was started for topic "
+                    f"{meta['topic']!r}, not {topic!r}")
+            return
+
+        def write(fpath):
+            with open(fpath, 'w') as fp:
+                json.dump({'topic': topic}, fp, indent=4)
+        self._write_atomic(meta_path, write)
+
+    def load_topic(self):
+        with open(os.path.join(self.path, 'meta.json')) as fp:
+            return json.load(fp)['topic']
+
+    def has_stage(self, stage):
+        return os.path.exists(self._stage_path(stage))
+
+    def load_stage(self, stage):
+        if stage in PLAN_STAGES:
+            return Plan.load_plan(self._stage_path(stage))
+        with open(self._stage_path(stage)) as fp:
+            return json.load(fp)
+
+    def save_stage(self, stage, output, fingerprint=None):
+        """Saves the output of a stage and the fingerprint of its inputs"""
+        if stage in PLAN_STAGES:
+            self._write_atomic(self._stage_path(stage),
+                               lambda fpath: Plan.save_plan(output, fpath))
+        else:
+            def write(fpath):
+                with open(fpath, 'w') as fp:
+                    json.dump(output, fp, indent=4)
+            self._write_atomic(self._stage_path(stage), write)
+        if fingerprint is not None:
+            self.save_fingerprint(stage, fingerprint)
+
+    def load_fingerprints(self):
+        if not os.path.exists(self.fingerprints_path):
+            return {}
+        with open(self.fingerprints_path) as fp:
+            return json.load(fp)
+
+    def stage_fingerprint(self, stage):
+        """Fingerprint the saved output of stage was made from, if known"""
+        return self.load_fingerprints().get(stage)
+
+    def save_fingerprint(self, stage, fingerprint):
+        with self._lock:
+            fingerprints = self.load_fingerprints()
+            fingerprints[stage] = fingerprint
+
+            def write(fpath):
+                with open(fpath, 'w') as fp:
+                    json.dump(fingerprints, fp, indent=4)
+            self._write_atomic(self.fingerprints_path, write)
+
+    def load_scenes(self):
+        """Finished scene records in generation order
+
+        A torn last line left by a crash in the middle of a write is
+        dropped from the file, the scene is regenerated on resume.
+        """
+        if not os.path.exists(self.scenes_path):
+            return []
+        scenes = []
+        torn = False
+        with open(self.scenes_path) as fp:
+            for line in fp:
+                try:
+                    scenes.append(json.loads(line))
+                except json.JSONDecodeError:
+                    torn = True
+                    break
+        if torn:
+            def write(fpath):
+                with open(fpath, 'w') as fp:
+                    for record in scenes:
+                        fp.write(json.dumps(record) + '\n')
+            self._write_atomic(self.scenes_path, write)
+        return scenes
+
+    def append_scene(self, act_num, ch_num, sc_num, text, fingerprint=None):
+        record = {'act_num': act_num, 'ch_num': ch_num, 'sc_num': sc_num,
+                  'text': text}
+        if fingerprint is not None:
+            record['fingerprint'] = fingerprint
+        # scenes of different chains can finish concurrently
+        with self._lock, open(self.scenes_path, 'a') as fp:
+            fp.write(json.dumps(record) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def compact_scenes(self, keys):
+        """Keeps the last record of every scene in keys, in their order
+
+        Regenerated scenes are appended after the records they replace,
+        keys are the (act_num, ch_num, sc_num) of the scenes of the plan.
+        """
+        latest = {(record.get('act_num'), record['ch_num'], record['sc_num']):
+                  record for record in self.load_scenes()}
+
+        def write(fpath):
+            with open(fpath, 'w') as fp:
+                for key in keys:
+                    if key in latest:
+                        fp.write(json.dumps(latest[key]) + '\n')
+        with self._lock:
+            self._write_atomic(self.scenes_path, write)
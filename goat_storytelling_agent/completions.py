@@ -0,0 +1,389 @@
+"""Batched requests to OpenAI-compatible /v1/completions servers.
+
+Servers like vLLM take a list of prompts in one completions request and
+stream the choices of all of them interleaved, tagged with the index of
+their prompt. A `CompletionBatcher` collects the prompts of concurrent
+callers, of one story or many, that share generation options, sends them
+as one streamed request and passes every caller the deltas of its own
+prompt. The request leaves max_tokens out, so the server generates up to
+the end of its context for every prompt, and the completion budget of each
+prompt is kept on the client: its stream ends once it got that many
+tokens, a streamed choice carrying one token.
+
+The request is closed once every caller has its completion or stopped
+reading, and after a failure only the unfinished prompts are sent again.
+Once all attempts failed, or on an unexpected error, the error that ended
+the batch is raised to all of its callers.
+"""
+import json
+import time
+import queue
+import asyncio
+import threading
+
+import requests
+
+from goat_storytelling_agent.transport import EndpointPool
+from goat_storytelling_agent.instrumentation import ConsoleLogger
+
+
+COMPLETIONS_PATH = '/v1/completions'
+# put after the last delta of a prompt
+_END = object()
+
+
+class _Request:
+    """Prompt of one caller and the queue its deltas are passed through"""
+    def __init__(self, prompt, max_tokens, deltas):
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.deltas = deltas
+        self.n_deltas = 0
+        self.done = False
+        # the caller stopped reading
+        self.cancelled = False
+
+
+class _Batch:
+    def __init__(self, options, full):
+        self.options = options
+        self.requests = []
+        # set when max_batch_size prompts are in
+        self.full = full
+
+
+def _payload(options, batch):
+    return json.dumps({
+        **options, 'prompt': [request.prompt for request in batch],
+        'max_tokens': None, 'stream': True})
+
+
+def _dispatch(line, batch):
+    """Passes the choices of a stream line to their requests
+
+    Returns
+    -------
+    bool
+        False once the stream is done
+    """
+    line = line.strip()
+    if not line.startswith(b"data:"):
+        return True
+    data = line[5:].strip()
+    if data == b"[DONE]":
+        return False
+    parsed = json.loads(data)
+    if parsed.get("error"):
+        raise ValueError(parsed["error"])
+    for choice in parsed.get("choices") or ():
+        request = batch[choice["index"]]
+        if request.done:
+            continue
+        if choice.get("text"):
+            request.n_deltas += 1
+            request.deltas.put_nowait(choice["text"])
+        if (choice.get("finish_reason")
+                or request.n_deltas >= request.max_tokens):
+            request.done = True
+            request.deltas.put_nowait(_END)
+    return True
+
+
+def _finished(batch):
+    return all(request.done or request.cancelled for request in batch)
+
+
+def _end(batch):
+    """Ends the requests a finished stream had no finish_reason for"""
+    for request in batch:
+        if not request.done:
+            request.done = True
+            request.deltas.put_nowait(_END)
+
+
+def _fail(batch, exc):
+    """Passes exc to the callers of the unfinished requests"""
+    for request in batch:
+        if not request.done:
+            request.done = True
+            request.deltas.put_nowait(exc)
+
+
+def _restart(batch):
+    """Requests of a failed batch to send again, their deltas are reset"""
+    pending = [request for request in batch
+               if not request.done and not request.cancelled]
+    for request in pending:
+        if request.n_deltas:
+            request.n_deltas = 0
+            request.deltas.put_nowait(None)
+    return pending
+
+
+class CompletionBatcher:
+    """Sends the completion requests of many threads as batched calls
+
+    Parameters
+    ----------
+    endpoint : str or List[str] or EndpointPool
+        Server url, replicas or a shared pool
+    transport : Transport, optional
+        Pooled HTTP transport, `requests.post` is used if not given
+    max_batch_size : int
+        Max number of prompts sent in one request
+    max_wait : float
+        Seconds the first prompt of a batch waits for more
+    request_timeout : float
+        Timeout of a request in seconds
+    retries : int
+        Attempts of a batch
+    api_key : str, optional
+        Sent as a bearer token
+    logger : AgentLogger, optional
+        Receives request errors
+    """
+    def __init__(self, endpoint, transport=None, max_batch_size=16,
+                 max_wait=0.01, request_timeout=120, retries=3,
+                 api_key=None, logger=None):
+        self.endpoints = EndpointPool.wrap(endpoint)
+        self.transport = transport
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.request_timeout = request_timeout
+        self.retries = retries
+        self.headers = {'Content-Type': 'application/json'}
+        if api_key:
+            self.headers['Authorization'] = f'Bearer {api_key}'
+        self.logger = logger or ConsoleLogger()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stats = {'batches': 0, 'prompts': 0, 'max_batch_size': 0}
+
+    def stream(self, prompt, max_tokens, options):
+        """Yields the text deltas of the completion of prompt
+
+        None is yielded when a failed batch is sent again, deltas received
+        before it must be discarded. Raises the error that ended the batch
+        if all attempts failed or it failed otherwise.
+
+        Parameters
+        ----------
+        prompt : str
+            Prompt text
+        max_tokens : int
+            Completion budget of the prompt, the stream ends after that
+            many tokens
+        options : Dict
+            Generation options, only prompts with equal options are
+            batched
+        """
+        request = self._request(prompt, max_tokens, queue.SimpleQueue())
+        self._submit(request, options)
+        try:
+            while True:
+                delta = request.deltas.get()
+                if delta is _END:
+                    return
+                if isinstance(delta, Exception):
+                    raise delta
+                yield delta
+        finally:
+            request.cancelled = True
+
+    def stats(self):
+        """Batches sent, prompts sent in them and the largest batch"""
+        with self._lock:
+            return dict(self._stats)
+
+    @staticmethod
+    def _request(prompt, max_tokens, deltas):
+        if max_tokens < 1:
+            raise ValueError(
+                f"No completion budget left for the prompt ({max_tokens} "
+                "tokens), it does not fit the context")
+        return _Request(prompt, max_tokens, deltas)
+
+    def _submit(self, request, options):
+        key = json.dumps(options, sort_keys=True)
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = self._pending[key] = _Batch(options, self._event())
+                self._start(key, batch)
+            batch.requests.append(request)
+            if len(batch.requests) >= self.max_batch_size:
+                del self._pending[key]
+                batch.full.set()
+
+    def _take(self, key, batch):
+        """Closes the batch to new prompts"""
+        with self._lock:
+            if self._pending.get(key) is batch:
+                del self._pending[key]
+            self._stats['batches'] += 1
+            self._stats['prompts'] += len(batch.requests)
+            self._stats['max_batch_size'] = max(
+                self._stats['max_batch_size'], len(batch.requests))
+        return batch.requests
+
+    def _event(self):
+        return threading.Event()
+
+    def _start(self, key, batch):
+        threading.Thread(target=self._run, args=(key, batch),
+                         daemon=True).start()
+
+    def _run(self, key, batch):
+        batch.full.wait(self.max_wait)
+        pending = self._take(key, batch)
+        try:
+            self._send(pending, batch.options)
+        except Exception as exc:
+            self.logger.error(f"\nBatch of {len(pending)} prompts failed",
+                              exc_info=True)
+            _fail(pending, exc)
+
+    def _send(self, pending, options):
+        post = self.transport.post if self.transport is not None \
+            else requests.post
+        for attempt in range(self.retries):
+            ok = False
+            endpoint = self.endpoints.acquire()
+            start = time.monotonic()
+            try:
+                response = post(
+                    f"{endpoint.url}{COMPLETIONS_PATH}", headers=self.headers,
+                    data=_payload(options, pending),
+                    timeout=self.request_timeout, stream=True)
+                # closing drops the generation of cancelled prompts
+                with response:
+                    response.raise_for_status()
+                    for line in response.iter_lines():
+                        if not _dispatch(line, pending) or _finished(pending):
+                            break
+                ok = True
+            except (requests.RequestException, ValueError) as exc:
+                error = exc
+                self.logger.error(
+                    f"\nBatch of {len(pending)} prompts failed "
+                    f"(retry={self.retries - attempt - 1})", exc_info=True)
+            finally:
+                self.endpoints.release(endpoint, ok=ok,
+                                       latency=time.monotonic() - start)
+            if ok:
+                _end(pending)
+                return
+            pending = _restart(pending)
+            if not pending:
+                return
+            if attempt + 1 < self.retries:
+                time.sleep(self.endpoints.backoff(attempt))
+        _fail(pending, error)
+
+
+class AsyncCompletionBatcher(CompletionBatcher):
+    """`CompletionBatcher` for the coroutines of one event loop
+
+    Requires `aiohttp`. The HTTP session is opened on the first batch,
+    call `aclose()` when done.
+    """
+    def __init__(self, endpoint, max_batch_size=16, max_wait=0.01,
+                 request_timeout=120, retries=3, api_key=None, logger=None,
+                 pool_size=100):
+        super().__init__(
+            endpoint, max_batch_size=max_batch_size, max_wait=max_wait,
+            request_timeout=request_timeout, retries=retries,
+            api_key=api_key, logger=logger)
+        self.pool_size = pool_size
+        self._session = None
+        self._tasks = set()
+
+    async def stream(self, prompt, max_tokens, options):
+        """Async version of `CompletionBatcher.stream`"""
+        request = self._request(prompt, max_tokens, asyncio.Queue())
+        self._submit(request, options)
+        try:
+            while True:
+                delta = await request.deltas.get()
+                if delta is _END:
+                    return
+                if isinstance(delta, Exception):
+                    raise delta
+                yield delta
+        finally:
+            request.cancelled = True
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        import aiohttp
+
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def _event(self):
+        return asyncio.Event()
+
+    def _start(self, key, batch):
+        task = asyncio.ensure_future(self._run(key, batch))
+        # the loop only keeps weak references to tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, batch):
+        try:
+            await asyncio.wait_for(batch.full.wait(), self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        pending = self._take(key, batch)
+        try:
+            await self._send(pending, batch.options)
+        except Exception as exc:
+            self.logger.error(f"\nBatch of {len(pending)} prompts failed",
+                              exc_info=True)
+            _fail(pending, exc)
+
+    async def _send(self, pending, options):
+        import aiohttp
+
+        session = self._get_session()
+        timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+        for attempt in range(self.retries):
+            ok = False
+            endpoint = self.endpoints.acquire()
+            start = time.monotonic()
+            try:
+                async with session.post(
+                        f"{endpoint.url}{COMPLETIONS_PATH}",
+                        headers=self.headers,
+                        data=_payload(options, pending),
+                        timeout=timeout) as response:
+                    response.raise_for_status()
+                    async for line in response.content:
+                        if not _dispatch(line, pending) or _finished(pending):
+                            response.close()
+                            break
+                ok = True
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    ValueError) as exc:
+                error = exc
+                self.logger.error(
+                    f"\nBatch of {len(pending)} prompts failed "
+                    f"(retry={self.retries - attempt - 1})", exc_info=True)
+            finally:
+                self.endpoints.release(endpoint, ok=ok,
+                                       latency=time.monotonic() - start)
+            if ok:
+                _end(pending)
+                return
+            pending = _restart(pending)
+            if not pending:
+                return
+            if attempt + 1 < self.retries:
+                await asyncio.sleep(self.endpoints.backoff(attempt))
+        _fail(pending, error)
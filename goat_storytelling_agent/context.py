@@ -0,0 +1,143 @@
+"""Scene prompts assembled within the token budget of the context window.
+
+A scene prompt holds the plot outline and the tail of the previous scene,
+and the completion gets what is left of `max_tokens`. For long novels the
+whole outline leaves too little room for the scene, so the outline is
+narrowed around the act of the scene: the farthest acts are first cut to
+their description, then left out, and only then the previous scene tail
+is shortened. The current act is always kept in full. If the prompt still
+does not fit, the scene specification is cut, and a scene that cannot
+get its minimum completion raises `SceneContextOverflow` instead of
+being sent.
+"""
+
+
+class SceneContextOverflow(ValueError):
+    """Even the smallest scene prompt leaves too little for the scene"""
+
+
+def context_variants(n_acts, act_idx, n_words, min_words=50):
+    """Yields (details, n_words) of scene contexts, largest first
+
+    details are the per-act levels of `Plan.plan_2_str`. Acts farther from
+    act_idx lose detail first, later acts before earlier ones at the same
+    distance. Once only the current act is left, the previous scene tail
+    of n_words is halved down to min_words and then dropped.
+    """
+    details = ['full'] * n_acts
+    yield list(details), n_words
+    others = sorted((i for i in range(n_acts) if i != act_idx),
+                    key=lambda i: (abs(i - act_idx), i > act_idx),
+                    reverse=True)
+    for level in ('summary', None):
+        for i in others:
+            details[i] = level
+            yield list(details), n_words
+    while n_words:
+        n_words = n_words // 2 if n_words > min_words else 0
+        yield list(details), n_words
+
+
+class SceneContext:
+    """Picks the largest scene prompt that leaves room for the scene
+
+    Parameters
+    ----------
+    count_tokens : Callable[[List[Dict]], int]
+        Prompt tokens of chat messages, as the backend counts them
+    max_tokens : int
+        Context window shared by the prompt and the completion
+    min_new_tokens : int
+        Completion tokens every scene must have room for
+    max_prompt_tokens : int, optional
+        Cap of scene prompts below the window, to cut prompt processing
+    min_spec_words : int
+        Words of the scene specification kept at least when it is cut
+    """
+    def __init__(self, count_tokens, max_tokens, min_new_tokens=1024,
+                 max_prompt_tokens=None, min_spec_words=20):
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.min_new_tokens = min_new_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self.min_spec_words = min_spec_words
+
+    @property
+    def budget(self):
+        budget = self.max_tokens - self.min_new_tokens
+        if self.max_prompt_tokens is not None:
+            budget = min(budget, self.max_prompt_tokens)
+        return budget
+
+    def assemble(self, build, plan, ch_num, n_words, n_spec_words=0):
+        """Builds the largest prompt within the budget
+
+        Parameters
+        ----------
+        build : Callable[[List, int, Optional[int]], List[Dict]]
+            Makes scene messages from the per-act details of the plan, the
+            number of previous scene words to keep and the number of scene
+            specification words to keep, None for all of them
+        plan : Plan
+            Book plan
+        ch_num : int
+            Chapter number of the scene
+        n_words : int
+            Previous scene words kept when the prompt fits
+        n_spec_words : int
+            Words of the scene specification
+
+        Returns
+        -------
+        List[Dict]
+            Scene messages
+        int
+            Prompt tokens, within the budget
+
+        Raises
+        ------
+        SceneContextOverflow
+            If the prompt does not fit even with the specification cut
+            to min_spec_words
+        """
+        variants = list(context_variants(
+            len(plan), plan.chapter_act(ch_num), n_words))
+
+        def size(idx):
+            messages = build(*variants[idx])
+            return messages, self.count_tokens(messages)
+
+        # the plain full prompt is the common case, one count suffices
+        messages, n_tokens = size(0)
+        if n_tokens <= self.budget or len(variants) == 1:
+            return messages, n_tokens
+        smallest = size(len(variants) - 1)
+        if smallest[1] > self.budget:
+            return self.crop_spec(build, variants[-1][0], ch_num,
+                                  n_spec_words, smallest[1])
+        # prompts shrink along the variants, find the first one that fits
+        low, high = 1, len(variants) - 1
+        best = smallest
+        while low < high:
+            mid = (low + high) // 2
+            messages, n_tokens = size(mid)
+            if n_tokens <= self.budget:
+                best = messages, n_tokens
+                high = mid
+            else:
+                low = mid + 1
+        return best
+
+    def crop_spec(self, build, details, ch_num, n_spec_words, n_tokens):
+        """Smallest prompt with the scene specification halved until it fits"""
+        spec_words = n_spec_words
+        while spec_words > self.min_spec_words:
+            spec_words = max(spec_words // 2, self.min_spec_words)
+            messages = build(details, 0, spec_words)
+            n_tokens = self.count_tokens(messages)
+            if n_tokens <= self.budget:
+                return messages, n_tokens
+        raise SceneContextOverflow(
+            f"Scene prompt of chapter {ch_num} has {n_tokens} tokens with "
+            f"only its act and a cut scene specification, over the budget "
+            f"of {self.budget}: raise max_tokens or lower min_scene_tokens")
@@ -0,0 +1,39 @@
+"""Events yielded by `StoryAgent.stream_story`."""
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass
+class StageFinished:
+    stage: str
+    output: Any
+
+
+@dataclass
+class SceneStarted:
+    act_num: int
+    ch_num: int
+    sc_num: int
+    scene: str
+
+
+@dataclass
+class TokenDelta:
+    """Piece of generated scene text
+
+    reset=True means the backend stream broke and was restarted, text
+    received for the scene so far has to be discarded.
+    """
+    act_num: int
+    ch_num: int
+    sc_num: int
+    text: str
+    reset: bool = False
+
+
+@dataclass
+class SceneFinished:
+    act_num: int
+    ch_num: int
+    sc_num: int
+    text: str
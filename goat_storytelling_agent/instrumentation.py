@@ -0,0 +1,299 @@
+"""Timing and token metrics of backend calls and pipeline stages.
+
+Every `query_chat` call and every pipeline stage of a `StoryAgent` is
+recorded by its `Metrics`. Records can be exported as JSONL, one JSON
+object per line, and aggregates as a Prometheus text format snapshot.
+
+Call record fields:
+    story_id, stage, start (unix time), wall_time, queue_time (waiting for
+    a slot of the request limiter), ttft (time to first token after the
+    queue, None for non-streaming backends), prompt_tokens,
+    completion_tokens, attempts, retries, requery (re-query after a failed
+    parse), cache_hit, ok, early_stop (stop string or validator that ended
+    the generation early, None if it ran to its end)
+
+Stage record fields:
+    story_id, stage, start, wall_time, calls, cache_hits, prompt_tokens,
+    completion_tokens, retries, requeries, resumed (loaded from a
+    checkpoint)
+
+Parse record fields:
+    story_id, stage, parser, ok (the answer was usable), issues
+
+The progress output of backend calls goes to a pluggable `AgentLogger`.
+"""
+import sys
+import json
+import time
+import logging
+import threading
+import traceback
+import contextlib
+from collections import deque
+
+
+CALL_SECONDS_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+_STAGE_SUMS = ('calls', 'cache_hits', 'prompt_tokens', 'completion_tokens',
+               'retries', 'requeries')
+
+
+class Metrics:
+    """Collects call and stage records of one or more agents
+
+    Parameters
+    ----------
+    jsonl_path : str, optional
+        File every record is appended to as soon as it is made
+    max_records : int
+        Number of latest records kept in memory for `export_jsonl`,
+        the Prometheus aggregates cover all records
+    """
+    def __init__(self, jsonl_path=None, max_records=100000):
+        self.jsonl_path = jsonl_path
+        self.records = deque(maxlen=max_records)
+        self._calls = {}
+        self._stages = {}
+        self._story_totals = {}
+        self._parses = {}
+        self._lock = threading.Lock()
+
+    def _append(self, record):
+        self.records.append(record)
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, 'a') as fp:
+                fp.write(json.dumps(record) + '\n')
+
+    def record_call(self, record):
+        record = {'type': 'call', **record}
+        stage = record['stage'] or ''
+        with self._lock:
+            self._append(record)
+            agg = self._calls.setdefault(stage, {
+                'calls': 0, 'cache_hits': 0, 'failures': 0,
+                'wall_time': 0.0, 'queue_time': 0.0,
+                'ttft': 0.0, 'ttft_count': 0,
+                'prompt_tokens': 0, 'completion_tokens': 0,
+                'retries': 0, 'requeries': 0, 'early_stops': 0,
+                'buckets': [0] * len(CALL_SECONDS_BUCKETS)})
+            agg['calls'] += 1
+            agg['cache_hits'] += record['cache_hit']
+            agg['failures'] += not record['ok']
+            agg['wall_time'] += record['wall_time']
+            agg['queue_time'] += record['queue_time']
+            if record['ttft'] is not None:
+                agg['ttft'] += record['ttft']
+                agg['ttft_count'] += 1
+            agg['prompt_tokens'] += record['prompt_tokens']
+            agg['completion_tokens'] += record['completion_tokens']
+            agg['retries'] += record['retries']
+            agg['requeries'] += record['requery']
+            agg['early_stops'] += record.get('early_stop') is not None
+            for idx, bound in enumerate(CALL_SECONDS_BUCKETS):
+                if record['wall_time'] <= bound:
+                    agg['buckets'][idx] += 1
+
+            totals = self._story_totals.setdefault(
+                record['story_id'], dict.fromkeys(_STAGE_SUMS, 0))
+            totals['calls'] += 1
+            totals['cache_hits'] += record['cache_hit']
+            totals['prompt_tokens'] += record['prompt_tokens']
+            totals['completion_tokens'] += record['completion_tokens']
+            totals['retries'] += record['retries']
+            totals['requeries'] += record['requery']
+
+    def story_totals(self, story_id):
+        with self._lock:
+            return dict(self._story_totals.get(
+                story_id, dict.fromkeys(_STAGE_SUMS, 0)))
+
+    def record_stage(self, record):
+        record = {'type': 'stage', **record}
+        with self._lock:
+            self._append(record)
+            agg = self._stages.setdefault(
+                record['stage'], {'count': 0, 'wall_time': 0.0, 'resumed': 0})
+            agg['count'] += 1
+            agg['wall_time'] += record['wall_time']
+            agg['resumed'] += record['resumed']
+
+    def record_parse(self, record):
+        record = {'type': 'parse', **record}
+        with self._lock:
+            self._append(record)
+            agg = self._parses.setdefault(
+                (record['stage'] or '', record['parser']),
+                {'parses': 0, 'failures': 0})
+            agg['parses'] += 1
+            agg['failures'] += not record['ok']
+
+    @contextlib.contextmanager
+    def track_stage(self, story_id, stage, resumed=False):
+        """Records a stage with the totals of the calls made during it
+
+        Stages of one story are expected to run one after another, calls
+        of the story made while the stage runs are attributed to it.
+        """
+        before = self.story_totals(story_id)
+        start_time = time.time()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            after = self.story_totals(story_id)
+            self.record_stage({
+                'story_id': story_id, 'stage': stage, 'start': start_time,
+                'wall_time': time.monotonic() - start,
+                **{key: after[key] - before[key] for key in _STAGE_SUMS},
+                'resumed': resumed})
+
+    def export_jsonl(self, fpath):
+        """Writes the records kept in memory to a JSONL file"""
+        with self._lock:
+            records = list(self.records)
+        with open(fpath, 'w') as fp:
+            for record in records:
+                fp.write(json.dumps(record) + '\n')
+
+    def prometheus(self):
+        """Aggregates in the Prometheus text exposition format
+
+        Returns
+        -------
+        str
+            Snapshot of counters, summaries and the call latency histogram
+        """
+        with self._lock:
+            calls = {stage: dict(agg) for stage, agg in self._calls.items()}
+            stages = {stage: dict(agg)
+                      for stage, agg in self._stages.items()}
+            parses = {key: dict(agg) for key, agg in self._parses.items()}
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{value}"'
+                                      for key, value in labels.items())
+                lines.append(f"{name}{suffix}{{{label_text}}} {value}")
+
+        def per_stage(key):
+            return [('', {'stage': stage}, agg[key])
+                    for stage, agg in sorted(calls.items())]
+
+        metric('goat_calls_total', 'counter', 'Chat calls',
+               per_stage('calls'))
+        metric('goat_cache_hits_total', 'counter',
+               'Chat calls answered from the response cache',
+               per_stage('cache_hits'))
+        metric('goat_call_failures_total', 'counter',
+               'Chat calls that returned no text', per_stage('failures'))
+        metric('goat_retries_total', 'counter', 'Backend request retries',
+               per_stage('retries'))
+        metric('goat_requeries_total', 'counter',
+               'Re-queries after a response failed to parse',
+               per_stage('requeries'))
+        metric('goat_early_stops_total', 'counter',
+               'Generations stopped early by a stop string or validator',
+               per_stage('early_stops'))
+        metric('goat_prompt_tokens_total', 'counter', 'Prompt tokens',
+               per_stage('prompt_tokens'))
+        metric('goat_completion_tokens_total', 'counter',
+               'Generated tokens', per_stage('completion_tokens'))
+
+        samples = []
+        for stage, agg in sorted(calls.items()):
+            for bound, count in zip(CALL_SECONDS_BUCKETS, agg['buckets']):
+                samples.append(
+                    ('_bucket', {'stage': stage, 'le': bound}, count))
+            samples.append(('_bucket', {'stage': stage, 'le': '+Inf'},
+                            agg['calls']))
+            samples.append(('_sum', {'stage': stage}, agg['wall_time']))
+            samples.append(('_count', {'stage': stage}, agg['calls']))
+        metric('goat_call_seconds', 'histogram',
+               'Wall time of chat calls', samples)
+
+        metric('goat_queue_seconds', 'summary',
+               'Time chat calls waited for a request slot',
+               [sample for stage, agg in sorted(calls.items())
+                for sample in (('_sum', {'stage': stage}, agg['queue_time']),
+                               ('_count', {'stage': stage}, agg['calls']))])
+        metric('goat_ttft_seconds', 'summary', 'Time to first token',
+               [sample for stage, agg in sorted(calls.items())
+                for sample in (('_sum', {'stage': stage}, agg['ttft']),
+                               ('_count', {'stage': stage},
+                                agg['ttft_count']))])
+        metric('goat_stage_seconds', 'summary', 'Wall time of pipeline stages',
+               [sample for stage, agg in sorted(stages.items())
+                for sample in (('_sum', {'stage': stage}, agg['wall_time']),
+                               ('_count', {'stage': stage}, agg['count']))])
+        metric('goat_stages_resumed_total', 'counter',
+               'Stages loaded from a checkpoint',
+               [('', {'stage': stage}, agg['resumed'])
+                for stage, agg in sorted(stages.items())])
+        metric('goat_parses_total', 'counter', 'Parsed model answers',
+               [('', {'stage': stage, 'parser': parser}, agg['parses'])
+                for (stage, parser), agg in sorted(parses.items())])
+        metric('goat_parse_failures_total', 'counter',
+               'Model answers that did not parse into a usable value',
+               [('', {'stage': stage, 'parser': parser}, agg['failures'])
+                for (stage, parser), agg in sorted(parses.items())])
+        return '\n'.join(lines) + '\n'
+
+
+class AgentLogger:
+    """Receives the progress output of backend calls, silent as is"""
+    def prompt(self, prompt):
+        pass
+
+    def delta(self, text, first):
+        pass
+
+    def response(self, call_stats):
+        pass
+
+    def error(self, message, exc_info=False):
+        pass
+
+
+class ConsoleLogger(AgentLogger):
+    """Prints prompts and streams generated text to stdout"""
+    def prompt(self, prompt):
+        print(f"\n\n========== Submitting prompt: >>\n{prompt}", end="")
+        sys.stdout.flush()
+
+    def delta(self, text, first):
+        if first:
+            print("<<|", end="")
+        print(text, end="")
+        sys.stdout.flush()
+
+    def response(self, call_stats):
+        print("\nDone reading response.")
+        if 'prompt_tokens_processed' in call_stats:
+            print(f"Prompt tokens: {call_stats['prompt_tokens']}, "
+                  f"processed: {call_stats['prompt_tokens_processed']}, "
+                  f"reused: {call_stats['prompt_tokens_reused']}")
+
+    def error(self, message, exc_info=False):
+        if exc_info:
+            traceback.print_exc()
+        print(message)
+
+
+class LoggingLogger(AgentLogger):
+    """Sends prompts and responses to a `logging` logger at DEBUG level
+
+    Generated text is not logged token by token, errors are warnings.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger('goat_storytelling_agent')
+
+    def prompt(self, prompt):
+        self.logger.debug("Submitting prompt: %s", prompt)
+
+    def response(self, call_stats):
+        self.logger.debug("Done reading response: %s", call_stats)
+
+    def error(self, message, exc_info=False):
+        self.logger.warning(message, exc_info=exc_info)
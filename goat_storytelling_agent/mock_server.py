@@ -0,0 +1,562 @@
+"""Local stand-in for the TGI, llama.cpp and OpenAI-compatible servers.
+
+Serves TGI `/generate` and `/generate_stream`, llama.cpp `/tokenize`
+and `/completion` (with SSE streaming and prompt cache statistics) and
+the OpenAI `/v1/completions` with batched prompts, so the pipeline can be
+run and benchmarked without a model. Replies are canned
+by prompt type and shaped so that the `Plan` and scene parsers accept
+them; the same prompt and seed always give the same reply. Streams end at
+the `stop` strings of a request and when the client disconnects. Requests
+with a JSON schema (llama.cpp `json_schema`, TGI `grammar`, OpenAI
+`response_format`) get canned JSON of the shape the schema asks for.
+
+Usage: python -m goat_storytelling_agent.mock_server --port 8080
+"""
+import re
+import sys
+import json
+import time
+import random
+import zlib
+import argparse
+import threading
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+SPEC_VALUES = {
+    'Genre': 'Adventure thriller',
+    'Place': 'A rain forest in the Amazon basin',
+    'Time': 'Present day, rainy season',
+    'Theme': 'Greed, trust and survival',
+    'Tone': 'Tense and realistic',
+    'Point of View': 'Third person limited',
+    'Characters': 'Helen Ward, a cartographer; Ignacio Ruiz, a river guide',
+    'Premise': 'Helen finds an old map and hires Ignacio to find the '
+               'lost expedition camp before a mining company does',
+}
+WORDS = ("the river map camp rain night trail boat Helen Ignacio forest "
+         "shadow fire water stone path light voice hand mud jungle old "
+         "slowly quietly said looked turned waited listened walked found "
+         "and but then while before after under over into across").split()
+
+
+class MockBackend:
+    """Threaded mock server speaking the TGI, llama.cpp and OpenAI APIs
+
+    Parameters
+    ----------
+    host, port : str, int
+        Address to listen on, port 0 picks a free one
+    latency : float
+        Seconds before the first byte of every response
+    tokens_per_second : float, optional
+        Generation speed, responses are not paced if None. The prompts of
+        a batched request advance together, one token each per step.
+    error_rate : float
+        Share of requests failed with HTTP 503
+    stream_error_rate : float
+        Share of streamed completions broken midway by an error event
+    chapters_per_act, scenes_per_chapter, scene_words : int
+        Size of the canned outlines and scenes
+    overrun_words : int
+        If set, scenes run on into the next scene for that many words and
+        scene breakdowns into a chapter of the next act, as models do
+    malformed_rate : float
+        Share of free-text specs, outlines and scene breakdowns that lose
+        their colons and no longer parse, answers under a schema never do
+    slots : int, optional
+        Requests generated at once, as the slots of a llama.cpp server.
+        Further requests queue for a free slot before their first byte
+    seed : int
+        Seed of the error injection
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 tokens_per_second=None, error_rate=0.0,
+                 stream_error_rate=0.0, chapters_per_act=3,
+                 scenes_per_chapter=2, scene_words=300, overrun_words=0,
+                 malformed_rate=0.0, slots=None, seed=0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.stream_error_rate = stream_error_rate
+        self.chapters_per_act = chapters_per_act
+        self.scenes_per_chapter = scenes_per_chapter
+        self.scene_words = scene_words
+        self.overrun_words = overrun_words
+        self.malformed_rate = malformed_rate
+        self.slots = slots
+        self._busy = threading.BoundedSemaphore(slots) if slots else None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._vocab = {}
+        self._words = []
+        self._slots = {}
+        self._stats = {'requests': 0, 'errors': 0, 'stream_errors': 0,
+                       'cancelled': 0, 'completion_tokens': 0,
+                       'batches': 0, 'batched_prompts': 0, 'malformed': 0,
+                       'queued': 0}
+        handler = type('Handler', (_Handler,), {'backend': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _draw(self, rate):
+        if not rate:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def tokenize(self, text):
+        """Word and whitespace pieces as token ids, reversible"""
+        pieces = re.findall(r'\s+|\S+', text)
+        with self._lock:
+            for piece in pieces:
+                if piece not in self._vocab:
+                    self._vocab[piece] = len(self._words) + 2
+                    self._words.append(piece)
+            return [self._vocab[piece] for piece in pieces]
+
+    def detokenize(self, tokens):
+        with self._lock:
+            return ''.join(self._words[token - 2] for token in tokens
+                           if 2 <= token < len(self._words) + 2)
+
+    def prompt_stats(self, tokens, slot, cache_prompt):
+        """Prompt tokens evaluated and processed with a per-slot cache"""
+        with self._lock:
+            previous = self._slots.get(slot, []) if cache_prompt else []
+            self._slots[slot] = tokens
+        n_common = 0
+        for cached, token in zip(previous, tokens):
+            if cached != token:
+                break
+            n_common += 1
+        return len(tokens), len(tokens) - n_common
+
+    def reply(self, prompt, schema=None):
+        """Canned completion for a prompt of the storytelling pipeline"""
+        if schema is not None:
+            return self.structured_reply(prompt, schema)
+        text = self._planning_reply(prompt.rpartition('### USER:')[2])
+        if text is None:
+            return self._scene(prompt)
+        if self._draw(self.malformed_rate):
+            self._count('malformed')
+            text = text.replace(':', ' -')
+        return text
+
+    def structured_reply(self, prompt, schema):
+        """Canned JSON answer of the shape the schema asks for"""
+        request = prompt.rpartition('### USER:')[2]
+        keys = list(schema.get('properties', {}))
+        if keys == ['acts']:
+            return json.dumps({'acts': [
+                self._act_json(act_num,
+                               1 + (act_num - 1) * self.chapters_per_act)
+                for act_num in range(1, 4)]})
+        if 'chapters' in keys:
+            act = re.search(r'Take Act (\d+)', request)
+            act_num = int(act.group(1)) if act else 1
+            return json.dumps(self._act_json(act_num, 1))
+        if keys and all(key.startswith('Chapter ') for key in keys):
+            return json.dumps({
+                key: [self._scene_fields(sc_num, key.split()[-1])
+                      for sc_num in range(1, self.scenes_per_chapter + 1)]
+                for key in keys})
+        return json.dumps({key: SPEC_VALUES.get(key, 'unknown')
+                           for key in keys})
+
+    def _planning_reply(self, request):
+        """Spec, outline or scene breakdown text, None for a scene"""
+        field = re.search(r'fill the missing field: (.+?)\.', request)
+        if field:
+            name = field.group(1).strip()
+            return f"{name}: {SPEC_VALUES.get(name, 'unknown')}"
+        if 'specification to write' in request or 'more detailed' in request:
+            return '\n'.join(f"{key}: {value}"
+                             for key, value in SPEC_VALUES.items())
+        act = re.search(r'Take Act (\d+)', request)
+        if act:
+            return self._act(int(act.group(1)), 1)
+        if 'Come up with a plot' in request:
+            ch_num = 1
+            acts = []
+            for act_num in range(1, 4):
+                acts.append(self._act(act_num, ch_num))
+                ch_num += self.chapters_per_act
+            return "Acts\n\n" + '\n\n'.join(acts)
+        if 'Break each chapter' in request:
+            summary = request.partition('by-chapter plot summary')[2]
+            ch_nums = [int(ch_num) for ch_num
+                       in re.findall(r'- Chapter (\d+):', summary)]
+            if ch_nums and self.overrun_words:
+                ch_nums.append(ch_nums[-1] + 1)
+            return '\n\n'.join(self._chapter_scenes(ch_num)
+                               for ch_num in ch_nums)
+        return None
+
+    def _scene(self, prompt):
+        request = prompt.rpartition('### USER:')[2]
+        text = self._prose(prompt, self.scene_words)
+        scene = re.search(r'scene (\d+) in chapter (\d+)', request)
+        if scene and self.overrun_words:
+            sc_num, ch_num = int(scene.group(1)), int(scene.group(2))
+            text += (f"\n\nChapter {ch_num}, Scene {sc_num + 1}\n\n"
+                     + self._prose(text, self.overrun_words))
+        return text
+
+    def _chapter_outlines(self, first_ch_num):
+        return [f"Helen and Ignacio face trouble number {ch_num} on the "
+                f"river, {'positive' if ch_num % 2 else 'negative'} charge"
+                for ch_num in range(first_ch_num,
+                                    first_ch_num + self.chapters_per_act)]
+
+    def _act(self, act_num, first_ch_num):
+        chapters = [f"- Chapter {ch_num}: {outline}"
+                    for ch_num, outline in enumerate(
+                        self._chapter_outlines(first_ch_num),
+                        start=first_ch_num)]
+        return f"Act {act_num}: The expedition, part {act_num}\n" + \
+            '\n'.join(chapters)
+
+    def _act_json(self, act_num, first_ch_num):
+        return {'description': f"The expedition, part {act_num}",
+                'chapters': self._chapter_outlines(first_ch_num)}
+
+    def _scene_fields(self, sc_num, ch_num):
+        return {'Characters': 'Helen, Ignacio',
+                'Place': f'river bank number {sc_num}', 'Time': 'evening',
+                'Event': f'they argue about the map in chapter {ch_num}',
+                'Conflict': 'trust', 'Story value': 'hope',
+                'Story value charge': 'positive', 'Mood': 'tense',
+                'Outcome': 'they keep going'}
+
+    def _chapter_scenes(self, ch_num):
+        scenes = [f"Scene {sc_num}:\n" + '\n'.join(
+            f"{key}: {value}"
+            for key, value in self._scene_fields(sc_num, ch_num).items())
+            for sc_num in range(1, self.scenes_per_chapter + 1)]
+        return f"Chapter {ch_num}:\n" + '\n'.join(scenes)
+
+    def _prose(self, prompt, n_words):
+        rng = random.Random(zlib.crc32(prompt.encode()))
+        sentences = []
+        n_left = n_words
+        while n_left > 0:
+            length = min(n_left, rng.randint(6, 16))
+            words = [rng.choice(WORDS) for _ in range(length)]
+            sentences.append(' '.join(words).capitalize() + '.')
+            n_left -= length
+        paragraphs = [' '.join(sentences[idx:idx + 5])
+                      for idx in range(0, len(sentences), 5)]
+        return '\n\n'.join(paragraphs)
+
+    def completion_pieces(self, prompt, max_tokens, stop=(), schema=None):
+        text = self.reply(prompt, schema)
+        ends = [idx for idx in (text.find(string) for string in stop or ()
+                                if string) if idx >= 0]
+        if ends:
+            text = text[:min(ends)]
+        pieces = re.findall(r'\s*\S+', text)
+        if max_tokens is not None and max_tokens >= 0:
+            pieces = pieces[:max_tokens]
+        return pieces
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Holds a generation slot, waiting for one if all are busy"""
+        if self._busy is None:
+            yield
+            return
+        if not self._busy.acquire(blocking=False):
+            self._count('queued')
+            self._busy.acquire()
+        try:
+            yield
+        finally:
+            self._busy.release()
+
+    def pace(self, n_tokens):
+        if self.tokens_per_second:
+            time.sleep(n_tokens / self.tokens_per_second)
+
+
+def _grammar_schema(parameters):
+    """JSON schema of a TGI grammar parameter, None if there is none"""
+    grammar = parameters.get('grammar') or {}
+    return grammar.get('value') if grammar.get('type') == 'json' else None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    backend = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type='application/json', status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+    def _event(self, prefix, payload):
+        self.wfile.write(prefix + json.dumps(payload).encode() + b'\n\n')
+        self.wfile.flush()
+
+    def _stream(self, pieces, break_at, send_piece, send_error, send_end,
+                n_tokens=None):
+        """Sends pieces until the end, the injected error or a disconnect
+
+        A piece is one token unless n_tokens counts them, e.g. for the
+        steps of a batch.
+        """
+        backend = self.backend
+        self._start_stream()
+        n_sent = 0
+        try:
+            for idx, piece in enumerate(pieces):
+                if idx == break_at:
+                    backend._count('stream_errors')
+                    send_error()
+                    return
+                backend.pace(1)
+                send_piece(piece)
+                n_sent += n_tokens(piece) if n_tokens is not None else 1
+            send_end()
+        except (BrokenPipeError, ConnectionResetError):
+            backend._count('cancelled')
+        finally:
+            backend._count('completion_tokens', n_sent)
+
+    def do_POST(self):
+        backend = self.backend
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        backend._count('requests')
+        time.sleep(backend.latency)
+        if backend._draw(backend.error_rate):
+            backend._count('errors')
+            self._send(b'{"error": "injected"}', status=503)
+            return
+        handlers = {'/tokenize': self.tokenize,
+                    '/completion': self.completion,
+                    '/generate': self.generate,
+                    '/generate_stream': self.generate_stream,
+                    '/v1/completions': self.completions}
+        handler = handlers.get(self.path.rstrip('/'))
+        if handler is None:
+            self._send(b'{"error": "not found"}', status=404)
+            return
+        if handler == self.tokenize:
+            handler(body)
+            return
+        with backend.slot():
+            handler(body)
+
+    def tokenize(self, body):
+        tokens = self.backend.tokenize(body.get('content', ''))
+        self._send(json.dumps({'tokens': tokens}).encode())
+
+    def completion(self, body):
+        backend = self.backend
+        prompt = body.get('prompt', '')
+        if isinstance(prompt, list):
+            # token ids with a leading BOS
+            tokens = prompt[1:]
+            prompt = backend.detokenize(tokens)
+        else:
+            tokens = backend.tokenize(prompt)
+        n_evaluated, n_processed = backend.prompt_stats(
+            tokens, body.get('id_slot'), body.get('cache_prompt', False))
+        pieces = backend.completion_pieces(
+            prompt, body.get('n_predict'), body.get('stop'),
+            body.get('json_schema'))
+        break_at = (len(pieces) // 2
+                    if backend._draw(backend.stream_error_rate) else None)
+        if not body.get('stream'):
+            backend.pace(len(pieces))
+            backend._count('completion_tokens', len(pieces))
+            self._send(json.dumps({
+                'content': ''.join(pieces), 'stop': True,
+                'tokens_evaluated': n_evaluated,
+                'timings': {'prompt_n': n_processed,
+                            'predicted_n': len(pieces)}}).encode())
+            return
+
+        def send_error():
+            self.wfile.write(b'error: {"content": "injected"}\n\n')
+            self.wfile.flush()
+
+        self._stream(
+            pieces, break_at, send_error=send_error,
+            send_piece=lambda piece: self._event(
+                b'data: ', {'content': piece, 'stop': False}),
+            send_end=lambda: self._event(b'data: ', {
+                'content': '', 'stop': True, 'tokens_evaluated': n_evaluated,
+                'tokens_predicted': len(pieces),
+                'timings': {'prompt_n': n_processed,
+                            'predicted_n': len(pieces)}}))
+
+    def completions(self, body):
+        """OpenAI /v1/completions, prompt is a string or a list of them
+
+        Streamed choices of all prompts are interleaved, one event per
+        choice and step, and a finish_reason event ends each of them.
+        """
+        backend = self.backend
+        prompts = body.get('prompt', '')
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        backend._count('batches')
+        backend._count('batched_prompts', len(prompts))
+        max_tokens = body.get('max_tokens', 16)
+        schema = ((body.get('response_format') or {}).get('json_schema')
+                  or {}).get('schema')
+        completions = [
+            backend.completion_pieces(prompt, max_tokens, body.get('stop'),
+                                      schema)
+            for prompt in prompts]
+        reasons = ['length' if len(pieces) == max_tokens else 'stop'
+                   for pieces in completions]
+        n_steps = max(map(len, completions), default=0)
+        if not body.get('stream'):
+            n_tokens = sum(map(len, completions))
+            backend.pace(n_steps)
+            backend._count('completion_tokens', n_tokens)
+            self._send(json.dumps({
+                'object': 'text_completion',
+                'choices': [{'index': idx, 'text': ''.join(pieces),
+                             'finish_reason': reason}
+                            for idx, (pieces, reason)
+                            in enumerate(zip(completions, reasons))],
+                'usage': {'completion_tokens': n_tokens}}).encode())
+            return
+
+        steps = []
+        for step in range(n_steps + 1):
+            steps.append([
+                {'index': idx, 'text': pieces[step], 'finish_reason': None}
+                if step < len(pieces) else
+                {'index': idx, 'text': '', 'finish_reason': reasons[idx]}
+                for idx, pieces in enumerate(completions)
+                if step <= len(pieces)])
+        break_at = (n_steps // 2
+                    if backend._draw(backend.stream_error_rate) else None)
+
+        def send_step(choices):
+            for choice in choices:
+                self._event(b'data: ', {'object': 'text_completion',
+                                        'choices': [choice]})
+
+        def send_end():
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+
+        self._stream(
+            steps, break_at, send_piece=send_step, send_end=send_end,
+            send_error=lambda: self._event(
+                b'data: ', {'error': {'message': 'injected'}}),
+            n_tokens=lambda choices: sum(
+                1 for choice in choices if choice['text']))
+
+    def generate(self, body):
+        backend = self.backend
+        parameters = body.get('parameters') or {}
+        pieces = backend.completion_pieces(
+            body.get('inputs', ''), parameters.get('max_new_tokens'),
+            parameters.get('stop'), _grammar_schema(parameters))
+        backend.pace(len(pieces))
+        backend._count('completion_tokens', len(pieces))
+        self._send(json.dumps({'generated_text': ''.join(pieces)}).encode())
+
+    def generate_stream(self, body):
+        backend = self.backend
+        parameters = body.get('parameters') or {}
+        pieces = backend.completion_pieces(
+            body.get('inputs', ''), parameters.get('max_new_tokens'),
+            parameters.get('stop'), _grammar_schema(parameters))
+        break_at = (len(pieces) // 2
+                    if backend._draw(backend.stream_error_rate) else None)
+        self._stream(
+            pieces, break_at,
+            send_error=lambda: self._event(b'data:', {'error': 'injected'}),
+            send_piece=lambda piece: self._event(
+                b'data:', {'token': {'text': piece, 'special': False}}),
+            send_end=lambda: self._event(
+                b'data:', {'token': {'text': '</s>', 'special': True},
+                           'generated_text': ''.join(pieces)}))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Mock TGI, llama.cpp and OpenAI-compatible server "
+                    "with canned replies")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--tokens-per-second', type=float, default=None)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--stream-error-rate', type=float, default=0.0)
+    parser.add_argument('--scene-words', type=int, default=300)
+    parser.add_argument('--overrun-words', type=int, default=0)
+    parser.add_argument('--malformed-rate', type=float, default=0.0)
+    parser.add_argument('--slots', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    backend = MockBackend(
+        args.host, args.port, latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        stream_error_rate=args.stream_error_rate,
+        scene_words=args.scene_words, overrun_words=args.overrun_words,
+        malformed_rate=args.malformed_rate, slots=args.slots,
+        seed=args.seed)
+    print(f"Serving mock backend on {backend.url}")
+    try:
+        backend.server.serve_forever()
+    except KeyboardInterrupt:
+        backend.server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
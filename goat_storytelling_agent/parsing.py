@@ -0,0 +1,378 @@
+"""Single-pass parsers of model answers with parse diagnostics.
+
+Each parser scans an answer once with precompiled patterns and returns a
+`ParseResult`: the parsed value, whether it is usable and the issues met
+on the way, e.g. why an outline did not split into three acts. `Plan`
+and `StoryAgent` wrap them and return only the values. The parse_json_*
+parsers read the answers of structured mode, see `structured`, into the
+same values.
+"""
+import re
+import json
+from dataclasses import dataclass, field
+from typing import Any, List
+
+
+# a line starting with an act heading or, if not, a chapter heading
+_PLAN_HEADING = re.compile(r'\n(?:.{0,5}?(Act )|.{0,20}?Chapter .+:)')
+_CHAPTER_HEADING = re.compile(r'\n.{0,20}?Chapter .+:')
+# scanned separately, as alternatives lose the fast literal prefix search,
+# a scene heading does not run over a chapter heading
+_CHAPTER_NUMBER = re.compile(r'Chapter (\d+)')
+_SCENE_HEADING = re.compile(r'Scene \d+(?:(?!Chapter \d).){0,10}?:')
+
+
+@dataclass
+class ParseResult:
+    """Parsed value, ok=False if it is not usable, and the issues met"""
+    value: Any
+    ok: bool
+    issues: List[str] = field(default_factory=list)
+
+
+def _has_more_words(text, n):
+    # splits at most n+1 words off instead of the whole text
+    return len(text.split(None, n)) > n
+
+
+def _act_dict(text, start, end, marks, prefix=''):
+    """Act from text[start:end] split at the chapter heading matches"""
+    descr_end = marks[0].start() if marks else end
+    chapters = []
+    for idx, mark in enumerate(marks):
+        ch_end = marks[idx + 1].start() if idx + 1 < len(marks) else end
+        chapter = text[mark.end():ch_end].strip()
+        if _has_more_words(chapter, 3):
+            chapters.append(chapter)
+    return {'act_descr': (prefix + text[start:descr_end]).strip(),
+            'chapters': chapters}
+
+
+def parse_act(act):
+    """Splits an act outline into its description and chapters"""
+    act = act.strip()
+    marks = list(_CHAPTER_HEADING.finditer(act))
+    act_dict = _act_dict(act, 0, len(act), marks)
+    issues = [] if act_dict['chapters'] else ['no chapters']
+    return ParseResult(act_dict, bool(act_dict['chapters']), issues)
+
+
+def _act_prefixes(first_act):
+    # every act but one already starting with it gets its heading back
+    if first_act.startswith('Act '):
+        return ['', 'Act ', 'Act ']
+    return ['Act ', 'Act ', 'Act ']
+
+
+def _scan_acts(text):
+    """Act sections of an outline split at act heading lines
+
+    Returns
+    -------
+    List[Tuple[int, int]]
+        Stripped (start, end) of the sections with more than 3 words
+    List[re.Match]
+        Chapter heading matches
+    """
+    bounds = []
+    marks = []
+    for match in _PLAN_HEADING.finditer(text):
+        if match.group(1):
+            bounds.append(match)
+        else:
+            marks.append(match)
+    sections = []
+    start = 0
+    for end, next_start in ([(m.start(), m.end()) for m in bounds]
+                            + [(len(text), None)]):
+        section = text[start:end]
+        stripped = section.strip()
+        if stripped and _has_more_words(stripped, 3):
+            lead = len(section) - len(section.lstrip())
+            sections.append((start + lead, start + lead + len(stripped)))
+        start = next_start
+    return sections, marks
+
+
+def _split_any_act(text, issues):
+    """Fallback split at every 'Act ', None if it is not three acts"""
+    acts = text.split('Act ')
+    if len(acts) == 4:
+        acts = acts[-3:]
+    elif len(acts) != 3:
+        issues.append(f"{len(acts) - 1} 'Act ' occurrences, expected 3")
+        return None
+    return [prefix + act for prefix, act in zip(_act_prefixes(acts[0]), acts)]
+
+
+def split_acts(text_plan):
+    """Splits an outline into three act texts starting with 'Act '"""
+    issues = []
+    sections, _ = _scan_acts(text_plan)
+    if len(sections) == 4:
+        sections = sections[1:]
+    if len(sections) == 3:
+        texts = [text_plan[start:end] for start, end in sections]
+        acts = [prefix + act
+                for prefix, act in zip(_act_prefixes(texts[0]), texts)]
+        return ParseResult(acts, True, issues)
+    issues.append(f"{len(sections)} act sections at line starts, expected 3")
+    acts = _split_any_act(text_plan, issues)
+    return ParseResult(acts or [], acts is not None, issues)
+
+
+def parse_text_plan(text_plan):
+    """Parses a by-chapter outline into a list of act dicts
+
+    Act and chapter headings are found in one scan of the outline, acts
+    without chapters are dropped.
+    """
+    issues = []
+    sections, marks = _scan_acts(text_plan)
+    if len(sections) == 4:
+        sections = sections[1:]
+    if len(sections) == 3:
+        prefixes = _act_prefixes(
+            text_plan[sections[0][0]:sections[0][1]])
+        acts = []
+        idx = 0
+        for prefix, (start, end) in zip(prefixes, sections):
+            while idx < len(marks) and marks[idx].start() < start:
+                idx += 1
+            act_marks = []
+            while idx < len(marks) and marks[idx].start() < end:
+                act_marks.append(marks[idx])
+                idx += 1
+            acts.append(_act_dict(text_plan, start, end, act_marks, prefix))
+    else:
+        issues.append(
+            f"{len(sections)} act sections at line starts, expected 3")
+        texts = _split_any_act(text_plan, issues)
+        if texts is None:
+            return ParseResult([], False, issues)
+        acts = [parse_act(text).value for text in texts if text]
+
+    plan = []
+    for act_num, act in enumerate(acts, start=1):
+        if act['chapters']:
+            plan.append(act)
+        else:
+            issues.append(f"act {act_num} has no chapters")
+    return ParseResult(plan, bool(plan), issues)
+
+
+class BookSpecParser:
+    """Parses the 'Field: value' lines of a book specification
+
+    A line sets the field whose lowercased name is in the text before the
+    colon, if that text is less than twice as long as the name and no
+    other field matches. Lines without a colon continue the last field.
+    The matches of the field names themselves are precomputed and other
+    keys are memoized.
+
+    Parameters
+    ----------
+    fields : List[str]
+        Field names in spec order
+    max_memo_entries : int
+        Keys other than field names remembered
+    """
+    def __init__(self, fields, max_memo_entries=1024):
+        self.fields = list(fields)
+        self._keys = [(field, field.lower().strip(), len(field.strip()))
+                      for field in self.fields]
+        # no field can match a key at least this long
+        self._max_key_len = 2 * max(
+            (key_len for _, _, key_len in self._keys), default=0)
+        self._index = {key: self._match(key) for _, key, _ in self._keys}
+        self._max_index_entries = len(self._index) + max_memo_entries
+
+    def _match(self, pseudokey):
+        matched = [field for field, key, key_len in self._keys
+                   if key in pseudokey and len(pseudokey) < 2 * key_len]
+        return matched[0] if len(matched) == 1 else None
+
+    def field_of(self, pseudokey):
+        """Field set by a lowercased, stripped key, None if no single one"""
+        try:
+            return self._index[pseudokey]
+        except KeyError:
+            pass
+        if len(pseudokey) >= self._max_key_len:
+            return None
+        field = self._match(pseudokey)
+        if len(self._index) < self._max_index_entries:
+            self._index[pseudokey] = field
+        return field
+
+    def parse(self, text_spec):
+        spec_dict = dict.fromkeys(self.fields, '')
+        if '"""' in text_spec[:len(text_spec) // 2]:
+            text_spec = text_spec.partition('"""')[2]
+        last_field = None
+        for line in text_spec.strip().split('\n'):
+            pseudokey, sep, value = line.partition(':')
+            if sep:
+                # unknown keys end the last field, their lines are dropped
+                last_field = self.field_of(pseudokey.lower().strip())
+                if last_field is not None:
+                    spec_dict[last_field] += value.strip()
+            elif last_field is not None:
+                spec_dict[last_field] += ' ' + line.strip()
+        issues = [f"missing field {field}"
+                  for field, value in spec_dict.items() if not value]
+        return ParseResult(spec_dict, not issues, issues)
+
+
+def parse_act_scenes(act_scenes, act_chapters):
+    """Splits a by-scene breakdown of an act into {chapter: [scenes]}
+
+    Text is attributed to the last scene heading of the last chapter
+    heading before it, so a chapter heading repeated on every scene
+    ('Chapter 3, Scene 2:') keeps all scenes of the chapter. Text between
+    a chapter heading and the scene heading after it belongs to no scene.
+    If more chapters are found than the act has, only act_chapters are
+    kept.
+    """
+    issues = []
+    text = act_scenes.strip()
+    chapters = {}
+    scenes = None
+    pos = 0
+    after_chapter = False
+    headings = sorted([*_CHAPTER_NUMBER.finditer(text),
+                       *_SCENE_HEADING.finditer(text)], key=re.Match.start)
+    for match in headings:
+        is_chapter = match.re is _CHAPTER_NUMBER
+        if scenes and (is_chapter or not after_chapter):
+            scenes[-1].append(text[pos:match.start()])
+        after_chapter = is_chapter
+        if is_chapter:
+            scenes = chapters.setdefault(int(match.group(1)), [])
+        elif scenes is not None:
+            scenes.append([])
+        pos = match.end()
+    if scenes:
+        scenes[-1].append(text[pos:])
+    if not chapters:
+        issues.append("no chapter headings")
+
+    ch_nums = list(chapters)
+    if len(ch_nums) > len(act_chapters):
+        issues.append(f"{len(ch_nums)} chapters, expected {act_chapters}")
+        ch_nums = [ch_num for ch_num in act_chapters if ch_num in chapters]
+    chapter_scenes = {}
+    for ch_num in ch_nums:
+        texts = [''.join(pieces).strip() for pieces in chapters[ch_num]]
+        texts = [text for text in texts if _has_more_words(text, 3)]
+        if texts:
+            chapter_scenes[ch_num] = texts
+        else:
+            issues.append(f"chapter {ch_num} has no scenes")
+    return ParseResult(chapter_scenes, bool(chapter_scenes), issues)
+
+
+def _load_json(text, issues):
+    """First JSON object in text, None if there is none"""
+    start = text.find('{')
+    if start < 0:
+        issues.append("no JSON object")
+        return None
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text, start)
+    except json.JSONDecodeError as exc:
+        issues.append(f"invalid JSON: {exc.msg} at {exc.pos}")
+        return None
+    return value
+
+
+def _json_text(value):
+    if value is None:
+        return ''
+    # servers ignoring the schema may nest values
+    return value.strip() if isinstance(value, str) else json.dumps(value)
+
+
+def _json_act(data):
+    if not isinstance(data, dict):
+        data = {}
+    chapters = data.get('chapters')
+    if not isinstance(chapters, list):
+        chapters = []
+    return {'act_descr': _json_text(data.get('description')),
+            'chapters': [chapter for chapter in map(_json_text, chapters)
+                         if chapter]}
+
+
+def parse_json_book_spec(text_spec, fields):
+    """Reads a book spec object into {field: value}"""
+    issues = []
+    data = _load_json(text_spec, issues) or {}
+    spec_dict = {field: _json_text(data.get(field)) for field in fields}
+    issues.extend(f"missing field {field}"
+                  for field, value in spec_dict.items() if not value)
+    return ParseResult(spec_dict, not issues, issues)
+
+
+def parse_json_act(act):
+    """Reads an act object into an act dict"""
+    issues = []
+    act_dict = _json_act(_load_json(act, issues) or {})
+    if not act_dict['chapters']:
+        issues.append("no chapters")
+    return ParseResult(act_dict, bool(act_dict['chapters']), issues)
+
+
+def parse_json_plan(text_plan):
+    """Reads an outline object into a list of act dicts"""
+    issues = []
+    acts = (_load_json(text_plan, issues) or {}).get('acts')
+    if not isinstance(acts, list) or len(acts) != 3:
+        issues.append(f"{len(acts) if isinstance(acts, list) else 0} acts, "
+                      "expected 3")
+        return ParseResult([], False, issues)
+    plan = []
+    for act_num, act in enumerate(acts, start=1):
+        act_dict = _json_act(act)
+        if act_dict['chapters']:
+            plan.append(act_dict)
+        else:
+            issues.append(f"act {act_num} has no chapters")
+    return ParseResult(plan, bool(plan), issues)
+
+
+def _scene_text(scene):
+    # the 'Field: value' lines of a scene spec in free text
+    if isinstance(scene, dict):
+        return '\n'.join(f"{key}: {_json_text(value)}"
+                         for key, value in scene.items()
+                         if _json_text(value))
+    return _json_text(scene)
+
+
+def parse_json_act_scenes(act_scenes, act_chapters):
+    """Reads a by-scene breakdown object into {chapter: [scenes]}
+
+    Scene specs are rendered as 'Field: value' lines, as they are written
+    in free text. Chapters outside act_chapters are dropped.
+    """
+    issues = []
+    data = _load_json(act_scenes, issues) or {}
+    chapters = {}
+    for key, scenes in data.items():
+        match = _CHAPTER_NUMBER.search(key)
+        ch_num = int(match.group(1)) if match else None
+        if ch_num not in act_chapters:
+            issues.append(f"chapter key {key!r} not in {act_chapters}")
+            continue
+        if not isinstance(scenes, list):
+            scenes = [scenes]
+        chapters[ch_num] = [text for text in map(_scene_text, scenes)
+                            if text]
+    chapter_scenes = {}
+    for ch_num in act_chapters:
+        if chapters.get(ch_num):
+            chapter_scenes[ch_num] = chapters[ch_num]
+        else:
+            issues.append(f"chapter {ch_num} has no scenes")
+    return ParseResult(chapter_scenes, bool(chapter_scenes), issues)
@@ -1,49 +1,354 @@
-"""Unifies all plot forms such as by-chapter and by-scene outlines in a single dict."""
+"""Unifies all plot forms such as by-chapter and by-scene outlines in a single model.
+
+A `Plan` holds `Act`s, an act holds `Chapter`s and a chapter its `Scene`
+specifications. Chapters are numbered through the whole plan whenever its
+structure changes, and the rendered text of every act and of the plan is
+cached until then. Acts can still be read and written as the dicts of
+earlier versions, with 'act_descr', 'chapters', 'act_scenes' and
+'chapter_scenes' keys, and plans are saved as a JSON list of such dicts.
+"""
 import re
 import json
 
+from goat_storytelling_agent import parsing
+
+
+_ACT_HEADING = re.compile(r'Act \d')
+# rendered variants of a plan kept, see SceneContext
+MAX_CACHED_TEXTS = 256
+
+
+class Scene:
+    __slots__ = ('number', 'spec')
+
+    def __init__(self, number, spec):
+        self.number = number
+        self.spec = spec
+
+    def __repr__(self):
+        return f'Scene({self.number!r}, {self.spec!r})'
+
+
+class Chapter:
+    """Chapter of an act
+
+    outline is None for a chapter only known from the by-scene breakdown,
+    e.g. when the model numbered the chapters of an act from 1. Such
+    chapters keep their number and are not rendered.
+    """
+    __slots__ = ('number', '_outline', 'scenes', '_act')
+
+    def __init__(self, number, outline, scenes=()):
+        self.number = number
+        self._outline = outline
+        self.scenes = [Scene(sc_num, spec)
+                       for sc_num, spec in enumerate(scenes, start=1)]
+        self._act = None
+
+    @property
+    def outline(self):
+        return self._outline
+
+    @outline.setter
+    def outline(self, outline):
+        self._outline = outline
+        if self._act is not None:
+            self._act._changed()
+
+    def __repr__(self):
+        return (f'Chapter({self.number!r}, {self._outline!r}, '
+                f'{[scene.spec for scene in self.scenes]!r})')
+
+
+class Act:
+    """Act of a plan, also readable and writable as a dict
+
+    Parameters
+    ----------
+    descr : str
+        Act description
+    chapters : List[str]
+        Chapter outlines
+    scenes_text : str, optional
+        Raw by-scene breakdown of the act, the 'act_scenes' key
+    """
+    __slots__ = ('number', '_descr', '_chapters', 'scenes_text', '_split',
+                 '_plan', '_rendered')
+    KEYS = ('act_descr', 'chapters', 'act_scenes', 'chapter_scenes')
+
+    def __init__(self, descr, chapters=(), scenes_text=None):
+        self.number = 1
+        self._descr = descr
+        self.scenes_text = scenes_text
+        # chapter_scenes was set
+        self._split = False
+        self._plan = None
+        self._rendered = {}
+        self._chapters = []
+        self.chapters = chapters
+
+    @property
+    def descr(self):
+        return self._descr
+
+    @descr.setter
+    def descr(self, descr):
+        self._descr = descr
+        self._changed()
+
+    @property
+    def chapters(self):
+        return tuple(self._chapters)
+
+    @chapters.setter
+    def chapters(self, chapters):
+        self._chapters = [
+            chapter if isinstance(chapter, Chapter) else Chapter(None, chapter)
+            for chapter in chapters]
+        for chapter in self._chapters:
+            chapter._act = self
+        self._changed()
+
+    def _changed(self):
+        if self._plan is not None:
+            self._plan._changed()
+            return
+        ch_num = 1
+        for chapter in self._chapters:
+            if chapter.outline is not None:
+                chapter.number = ch_num
+                ch_num += 1
+        self._rendered.clear()
+
+    def outlined_chapters(self):
+        return [chapter for chapter in self._chapters
+                if chapter.outline is not None]
+
+    def chapter_scenes(self):
+        return {chapter.number: [scene.spec for scene in chapter.scenes]
+                for chapter in self._chapters if chapter.scenes}
+
+    def set_chapter_scenes(self, chapter_scenes):
+        """Assigns scene specs to the chapters by chapter number
+
+        Chapters without an outline are made for unknown numbers and
+        placed in the order of chapter_scenes among the outlined ones.
+        """
+        outlined = self.outlined_chapters()
+        by_number = {chapter.number: idx
+                     for idx, chapter in enumerate(outlined)}
+        chapters = []
+        next_idx = 0
+        for chapter in outlined:
+            chapter.scenes = []
+        for ch_num, specs in chapter_scenes.items():
+            # JSON keeps chapter numbers as str keys
+            ch_num = int(ch_num)
+            idx = by_number.get(ch_num)
+            if idx is None:
+                chapter = Chapter(ch_num, None)
+                chapter._act = self
+                chapters.append(chapter)
+            else:
+                chapter = outlined[idx]
+                if idx >= next_idx:
+                    chapters.extend(outlined[next_idx:idx + 1])
+                    next_idx = idx + 1
+            chapter.scenes = [Scene(sc_num, spec)
+                              for sc_num, spec in enumerate(specs, start=1)]
+        self._chapters = chapters + outlined[next_idx:]
+        self._split = True
+
+    def render(self, detail='full'):
+        """Act text, 'summary' leaves the chapters out"""
+        text = self._rendered.get(detail)
+        if text is None:
+            text = self._descr + '\n'
+            if not _ACT_HEADING.search(text, 0, 50):
+                text = f'Act {self.number}:\n' + text
+            if detail == 'full':
+                text += ''.join(
+                    f'- Chapter {chapter.number}: {chapter.outline}\n'
+                    for chapter in self.outlined_chapters())
+            self._rendered[detail] = text
+        return text
+
+    def to_dict(self):
+        act_dict = {'act_descr': self._descr,
+                    'chapters': [chapter.outline
+                                 for chapter in self.outlined_chapters()]}
+        if self.scenes_text is not None:
+            act_dict['act_scenes'] = self.scenes_text
+        if self._split:
+            act_dict['chapter_scenes'] = self.chapter_scenes()
+        return act_dict
+
+    def __getitem__(self, key):
+        if key == 'act_descr':
+            return self._descr
+        if key == 'chapters':
+            return [chapter.outline for chapter in self.outlined_chapters()]
+        if key == 'act_scenes' and self.scenes_text is not None:
+            return self.scenes_text
+        if key == 'chapter_scenes' and self._split:
+            return self.chapter_scenes()
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'act_descr':
+            self.descr = value
+        elif key == 'chapters':
+            self.chapters = value
+        elif key == 'act_scenes':
+            self.scenes_text = value
+        elif key == 'chapter_scenes':
+            self.set_chapter_scenes(value)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.to_dict())
+
+    def __repr__(self):
+        return f'Act({self.to_dict()!r})'
+
 
 class Plan:
+    """Acts of a story, a sequence of `Act`
+
+    Acts given as dicts are converted. Replacing an act renumbers the
+    chapters and drops the cached texts.
+    """
+    __slots__ = ('_acts', '_texts')
+
+    def __init__(self, acts=()):
+        self._acts = []
+        self._texts = {}
+        adopted = [self._adopt(act) for act in acts]
+        self._acts = [act for act, _ in adopted]
+        self._changed()
+        for act, chapter_scenes in adopted:
+            if chapter_scenes is not None:
+                act.set_chapter_scenes(chapter_scenes)
+
+    def _adopt(self, act):
+        if isinstance(act, Act) and act._plan is None:
+            act._plan = self
+            return act, None
+        # acts of another plan are copied
+        act_dict = act.to_dict() if isinstance(act, Act) else act
+        new_act = Act(act_dict['act_descr'], act_dict.get('chapters', ()),
+                      act_dict.get('act_scenes'))
+        new_act._plan = self
+        return new_act, act_dict.get('chapter_scenes')
+
+    def _changed(self):
+        ch_num = 1
+        for act_num, act in enumerate(self._acts, start=1):
+            act.number = act_num
+            for chapter in act._chapters:
+                if chapter.outline is not None:
+                    chapter.number = ch_num
+                    ch_num += 1
+            act._rendered.clear()
+        self._texts.clear()
+
+    @staticmethod
+    def wrap(plan):
+        """The plan itself if it is a `Plan`, else a `Plan` of its acts"""
+        return plan if isinstance(plan, Plan) else Plan(plan)
+
+    def __getitem__(self, idx):
+        return self._acts[idx]
+
+    def __setitem__(self, idx, act):
+        self._acts[idx]._plan = None
+        new_act, chapter_scenes = self._adopt(act)
+        self._acts[idx] = new_act
+        self._changed()
+        if chapter_scenes is not None:
+            new_act.set_chapter_scenes(chapter_scenes)
+
+    def append(self, act):
+        new_act, chapter_scenes = self._adopt(act)
+        self._acts.append(new_act)
+        self._changed()
+        if chapter_scenes is not None:
+            new_act.set_chapter_scenes(chapter_scenes)
+
+    def __len__(self):
+        return len(self._acts)
+
+    def __iter__(self):
+        return iter(self._acts)
+
+    def __eq__(self, other):
+        if isinstance(other, (Plan, list)):
+            return self.to_json() == Plan.wrap(other).to_json()
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Plan({self.to_json()!r})'
+
+    def text(self, details=None):
+        """Cached plan text, see `plan_2_str`"""
+        key = None if details is None else tuple(details)
+        text = self._texts.get(key)
+        if text is None:
+            if details is None:
+                details = ['full'] * len(self._acts)
+            text = ''.join(act.render(detail) + '\n'
+                           for act, detail in zip(self._acts, details)
+                           if detail is not None).strip()
+            if len(self._texts) >= MAX_CACHED_TEXTS:
+                self._texts.clear()
+            self._texts[key] = text
+        return text
+
+    def scenes(self):
+        """Yields (act_num, ch_num, sc_num, scene spec) in story order"""
+        for act in self._acts:
+            for chapter in act._chapters:
+                for scene in chapter.scenes:
+                    yield act.number, chapter.number, scene.number, scene.spec
+
+    def chapter_act(self, ch_num):
+        """Index of the act with chapter number ch_num, the last if none"""
+        for idx, act in enumerate(self._acts):
+            for chapter in act._chapters:
+                if chapter.outline is not None and chapter.number == ch_num:
+                    return idx
+        return len(self._acts) - 1
+
+    def to_json(self):
+        return [act.to_dict() for act in self._acts]
+
+    @staticmethod
+    def from_json(data):
+        return Plan(Plan.restore_chapter_numbers(data))
+
     @staticmethod
     def split_by_act(original_plan):
-        # removes only Act texts with newline prepended soemwhere near
-        acts = re.split('\n.{0,5}?Act ', original_plan)
-        # remove random short garbage from re split
-        acts = [text.strip() for text in acts[:]
-                if (text and (len(text.split()) > 3))]
-        if len(acts) == 4:
-            acts = acts[1:]
-        elif len(acts) != 3:
-            print('Fail: split_by_act, attempt 1', original_plan)
-            acts = original_plan.split('Act ')
-            if len(acts) == 4:
-                acts = acts[-3:]
-            elif len(acts) != 3:
-                print('Fail: split_by_act, attempt 2', original_plan)
-                return []
-
-        # [act1, act2, act3], [Act + act1, act2, act3]
-        if acts[0].startswith('Act '):
-            acts = [acts[0]] + ['Act ' + act for act in acts[1:]]
-        else:
-            acts = ['Act ' + act for act in acts[:]]
-        return acts
+        return parsing.split_acts(original_plan).value
 
     @staticmethod
     def parse_act(act):
-        act = re.split(r'\n.{0,20}?Chapter .+:', act.strip())
-        chapters = [text.strip() for text in act[1:]
-                    if (text and (len(text.split()) > 3))]
-        return {'act_descr': act[0].strip(), 'chapters': chapters}
+        return parsing.parse_act(act).value
 
     @staticmethod
     def parse_text_plan(text_plan):
-        acts = Plan.split_by_act(text_plan)
-        if not acts:
-            return []
-        plan = [Plan.parse_act(act) for act in acts if act]
-        plan = [act for act in plan if act['chapters']]
-        return plan
+        return Plan(parsing.parse_text_plan(text_plan).value)
 
     @staticmethod
     def normalize_text_plan(text_plan):
@@ -53,38 +358,40 @@ class Plan:
 
     @staticmethod
     def act_2_str(plan, act_num):
-        text_plan = ''
+        # earlier acts without chapters, the act in full, later acts left out
+        plan = Plan.wrap(plan)
+        n_before = min(act_num - 1, len(plan))
+        details = (['summary'] * n_before + ['full']
+                   + [None] * (len(plan) - n_before - 1))
         chs = []
-        ch_num = 1
-        for i, act in enumerate(plan):
-            act_descr = act['act_descr'] + '\n'
-            if not re.search(r'Act \d', act_descr[0:50]):
-                act_descr = f'Act {i+1}:\n' + act_descr
-            for chapter in act['chapters']:
-                if (i + 1) == act_num:
-                    act_descr += f'- Chapter {ch_num}: {chapter}\n'
-                    chs.append(ch_num)
-                elif (i + 1) > act_num:
-                    return text_plan.strip(), chs
-                ch_num += 1
-            text_plan += act_descr + '\n'
-        return text_plan.strip(), chs
+        if act_num <= len(plan):
+            chs = [chapter.number
+                   for chapter in plan[act_num - 1].outlined_chapters()]
+        return plan.text(details), chs
 
     @staticmethod
-    def plan_2_str(plan):
-        text_plan = ''
-        ch_num = 1
-        for i, act in enumerate(plan):
-            act_descr = act['act_descr'] + '\n'
-            if not re.search(r'Act \d', act_descr[0:50]):
-                act_descr = f'Act {i+1}:\n' + act_descr
-            for chapter in act['chapters']:
-                act_descr += f'- Chapter {ch_num}: {chapter}\n'
-                ch_num += 1
-            text_plan += act_descr + '\n'
-        return text_plan.strip()
+    def plan_2_str(plan, details=None):
+        # details per act: 'full', 'summary' (no chapters) or None (left
+        # out), chapter numbers stay those of the whole plan
+        return Plan.wrap(plan).text(details)
 
     @staticmethod
     def save_plan(plan, fpath):
         with open(fpath, 'w') as fp:
-            json.dump(plan, fp, indent=4)
+            json.dump(Plan.wrap(plan).to_json(), fp, indent=4)
+
+    @staticmethod
+    def load_plan(fpath):
+        with open(fpath) as fp:
+            plan = json.load(fp)
+        return Plan.from_json(plan)
+
+    @staticmethod
+    def restore_chapter_numbers(plan):
+        # json stores int chapter numbers of chapter_scenes as str keys
+        for act in plan:
+            if 'chapter_scenes' in act:
+                act['chapter_scenes'] = {
+                    int(ch_num): scenes
+                    for ch_num, scenes in act['chapter_scenes'].items()}
+        return plan
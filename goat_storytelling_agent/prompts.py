@@ -1,3 +1,7 @@
+# part of the fingerprints of saved stage outputs and scenes, bump it
+# when the prompts change so that `StoryAgent.recompute` regenerates them
+version = 1
+
 system = (
     "You are a helpful assistant for fiction writing. "
     "Always cut the bullshit and provide concise outlines with useful details. "
@@ -16,6 +20,9 @@ book_spec_format = (
     "Characters: use specific names already\n"
     "Premise: describe some concrete events already")
 
+scene_spec_fields = ['Characters', 'Place', 'Time', 'Event', 'Conflict',
+                     'Story value', 'Story value charge', 'Mood', 'Outcome']
+
 scene_spec_format = (
     "Chapter [number]:\nScene [number]:\nCharacters: character list\nPlace: place\nTime: absolute or relative time\nEvent: what happens\nConflict: scene micro-conflict\n"
     "Story value: story value affected by the scene\nStory value charge: the charge of story value by the end of the scene (positive or negative)\nMood: mood\nOutcome: the result.")
@@ -91,13 +98,23 @@ def split_chapters_into_scenes_messages(act_num, text_act, form):
     return messages
 
 
-def scene_messages(scene, sc_num, ch_num, text_plan, form):
+def scene_messages(scene, sc_num, ch_num, text_plan, form, plan_first=False):
+    if plan_first:
+        # the plot shared by all scenes goes first so that the backend
+        # can reuse the cached prompt prefix between scenes
+        content = (
+            f"Here is the overall plot:\n\"\"\"{text_plan}\"\"\"\n\n"
+            f"Write a long detailed scene for a {form} for scene {sc_num} in chapter {ch_num} based on the information. "
+            "Be creative, explore interesting characters and unusual settings. Do NOT use foreshadowing.\n"
+            f"Here is the scene specification:\n\"\"\"{scene}\"\"\"")
+    else:
+        content = (
+            f"Write a long detailed scene for a {form} for scene {sc_num} in chapter {ch_num} based on the information. "
+            "Be creative, explore interesting characters and unusual settings. Do NOT use foreshadowing.\n"
+            f"Here is the scene specification:\n\"\"\"{scene}\"\"\"\n\nHere is the overall plot:\n\"\"\"{text_plan}\"\"\"")
     messages = [
         {"role": "system", "content": 'You are an expert fiction writer. Write detailed scenes with lively dialogue.'},
-        {"role": "user",
-            "content": f"Write a long detailed scene for a {form} for scene {sc_num} in chapter {ch_num} based on the information. "
-            "Be creative, explore interesting characters and unusual settings. Do NOT use foreshadowing.\n"
-            f"Here is the scene specification:\n\"\"\"{scene}\"\"\"\n\nHere is the overall plot:\n\"\"\"{text_plan}\"\"\""},
+        {"role": "user", "content": content},
         {"role": "assistant", "content": f"\nChapter {ch_num}, Scene {sc_num}\n"},
     ]
     return messages
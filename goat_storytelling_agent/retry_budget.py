@@ -0,0 +1,187 @@
+"""Budgets of the re-query loops run when a model answer fails to parse.
+
+Every parse loop of a stage (a missing spec field, the plot outline, an
+act rewrite) gets its own `RetryBudget` from the `RetryPolicy`, and the
+re-queries of all loops of a story are bounded by the story budget. When
+a budget runs out the stage falls back: a missing spec field stays
+empty, an act keeps its previous outline, and an outline that never
+parsed fails the story with `RetryBudgetExceeded`.
+"""
+import threading
+
+
+class RetryBudgetExceeded(RuntimeError):
+    """A stage ran out of retries with no output to fall back to"""
+
+
+class RetryBudget:
+    """Limits of a retry loop, None means unlimited
+
+    Parameters
+    ----------
+    max_attempts : int, optional
+        Queries of the loop, including the first one. For the story budget:
+        re-queries of all loops
+    max_tokens : int, optional
+        Completion tokens of the queries. For the story budget: of all
+        re-queries
+    max_time : float, optional
+        Seconds of the queries. For the story budget: of all re-queries
+    """
+    def __init__(self, max_attempts=None, max_tokens=None, max_time=None):
+        self.max_attempts = max_attempts
+        self.max_tokens = max_tokens
+        self.max_time = max_time
+
+    def allows(self, attempts, tokens, seconds):
+        return ((self.max_attempts is None or attempts < self.max_attempts)
+                and (self.max_tokens is None or tokens < self.max_tokens)
+                and (self.max_time is None or seconds < self.max_time))
+
+    def as_dict(self):
+        return {'max_attempts': self.max_attempts,
+                'max_tokens': self.max_tokens, 'max_time': self.max_time}
+
+
+class RetryPolicy:
+    """Retry budgets of the stages and of the whole story
+
+    Parameters
+    ----------
+    stages : Dict[str, RetryBudget]
+        Budget of every parse loop of a stage, by stage name
+    default : RetryBudget, optional
+        Budget of loops of the other stages, 5 attempts if not set
+    story : RetryBudget, optional
+        Budget of the re-queries of all loops of a story, 30 if not set
+    """
+    def __init__(self, stages={}, default=None, story=None):
+        self.stages = stages
+        self.default = default if default is not None else RetryBudget(
+            max_attempts=5)
+        self.story = story if story is not None else RetryBudget(
+            max_attempts=30)
+
+    def budget(self, stage):
+        return self.stages.get(stage, self.default)
+
+
+class RetryLoop:
+    """Usage of one parse loop, made by `RetryTracker.loop`"""
+    def __init__(self, tracker, stage, budget):
+        self.tracker = tracker
+        self.stage = stage
+        self.budget = budget
+        self.attempts = 0
+        self.tokens = 0
+        self.seconds = 0.0
+
+    @property
+    def requery(self):
+        """True if the current query repeats a failed one"""
+        return self.attempts > 1
+
+    def next(self):
+        """Starts the next query, False if the budget does not allow it"""
+        return self.start(1) == 1
+
+    def start(self, n):
+        """Starts up to n queries at once, returns how many the budget allows
+
+        The queries after the first one of the loop count as re-queries.
+        """
+        started = 0
+        while started < n and (not self.attempts or (
+                self.budget.allows(self.attempts, self.tokens, self.seconds)
+                and self.tracker.allows_requery())):
+            self.attempts += 1
+            self.tracker.started(self.stage, self.requery)
+            started += 1
+        if not started:
+            self.tracker.exhausted(self.stage)
+        return started
+
+    def charge(self, tokens, seconds, requery=None):
+        """Adds a finished query of the loop
+
+        requery tells if the query repeated a failed one, by default if
+        the last started query does. Queries started together pass it, as
+        they finish in any order.
+        """
+        if requery is None:
+            requery = self.requery
+        self.tokens += tokens
+        self.seconds += seconds
+        self.tracker.charge(self.stage, tokens, seconds, requery)
+
+
+class RetryTracker:
+    """Retry budget usage of the story written by an agent"""
+    def __init__(self, policy=None):
+        self.policy = policy if policy is not None else RetryPolicy()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Starts the accounting of a new story"""
+        with self._lock:
+            self._stages = {}
+            self._requeries = 0
+            self._requery_tokens = 0
+            self._requery_seconds = 0.0
+
+    def loop(self, stage):
+        return RetryLoop(self, stage, self.policy.budget(stage))
+
+    def _stage(self, stage):
+        return self._stages.setdefault(stage, {
+            'loops': 0, 'queries': 0, 'requeries': 0, 'tokens': 0,
+            'requery_tokens': 0, 'seconds': 0.0, 'exhausted': 0})
+
+    def allows_requery(self):
+        with self._lock:
+            return self.policy.story.allows(
+                self._requeries, self._requery_tokens, self._requery_seconds)
+
+    def started(self, stage, requery):
+        with self._lock:
+            usage = self._stage(stage)
+            usage['queries'] += 1
+            if requery:
+                usage['requeries'] += 1
+                self._requeries += 1
+            else:
+                usage['loops'] += 1
+
+    def charge(self, stage, tokens, seconds, requery):
+        with self._lock:
+            usage = self._stage(stage)
+            usage['tokens'] += tokens
+            usage['seconds'] += seconds
+            if requery:
+                usage['requery_tokens'] += tokens
+                self._requery_tokens += tokens
+                self._requery_seconds += seconds
+
+    def exhausted(self, stage):
+        with self._lock:
+            self._stage(stage)['exhausted'] += 1
+
+    def stats(self):
+        """Budget usage per stage and of the story
+
+        Returns
+        -------
+        Dict
+            'stages': loops, queries, re-queries, tokens and seconds spent
+            and the number of exhausted budgets per stage; 'story': the
+            re-queries of all stages with the story budget
+        """
+        with self._lock:
+            return {
+                'stages': {stage: dict(usage)
+                           for stage, usage in self._stages.items()},
+                'story': {'requeries': self._requeries,
+                          'requery_tokens': self._requery_tokens,
+                          'requery_seconds': self._requery_seconds,
+                          'budget': self.policy.story.as_dict()}}
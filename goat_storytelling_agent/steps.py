@@ -0,0 +1,72 @@
+"""Steps the pipeline generators of `StoryAgent` yield to their driver.
+
+Every stage is written once, as a generator that yields a step whenever
+it needs the backend or runs work concurrently and gets back the result
+of the step. `StoryAgent.run_steps` performs the steps in the calling
+thread and a thread pool, `AsyncStoryAgent.run_steps` awaits them on the
+event loop. An exception of a step is raised inside the generator.
+
+`StoryAgent.iter_steps` also hands the events of `Emit` steps and the text
+of `Stream` steps on to its consumer, the other drivers drop the events
+and run a `Stream` like a `Query`.
+"""
+
+
+class Query:
+    """Chat call of `StoryAgent.query_chat`, its answer is sent back"""
+    def __init__(self, messages, **kwargs):
+        self.messages = messages
+        self.kwargs = kwargs
+
+
+class Backend:
+    """Backend call of `StoryAgent.query_backend`, its answer is sent back"""
+    def __init__(self, messages, **kwargs):
+        self.messages = messages
+        self.kwargs = kwargs
+
+
+class Race:
+    """Sampled chat calls of `StoryAgent.race_chat`, the value of the
+    winning answer is sent back"""
+    def __init__(self, messages, accept, stage, retry_loop, schema=None):
+        self.messages = messages
+        self.accept = accept
+        self.stage = stage
+        self.retry_loop = retry_loop
+        self.schema = schema
+
+
+class Map:
+    """Runs the steps of steps(item) for every item, up to max_workers at
+    once, the list of their results is sent back"""
+    def __init__(self, steps, items, max_workers=None):
+        self.steps = steps
+        self.items = list(items)
+        self.max_workers = max_workers
+
+
+class Stream:
+    """Streamed chat call of `StoryAgent.stream_chat`
+
+    Every delta is handed on as make_event(text, reset=...), the answer is
+    sent back.
+    """
+    def __init__(self, messages, make_event, **kwargs):
+        self.messages = messages
+        self.make_event = make_event
+        self.kwargs = kwargs
+
+
+class Call:
+    """Blocking call besides the backend, e.g. to the response cache, its
+    result is sent back. `AsyncStoryAgent` runs it in a worker thread."""
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+
+class Emit:
+    """Event handed on to the consumer of the pipeline"""
+    def __init__(self, event):
+        self.event = event
@@ -0,0 +1,208 @@
+"""Stop strings and validators that end a generation while it streams.
+
+A `StreamGuard` is fed the text deltas of one generation and passes on
+the text that is kept. It stops at the first stop string or before the
+first line a validator rejects, e.g. the heading of the next scene, and
+the request is then closed instead of generating text that is thrown
+away after parsing.
+
+A validator is called as validator(lines, line, complete) with the
+complete lines of the answer before the current one, including the
+started assistant message, and the current line so far. It returns True
+to keep the line, False to end the answer before it or None while the
+line is too short to tell, and the line is held back until then. A
+complete line that is still undecided is kept.
+
+A guard can also be given a cancel event, e.g. of answers raced against
+each other, that ends its answer at the next delta once set.
+"""
+import re
+
+
+# chapter references as `parsing.parse_act_scenes` finds them
+_CHAPTER_NUMBER = re.compile(r'Chapter (\d+)')
+_SCENE_HEADINGS = ('Chapter ', 'Scene ')
+
+
+class StreamGuard:
+    """Filters the deltas of a streamed answer
+
+    Parameters
+    ----------
+    stop : List[str]
+        Strings ending the answer, they are not part of it
+    validators : List[Callable]
+        Line validators, see the module docstring
+    prefix : str
+        Started assistant message the answer continues, seen by the
+        validators but not passed on
+    cancel : threading.Event or asyncio.Event, optional
+        Ends the answer once set, with the reason 'cancelled'
+    """
+    def __init__(self, stop=(), validators=(), prefix='', cancel=None):
+        self.stop = [string for string in stop if string]
+        self.validators = list(validators)
+        self.prefix = prefix
+        self.cancel = cancel
+        self.reset()
+
+    def reset(self):
+        """Starts over, for a retried request"""
+        # the stop string or validator that ended the answer
+        self.reason = None
+        # tail of the text that may start a stop string
+        self._held = ''
+        *self._lines, self._line = self.prefix.split('\n')
+        # the current line was accepted and is passed on as it grows
+        self._accepted = False
+        # the prefix part of the current line is not passed on
+        self._emit_from = len(self._line)
+        self._newline = False
+
+    @property
+    def stopped(self):
+        return self.reason is not None
+
+    def feed(self, delta):
+        """Text of the delta that can be passed on"""
+        if self.cancel is not None and self.cancel.is_set():
+            self.reason = 'cancelled'
+        if self.reason is not None:
+            return ''
+        text = self._held + delta
+        self._held = ''
+        found = False
+        if self.stop:
+            text, found = self._cut_stop(text)
+        out = self._feed_lines(text)
+        if found and self.reason is None:
+            out += self._end()
+            self.reason = 'stop'
+        return out
+
+    def finish(self):
+        """Text held back when the stream ended"""
+        if self.reason is not None:
+            return ''
+        text = self._feed_lines(self._held)
+        self._held = ''
+        return text + self._end()
+
+    def _cut_stop(self, text):
+        ends = [idx for idx in (text.find(string) for string in self.stop)
+                if idx >= 0]
+        if ends:
+            return text[:min(ends)], True
+        # hold back the longest tail that may grow into a stop string
+        for size in range(min(len(text), max(map(len, self.stop)) - 1),
+                          0, -1):
+            tail = text[-size:]
+            if any(string.startswith(tail) for string in self.stop):
+                self._held = tail
+                return text[:-size], False
+        return text, False
+
+    def _feed_lines(self, text):
+        if not self.validators:
+            return text
+        out = []
+        for idx, part in enumerate(text.split('\n')):
+            if idx:
+                if not self._accepted and not self._check(out, True):
+                    return ''.join(out)
+                self._lines.append(self._line)
+                self._line = ''
+                self._accepted = False
+                self._emit_from = 0
+                self._newline = True
+            if part:
+                self._line += part
+                if self._accepted:
+                    out.append(part)
+                elif not self._check(out, False):
+                    return ''.join(out)
+        return ''.join(out)
+
+    def _end(self):
+        # the last line is complete once the answer ends
+        out = []
+        if self.validators and not self._accepted:
+            self._check(out, True)
+        return ''.join(out)
+
+    def _check(self, out, complete):
+        """Asks the validators about the current line, False to stop"""
+        verdict = True
+        for validator in self.validators:
+            result = validator(self._lines, self._line, complete)
+            if result is False:
+                self.reason = getattr(
+                    validator, '__name__', type(validator).__name__)
+                return False
+            if result is None:
+                verdict = None
+        if verdict or complete:
+            if self._newline:
+                out.append('\n')
+            out.append(self._line[self._emit_from:])
+            self._accepted = True
+            self._newline = False
+        return True
+
+
+def next_scene_heading(lines, line, complete):
+    """Rejects a 'Chapter '/'Scene ' line starting the next scene
+
+    `StoryAgent.prepare_scene_text` takes such lines among the first
+    five, and the five after the last chapter heading among them, as the
+    heading of the scene itself and cuts the text at the next one. Only
+    lines past both are rejected, so the scene text is the same as if the
+    generation had run to its end. Leading blank lines are not counted,
+    as answers may be stripped before.
+    """
+    if not line.startswith(_SCENE_HEADINGS):
+        if complete or not any(heading.startswith(line)
+                               for heading in _SCENE_HEADINGS):
+            return True
+        return None
+    start = 0
+    while start < len(lines) and not lines[start].strip():
+        start += 1
+    head = lines[start:start + 5]
+    idx = len(lines) - start
+    if idx < 5:
+        return True
+    n_head = max((i + 1 for i, text in enumerate(head) if 'Chapter ' in text),
+                 default=0)
+    return idx < n_head + 5
+
+
+class ActChapterScope:
+    """Rejects a line that goes on to a chapter outside the act
+
+    A by-scene breakdown of an act that mentions a chapter of another act
+    after all chapters of the act has run into the next act, and
+    `parsing.parse_act_scenes` drops those chapters. Lines are checked
+    when complete.
+
+    Parameters
+    ----------
+    act_chapters : List[int]
+        Chapter numbers of the act
+    """
+    def __init__(self, act_chapters):
+        self.act_chapters = set(act_chapters)
+
+    def __call__(self, lines, line, complete):
+        if not complete:
+            return None
+        ch_nums = [int(ch_num) for ch_num in _CHAPTER_NUMBER.findall(line)]
+        if all(ch_num in self.act_chapters for ch_num in ch_nums):
+            return True
+        seen = {int(ch_num) for text in lines
+                for ch_num in _CHAPTER_NUMBER.findall(text)}
+        for ch_num in ch_nums:
+            if ch_num not in self.act_chapters and self.act_chapters <= seen:
+                return False
+            seen.add(ch_num)
+        return True
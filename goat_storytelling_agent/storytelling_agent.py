@@ -1,15 +1,43 @@
-import sys
+import os
 import time
-import re
 import json
 import requests
-import traceback
+import threading
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from goat_storytelling_agent import utils
+from goat_storytelling_agent import utils, parsing, structured
 from goat_storytelling_agent.plan import Plan
+from goat_storytelling_agent.steps import (
+    Query, Backend, Race, Map, Stream, Call, Emit)
+from goat_storytelling_agent.context import SceneContext
+from goat_storytelling_agent.stopping import (
+    StreamGuard, ActChapterScope, next_scene_heading)
+from goat_storytelling_agent.cache import ResponseCache
+from goat_storytelling_agent.checkpoint import RunCheckpoint, fingerprint
+from goat_storytelling_agent.events import (
+    StageFinished, SceneStarted, TokenDelta, SceneFinished)
+from goat_storytelling_agent.transport import Transport, EndpointPool
+from goat_storytelling_agent.completions import CompletionBatcher
+from goat_storytelling_agent.token_count import make_token_counter
+from goat_storytelling_agent.instrumentation import Metrics, ConsoleLogger
+from goat_storytelling_agent.retry_budget import (
+    RetryTracker, RetryBudgetExceeded)
 
 
-SUPPORTED_BACKENDS = ["hf", "llama.cpp"]
+SUPPORTED_BACKENDS = ["hf", "llama.cpp", "openai"]
+# scenes of one story/act/chapter are written in order, each chain starts
+# without a previous scene and separate chains can be written concurrently
+SCENE_DEPENDENCIES = ["story", "act", "chapter"]
+# temperature raced samples are drawn with when the stage options are greedy
+RACE_TEMPERATURE = 0.8
+# parsers of the planning answers, in free text and in structured mode
+_TEXT_PARSERS = {'plan': parsing.parse_text_plan, 'act': parsing.parse_act,
+                 'act_scenes': parsing.parse_act_scenes}
+_JSON_PARSERS = {'plan': parsing.parse_json_plan,
+                 'act': parsing.parse_json_act,
+                 'act_scenes': parsing.parse_json_act_scenes}
 
 
 def generate_prompt_parts(
@@ -31,116 +59,378 @@ def generate_prompt_parts(
         yield '\n### ASSISTANT:'
 
 
-def _query_chat_hf(endpoint, messages, tokenizer, retries=3,
+def _query_chat_hf(endpoint, messages, token_counter, retries=3,
                    request_timeout=120, max_tokens=4096,
-                   extra_options={'do_sample': True}):
-    endpoint = endpoint.rstrip('/')
-    prompt = ''.join(generate_prompt_parts(messages))
-    tokens = tokenizer(prompt, add_special_tokens=True,
-                       truncation=False)['input_ids']
+                   extra_options={'do_sample': True}, transport=None,
+                   call_stats=None, logger=None, guard=None):
+    if guard is not None:
+        # streamed, so that the generation can be stopped early
+        call_stats = {} if call_stats is None else call_stats
+        stream = _stream_chat_hf(
+            endpoint, messages, token_counter, retries=retries,
+            request_timeout=request_timeout, max_tokens=max_tokens,
+            extra_options=extra_options, transport=transport,
+            call_stats=call_stats, logger=logger)
+        deltas = []
+        for delta in _guard_stream(stream, guard, call_stats):
+            if delta is None:
+                deltas.clear()
+            else:
+                deltas.append(delta)
+        return _join_response(messages, deltas) if deltas else ''
+    endpoints = EndpointPool.wrap(endpoint)
+    post = transport.post if transport is not None else requests.post
+    logger = logger or ConsoleLogger()
+    call_stats = {} if call_stats is None else call_stats
+    prompt_parts = list(generate_prompt_parts(messages))
+    prompt = ''.join(prompt_parts)
+    n_prompt_tokens = token_counter.count_parts(prompt_parts)
+    call_stats['prompt_tokens'] = n_prompt_tokens
     data = {
         "inputs": prompt,
         "parameters": {
-            'max_new_tokens': max_tokens - len(tokens),
+            'max_new_tokens': max_tokens - n_prompt_tokens,
             **extra_options
         }
     }
     headers = {'Content-Type': 'application/json'}
 
-    while retries > 0:
+    for attempt in range(retries):
+        call_stats['attempts'] = attempt + 1
+        endpoint = endpoints.acquire()
+        start = time.monotonic()
         try:
-            response = requests.post(
-                f"{endpoint}/generate", headers=headers, data=json.dumps(data),
-                timeout=request_timeout)
-            if messages and messages[-1]["role"] == "assistant":
-                result_prefix = messages[-1]["content"]
-            else:
-                result_prefix = ''
-            generated_text = result_prefix + json.loads(
-                response.text)['generated_text']
-            return generated_text
+            response = post(
+                f"{endpoint.url}/generate", headers=headers,
+                data=json.dumps(data), timeout=request_timeout)
+            response.raise_for_status()
+            generated_text = _join_response(
+                messages, [json.loads(response.text)['generated_text']])
         except Exception:
-            traceback.print_exc()
-            print('Timeout error, retrying...')
-            retries -= 1
-            time.sleep(5)
-    else:
-        return ''
+            endpoints.release(endpoint, ok=False)
+            logger.error('Timeout error, retrying...', exc_info=True)
+            if attempt + 1 < retries:
+                time.sleep(endpoints.backoff(attempt))
+            continue
+        endpoints.release(endpoint, ok=True,
+                          latency=time.monotonic() - start)
+        return generated_text
+    return ''
 
 
-def _query_chat_llamacpp(endpoint, messages, retries=3, request_timeout=120,
-                         max_tokens=4096, extra_options={}):
-    endpoint = endpoint.rstrip('/')
+def _stream_chat_hf(endpoint, messages, token_counter, retries=3,
+                    request_timeout=120, max_tokens=4096,
+                    extra_options={'do_sample': True}, transport=None,
+                    call_stats=None, logger=None):
+    """Yields generated text deltas from the TGI /generate_stream endpoint
+
+    None is yielded when the stream broke after some text was received and
+    the request is retried, deltas received before it must be discarded.
+    If call_stats dict is given, it is filled with prompt tokens, attempts
+    and the time to first token.
+    """
+    endpoints = EndpointPool.wrap(endpoint)
+    post = transport.post if transport is not None else requests.post
+    logger = logger or ConsoleLogger()
+    call_stats = {} if call_stats is None else call_stats
+    call_start = time.monotonic()
+    prompt_parts = list(generate_prompt_parts(messages))
+    prompt = ''.join(prompt_parts)
+    n_prompt_tokens = token_counter.count_parts(prompt_parts)
+    call_stats['prompt_tokens'] = n_prompt_tokens
+    data = {
+        "inputs": prompt,
+        "parameters": {
+            'max_new_tokens': max_tokens - n_prompt_tokens,
+            **extra_options
+        }
+    }
+    headers = {'Content-Type': 'application/json'}
+
+    for attempt in range(retries):
+        call_stats['attempts'] = attempt + 1
+        n_deltas = 0
+        ok = False
+        endpoint = endpoints.acquire()
+        start = time.monotonic()
+        try:
+            response = post(
+                f"{endpoint.url}/generate_stream", headers=headers,
+                data=json.dumps(data), timeout=request_timeout, stream=True)
+            with response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    parsed = json.loads(line[5:])
+                    if parsed.get("error"):
+                        raise ValueError(parsed["error"])
+                    token = parsed.get("token") or {}
+                    if token.get("special"):
+                        continue
+                    if 'ttft' not in call_stats:
+                        call_stats['ttft'] = time.monotonic() - call_start
+                    n_deltas += 1
+                    yield token.get("text", "")
+            ok = True
+            return
+        except GeneratorExit:
+            # the caller stopped reading, not a fault of the endpoint
+            ok = True
+            raise
+        except Exception:
+            logger.error('Timeout error, retrying...', exc_info=True)
+        finally:
+            endpoints.release(endpoint, ok=ok,
+                              latency=time.monotonic() - start)
+        if n_deltas:
+            yield None
+        if attempt + 1 < retries:
+            time.sleep(endpoints.backoff(attempt))
+
+
+def _stream_chat_llamacpp(endpoint, messages, retries=3, request_timeout=120,
+                          max_tokens=4096, extra_options={}, transport=None,
+                          call_stats=None, token_counter=None, logger=None):
+    """Yields generated text deltas from the llama.cpp /completion endpoint
+
+    None is yielded when the server reported an error after some text was
+    received and the request is retried, deltas received before it must
+    be discarded. If call_stats dict is given, it is filled with prompt
+    tokens processed and reused from the server prompt cache, attempts and
+    the time to first token. Without token_counter the prompt is tokenized
+    by a /tokenize call first.
+    """
+    endpoints = EndpointPool.wrap(endpoint)
+    post = transport.post if transport is not None else requests.post
+    logger = logger or ConsoleLogger()
+    call_stats = {} if call_stats is None else call_stats
+    call_start = time.monotonic()
     headers = {'Content-Type': 'application/json'}
-    prompt = ''.join(generate_prompt_parts(messages))
-    print(f"\n\n========== Submitting prompt: >>\n{prompt}", end="")
-    sys.stdout.flush()
-    response = requests.post(
-        f"{endpoint}/tokenize", headers=headers,
-        data=json.dumps({"content": prompt}),
-        timeout=request_timeout, stream=False)
-    tokens = [1, *response.json()["tokens"]]
+    prompt_parts = list(generate_prompt_parts(messages))
+    if token_counter is None:
+        response = endpoints.post(
+            post, "/tokenize", retries=max(retries, 1), headers=headers,
+            data=json.dumps({"content": ''.join(prompt_parts)}),
+            timeout=request_timeout, stream=False)
+        prompt = [1, *response.json()["tokens"]]
+        n_prompt_tokens = len(prompt)
+    else:
+        prompt = ''.join(prompt_parts)
+        n_prompt_tokens = token_counter.count_parts(prompt_parts)
+    # replaced by the server count of the last chunk
+    call_stats['prompt_tokens'] = n_prompt_tokens
     data = {
-        "prompt": tokens,
+        "prompt": prompt,
         "stream": True,
-        "n_predict": max_tokens - len(tokens),
+        "n_predict": max_tokens - n_prompt_tokens,
         **extra_options,
     }
     jdata = json.dumps(data)
     request_kwargs = dict(headers=headers, data=jdata,
                           timeout=request_timeout, stream=True)
-    response = requests.post(f"{endpoint}/completion", **request_kwargs)
-    result = bytearray()
-    if messages and messages[-1]["role"] == "assistant":
-        result += messages[-1]["content"].encode("utf-8")
+    n_deltas = 0
+    attempt = 0
+    while True:
+        call_stats['attempts'] = attempt + 1
+        failed = True
+        endpoint = endpoints.acquire()
+        start = time.monotonic()
+        try:
+            response = post(f"{endpoint.url}/completion", **request_kwargs)
+            # closing releases the connection back to the pool
+            with response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if line.startswith(b"error:"):
+                        logger.error(f"\nError(retry={retries - attempt - 1}): "
+                                     f"{line!r}")
+                        break
+                    if not line.startswith(b"data: "):
+                        raise ValueError(
+                            f"Got unexpected response: {line!r}")
+                    parsed = json.loads(line[6:])
+                    if 'ttft' not in call_stats:
+                        call_stats['ttft'] = time.monotonic() - call_start
+                    n_deltas += 1
+                    yield parsed.get("content", "")
+                    if parsed.get("stop") is True:
+                        call_stats.update(_llamacpp_prompt_stats(parsed))
+                        failed = False
+                        break
+                else:
+                    # stream ended without an error line
+                    failed = False
+        except GeneratorExit:
+            # the caller stopped reading, not a fault of the endpoint
+            failed = False
+            raise
+        except requests.RequestException:
+            logger.error(f"\nConnection error(retry={retries - attempt - 1})",
+                         exc_info=True)
+        finally:
+            endpoints.release(endpoint, ok=not failed,
+                              latency=time.monotonic() - start)
+        attempt += 1
+        if not failed or attempt > retries:
+            return
+        if n_deltas:
+            n_deltas = 0
+            yield None
+        time.sleep(endpoints.backoff(attempt - 1))
+
+
+def _llamacpp_prompt_stats(parsed):
+    """Prompt token counts from the final chunk of a llama.cpp stream"""
+    n_prompt = parsed.get("tokens_evaluated", 0)
+    timings = parsed.get("timings") or {}
+    n_processed = timings.get("prompt_n", n_prompt)
+    return {
+        'prompt_tokens': n_prompt,
+        'prompt_tokens_processed': n_processed,
+        'prompt_tokens_reused': max(n_prompt - n_processed, 0),
+        'completion_tokens': timings.get(
+            "predicted_n", parsed.get("tokens_predicted", 0)),
+    }
+
+
+def _query_chat_llamacpp(endpoint, messages, retries=3, request_timeout=120,
+                         max_tokens=4096, extra_options={}, transport=None,
+                         call_stats=None, token_counter=None, logger=None,
+                         guard=None):
+    logger = logger or ConsoleLogger()
+    call_stats = {} if call_stats is None else call_stats
+    logger.prompt(''.join(generate_prompt_parts(messages)))
+    deltas = []
     is_first = True
-    for line in response.iter_lines():
-        line = line.strip()
-        if not line:
+    stream = _stream_chat_llamacpp(
+        endpoint, messages, retries=retries,
+        request_timeout=request_timeout, max_tokens=max_tokens,
+        extra_options=extra_options, transport=transport,
+        call_stats=call_stats, token_counter=token_counter, logger=logger)
+    if guard is not None:
+        stream = _guard_stream(stream, guard, call_stats)
+    for content in stream:
+        if content is None:
+            is_first = True
+            deltas.clear()
             continue
-        if line.startswith(b"error:"):
-            retries -= 1
-            print(f"\nError(retry={retries}): {line!r}")
-            if retries < 0:
-                break
-            del response
-            time.sleep(5)
-            response = requests.post(f"{endpoint}/completion", **request_kwargs)
+        deltas.append(content)
+        logger.delta(content, is_first)
+        is_first = False
+    logger.response(call_stats)
+    return _join_response(messages, deltas).strip()
+
+
+def _stream_chat_openai(batcher, messages, token_counter, max_tokens=4096,
+                        extra_options={}, call_stats=None):
+    """Yields generated text deltas of a prompt sent through a batcher
+
+    The prompt shares an OpenAI-compatible /v1/completions request with the
+    concurrent prompts of the `completions.CompletionBatcher`. None is
+    yielded when the batch is sent again after a failure, deltas received
+    before it must be discarded.
+    """
+    call_stats = {} if call_stats is None else call_stats
+    call_start = time.monotonic()
+    prompt_parts = list(generate_prompt_parts(messages))
+    n_prompt_tokens = token_counter.count_parts(prompt_parts)
+    call_stats['prompt_tokens'] = n_prompt_tokens
+    call_stats['attempts'] = 1
+    stream = batcher.stream(''.join(prompt_parts),
+                            max_tokens - n_prompt_tokens, extra_options)
+    # closing takes the prompt out of its batch
+    with contextlib.closing(stream):
+        for delta in stream:
+            if delta is None:
+                call_stats['attempts'] += 1
+            elif 'ttft' not in call_stats:
+                call_stats['ttft'] = time.monotonic() - call_start
+            yield delta
+
+
+def _query_chat_openai(batcher, messages, token_counter, max_tokens=4096,
+                       extra_options={}, call_stats=None, logger=None,
+                       guard=None):
+    logger = logger or ConsoleLogger()
+    call_stats = {} if call_stats is None else call_stats
+    logger.prompt(''.join(generate_prompt_parts(messages)))
+    deltas = []
+    is_first = True
+    stream = _stream_chat_openai(
+        batcher, messages, token_counter, max_tokens=max_tokens,
+        extra_options=extra_options, call_stats=call_stats)
+    if guard is not None:
+        stream = _guard_stream(stream, guard, call_stats)
+    for content in stream:
+        if content is None:
             is_first = True
-            result.clear()
+            deltas.clear()
             continue
-        if not line.startswith(b"data: "):
-            raise ValueError(f"Got unexpected response: {line!r}")
-        parsed = json.loads(line[6:])
-        content = parsed.get("content", b"")
-        result += bytes(content, encoding="utf-8")
-        if is_first:
-            is_first = False
-            print("<<|", end="")
-            sys.stdout.flush()
-        print(content, end="")
-        sys.stdout.flush()
-        if parsed.get("stop") is True:
-            break
-    print("\nDone reading response.")
-    return str(result, encoding="utf-8").strip()
+        deltas.append(content)
+        logger.delta(content, is_first)
+        is_first = False
+    logger.response(call_stats)
+    return _join_response(messages, deltas).strip()
+
+
+def _guard_stream(stream, guard, call_stats):
+    """Passes the deltas of a stream through a `StreamGuard`
+
+    The stream is closed as soon as the guard stops, which closes the
+    connection and with it the generation on the server. The reason is
+    stored in call_stats under 'early_stop'.
+    """
+    for delta in stream:
+        if delta is None:
+            guard.reset()
+            yield None
+            continue
+        text = guard.feed(delta)
+        if text:
+            yield text
+        if guard.stopped:
+            call_stats['early_stop'] = guard.reason
+            stream.close()
+            return
+    text = guard.finish()
+    if text:
+        yield text
+
+
+def _join_response(messages, deltas):
+    """Prepends the started assistant message to the generated text"""
+    if messages and messages[-1]["role"] == "assistant":
+        result_prefix = messages[-1]["content"]
+    else:
+        result_prefix = ''
+    return result_prefix + ''.join(deltas)
 
 
 class StoryAgent:
     def __init__(self, backend_uri, backend="hf", request_timeout=120,
                  max_tokens=4096, n_crop_previous=400,
                  prompt_engine=None, form='novel',
-                 extra_options={}, scene_extra_options={}):
+                 extra_options={}, scene_extra_options={},
+                 pool_size=10, max_in_flight=1,
+                 cache=None, cache_sampling=False,
+                 prompt_cache=False, slot_id=None,
+                 scene_parallelism=1, scene_dependency='story',
+                 token_counter=None, request_limiter=None, story_id=None,
+                 metrics=None, logger=None, retry_policy=None,
+                 min_scene_tokens=1024, max_scene_prompt_tokens=None,
+                 stop=(), validators=None, early_stop=True,
+                 batcher=None, max_batch_size=16, batch_wait=0.01,
+                 structured=False, race_samples=1, recorder=None):
 
         self.backend = backend.lower()
         if self.backend not in SUPPORTED_BACKENDS:
             raise ValueError("Unknown backend")
 
-        if self.backend == "hf":
-            from transformers import LlamaTokenizerFast
-            self.tokenizer = LlamaTokenizerFast.from_pretrained(
-                "GOAT-AI/GOAT-70B-Storytelling")
-
         if prompt_engine is None:
             from goat_storytelling_agent import prompts
             self.prompt_engine = prompts
@@ -153,52 +443,695 @@ class StoryAgent:
         self.scene_extra_options = extra_options.copy()
         self.scene_extra_options.update(scene_extra_options)
         self.backend_uri = backend_uri
+        # one url, a list of replicas or a ready EndpointPool
+        self.endpoints = EndpointPool.wrap(backend_uri)
         self.n_crop_previous = n_crop_previous
         self.request_timeout = request_timeout
+        self.transport = Transport(pool_size=pool_size)
+        # the hf tokenizer is only loaded on the first request
+        self.token_counter = make_token_counter(
+            token_counter, self.backend, self.endpoints,
+            transport=self.transport, request_timeout=request_timeout)
+        self.max_in_flight = max_in_flight
+        self.cache = cache
+        self.cache_sampling = cache_sampling
+        self.prompt_cache = prompt_cache
+        self.slot_id = slot_id
+        self.prompt_stats = []
+        if scene_dependency not in SCENE_DEPENDENCIES:
+            raise ValueError("Unknown scene dependency policy")
+        self.scene_parallelism = scene_parallelism
+        self.scene_dependency = scene_dependency
+        # shared by the agents of a batch to cap requests of all stories
+        self.request_limiter = request_limiter
+        self.story_id = story_id
+        # share of the scenes written, orders the scenes of the stories at
+        # a prioritizing limiter
+        self.progress = 0.0
+        self.usage = {'requests': 0, 'completion_tokens': 0}
+        self._usage_lock = threading.Lock()
+        self.metrics = metrics if metrics is not None else Metrics()
+        # receives prompts and streamed text of the backend calls
+        self.logger = logger if logger is not None else ConsoleLogger()
+        # openai: prompts of concurrent calls share completion requests,
+        # those of several stories when the batcher is shared
+        self.batcher = batcher
+        if self.backend == "openai" and batcher is None:
+            self.batcher = self.make_batcher(max_batch_size, batch_wait)
+        # bounds the re-queries of answers that fail to parse
+        self.retry_tracker = RetryTracker(retry_policy)
+        self.spec_parser = parsing.BookSpecParser(
+            self.prompt_engine.book_spec_fields)
+        # scene prompts are narrowed to leave min_scene_tokens to the scene
+        self.scene_context = SceneContext(
+            self.count_prompt_tokens, max_tokens,
+            min_new_tokens=min_scene_tokens,
+            max_prompt_tokens=max_scene_prompt_tokens)
+        # stop strings of every answer, also sent to the backend
+        self.stop = list(stop)
+        # extra line validators of the answers by stage
+        self.validators = dict(validators or {})
+        # stop scenes at the next scene heading, scene breakdowns at
+        # chapters of the next act
+        self.early_stop = early_stop
+        # planning answers are generated under a JSON schema
+        self.structured = structured
+        # sampled answers of the outline and the acts queried at once,
+        # the first one that parses wins
+        self.race_samples = race_samples
+        # writes a trace of the calls that can be replayed, see `traffic`
+        self.recorder = recorder
+
+    def make_batcher(self, max_batch_size, batch_wait):
+        """`CompletionBatcher` of the endpoints, keyed by OPENAI_API_KEY"""
+        return CompletionBatcher(
+            self.endpoints, transport=self.transport,
+            max_batch_size=max_batch_size, max_wait=batch_wait,
+            request_timeout=self.request_timeout,
+            api_key=os.environ.get('OPENAI_API_KEY'), logger=self.logger)
+
+    def map_concurrent(self, func, items, max_workers=None):
+        """Applies func to items with up to max_in_flight calls at once
+
+        Results are returned in the order of items. With max_in_flight=1
+        items are processed one after another in the calling thread.
+        """
+        items = list(items)
+        max_workers = max_workers or self.max_in_flight
+        if max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        n_workers = min(max_workers, len(items))
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            return list(pool.map(func, items))
+
+    def run_steps(self, steps):
+        """Drives a pipeline generator and returns its result
+
+        The steps it yields are performed by `run_step` and their results
+        sent back, see `steps`.
+        """
+        send, value = steps.send, None
+        while True:
+            try:
+                step = send(value)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                send, value = steps.send, self.run_step(step)
+            except BaseException as exc:
+                send, value = steps.throw, exc
+
+    def iter_steps(self, steps):
+        """Drives a pipeline generator like `run_steps`, yielding events
+
+        The events of its `steps.Emit` steps are yielded, and for a
+        `steps.Stream` step the events made from the streamed deltas.
+        """
+        send, value = steps.send, None
+        while True:
+            try:
+                step = send(value)
+            except StopIteration:
+                return
+            try:
+                if isinstance(step, Emit):
+                    value = None
+                    yield step.event
+                elif isinstance(step, Stream):
+                    value = yield from self.stream_step(step)
+                else:
+                    value = self.run_step(step)
+                send = steps.send
+            except BaseException as exc:
+                send, value = steps.throw, exc
+
+    def stream_step(self, step):
+        """Yields the events of a `steps.Stream`, returns its answer"""
+        deltas = []
+        for delta in self.stream_chat(step.messages, **step.kwargs):
+            if delta is None:
+                deltas.clear()
+                yield step.make_event('', reset=True)
+            else:
+                deltas.append(delta)
+                yield step.make_event(delta)
+        return self.join_stream(step.messages, deltas)
+
+    def run_step(self, step):
+        """Result of a step of a pipeline generator, see `steps`"""
+        if isinstance(step, Query):
+            return self.query_chat(step.messages, **step.kwargs)
+        if isinstance(step, Backend):
+            return self.query_backend(step.messages, **step.kwargs)
+        if isinstance(step, Stream):
+            return self.query_chat(step.messages, **step.kwargs)
+        if isinstance(step, Emit):
+            return None
+        if isinstance(step, Call):
+            return step.func(*step.args)
+        if isinstance(step, Race):
+            return self.race_chat(step.messages, step.accept, step.stage,
+                                  step.retry_loop, step.schema)
+        return self.map_concurrent(
+            lambda item: self.run_steps(step.steps(item)), step.items,
+            step.max_workers)
+
+    def cache_key(self, messages, use_cache=True, stage=None):
+        """Cache key of the call or None if the cache is bypassed"""
+        if not use_cache or self.cache is None:
+            return None
+        options = self.stage_options(stage)
+        if (not self.cache_sampling
+                and ResponseCache.is_sampling(options, self.backend)):
+            return None
+        prompt = ''.join(generate_prompt_parts(messages))
+        return ResponseCache.make_key(
+            prompt, self.backend, self.max_tokens, self.stop_options(options))
+
+    def make_guard(self, messages, stage, validators=(), cancel=None):
+        """`StreamGuard` of a call, None if it has nothing to check
+
+        validators are the built-in ones of the stage and are left out
+        with early_stop=False.
+        """
+        validators = [*(validators if self.early_stop else ()),
+                      *self.validators.get(stage, ())]
+        if not self.stop and not validators and cancel is None:
+            return None
+        return StreamGuard(self.stop, validators,
+                           prefix=_join_response(messages, []),
+                           cancel=cancel)
+
+    def query_chat(self, messages, retries=3, use_cache=True, refresh=False,
+                   stage=None, retry_loop=None, validators=(), schema=None,
+                   cancel=None, options=None):
+        """Queries the backend, going through the response cache if set
+
+        Parameters
+        ----------
+        messages : List[Dict]
+            Chat messages
+        retries : int
+            Number of backend retries
+        use_cache : bool
+            Set to False to bypass the cache, e.g. when a new sample
+            is wanted
+        refresh : bool
+            Skip the cache lookup but store the new response, used when
+            re-querying after a cached response failed to parse
+        stage : str, optional
+            Pipeline stage the call is recorded under in the metrics
+        retry_loop : RetryLoop, optional
+            Parse loop the call is charged to
+        validators : List[Callable]
+            Line validators stopping the generation early, see `stopping`
+        schema : Dict, optional
+            JSON schema the answer is constrained to, see `structured`
+        cancel : threading.Event, optional
+            Stops the generation once set, the cut answer is not cached
+        options : Dict, optional
+            Generation options sent instead of those of the stage, the call
+            then bypasses the cache
+        """
+        return self.run_steps(self.query_chat_steps(
+            messages, retries=retries, use_cache=use_cache, refresh=refresh,
+            stage=stage, retry_loop=retry_loop, validators=validators,
+            schema=schema, cancel=cancel, options=options))
+
+    def query_chat_steps(self, messages, retries=3, use_cache=True,
+                         refresh=False, stage=None, retry_loop=None,
+                         validators=(), schema=None, cancel=None,
+                         options=None):
+        """Steps of `query_chat`"""
+        start_time, start = time.time(), time.monotonic()
+        if schema is not None:
+            messages = structured.schema_messages(messages, schema)
+        key = self.cache_key(messages, use_cache and options is None, stage)
+        if key is not None and not refresh:
+            result = yield Call(self.cache.get, key)
+            if result is not None:
+                self.record_call(stage, start_time, start, {},
+                                 requery=refresh, cache_hit=True,
+                                 retry_loop=retry_loop, messages=messages,
+                                 result=result, schema=schema)
+                return result
+        call_stats = {}
+        result = yield Backend(
+            messages, retries=retries, call_stats=call_stats,
+            guard=self.make_guard(messages, stage, validators, cancel),
+            schema=schema, stage=stage, options=options)
+        if (key is not None and result
+                and call_stats.get('early_stop') != 'cancelled'):
+            yield Call(self.cache.put, key, result)
+        self.record_call(stage, start_time, start, call_stats,
+                         requery=refresh, ok=bool(result),
+                         retry_loop=retry_loop, messages=messages,
+                         result=result, schema=schema, options=options)
+        return result
+
+    def race_chat(self, messages, accept, stage, retry_loop, schema=None):
+        """Queries race_samples answers at once until one is accepted
+
+        The first answer to finish that accept takes wins and the
+        generation of the others is stopped. Every answer is charged to
+        retry_loop and a round only starts the queries its budget allows.
+        Only the first query of the loop is sent with the options of the
+        stage and goes through the cache, the others sample with their own
+        seed, see `sample_options`.
+
+        Parameters
+        ----------
+        messages : List[Dict]
+            Chat messages
+        accept : Callable[[str], Any]
+            Reads an answer, returns a falsy value if it is not usable
+        stage : str
+            Pipeline stage the calls are recorded under
+        retry_loop : RetryLoop
+            Parse loop the calls are charged to
+        schema : Dict, optional
+            JSON schema the answers are constrained to
+
+        Returns
+        -------
+        Any
+            Value of the winning answer, None if the budget ran out first
+        """
+        while True:
+            first = retry_loop.attempts + 1
+            n_samples = retry_loop.start(self.race_samples)
+            if not n_samples:
+                return None
+            cancel = threading.Event()
+
+            def sample(idx):
+                return self.query_chat(
+                    messages, refresh=first + idx > 1, stage=stage,
+                    retry_loop=retry_loop, schema=schema, cancel=cancel,
+                    options=self.sample_options(stage, schema, first + idx))
+
+            with ThreadPoolExecutor(max_workers=n_samples) as pool:
+                futures = [pool.submit(sample, idx)
+                           for idx in range(n_samples)]
+                try:
+                    for future in as_completed(futures):
+                        value = accept(future.result())
+                        if value:
+                            return value
+                finally:
+                    # the other samples stop at their next delta
+                    cancel.set()
+
+    def sample_options(self, stage, schema, attempt):
+        """Generation options of a raced query, None for the first one
+
+        Greedy options of the stage would give every query the same
+        answer, so they are switched to sampling, and every query samples
+        with its attempt number in the loop as seed.
+        """
+        if attempt == 1:
+            return None
+        options = self.backend_options(schema, stage)
+        if not ResponseCache.is_sampling(options, self.backend):
+            if self.backend == 'hf':
+                options = {key: value for key, value in options.items()
+                           if key != 'temperature'}
+                options['do_sample'] = True
+            else:
+                options = {key: value for key, value in options.items()
+                           if key != 'do_sample'}
+                options['temperature'] = RACE_TEMPERATURE
+        return {**options, 'seed': attempt}
+
+    def record_call(self, stage, start_time, start, call_stats,
+                    requery=False, cache_hit=False, ok=True,
+                    retry_loop=None, messages=None, result=None,
+                    schema=None, options=None):
+        """Adds a chat call to the metrics and its parse loop budget
+
+        With a recorder, the messages, generation options and result of
+        the call go to the traffic trace as well.
+        """
+        attempts = call_stats.get('attempts', 0 if cache_hit else 1)
+        wall_time = time.monotonic() - start
+        if retry_loop is not None:
+            retry_loop.charge(call_stats.get('completion_tokens', 0),
+                              wall_time, requery)
+        record = {
+            'story_id': self.story_id, 'stage': stage, 'start': start_time,
+            'wall_time': wall_time,
+            'queue_time': call_stats.get('queue_time', 0.0),
+            'ttft': call_stats.get('ttft'),
+            'prompt_tokens': call_stats.get('prompt_tokens', 0),
+            'completion_tokens': call_stats.get('completion_tokens', 0),
+            'attempts': attempts, 'retries': max(attempts - 1, 0),
+            'requery': requery, 'cache_hit': cache_hit, 'ok': ok,
+            'early_stop': call_stats.get('early_stop')}
+        self.metrics.record_call(record)
+        if self.recorder is not None and messages is not None:
+            if options is None:
+                options = self.backend_options(schema, stage)
+            self.recorder.record(record, self.backend, messages, options,
+                                 result)
+
+    def cache_stats(self):
+        """Hit and miss statistics of the response cache"""
+        return self.cache.stats() if self.cache is not None else {}
+
+    def request_priority(self, stage=None):
+        """Order of a call among those waiting for a limiter, lowest first
+
+        Planning calls are short and go before scenes, and the scenes of
+        the stories closest to completion go first.
+        """
+        return (stage == 'write_scenes', -self.progress)
+
+    @contextlib.contextmanager
+    def request_slot(self, call_stats=None, stage=None):
+        """Holds a slot of the shared request limiter, if any, for a call
+
+        The time spent waiting for the slot is stored in call_stats. The
+        slot is queued for by `request_priority`, and the latency, time
+        to first token and retries of the call are reported on release.
+        """
+        if self.request_limiter is None:
+            yield
+            return
+        call_stats = {} if call_stats is None else call_stats
+        start = time.monotonic()
+        self.request_limiter.acquire(self.story_id,
+                                     self.request_priority(stage))
+        call_stats['queue_time'] = time.monotonic() - start
+        start = time.monotonic()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.request_limiter.release(
+                self.story_id, latency=time.monotonic() - start,
+                ttft=call_stats.get('ttft'),
+                failed=failed or call_stats.get('attempts', 1) > 1)
+
+    def query_backend(self, messages, retries=3, call_stats=None, guard=None,
+                      schema=None, stage=None, options=None, max_tokens=None):
+        """Sends a chat call to the backend through the request limiter
+
+        options and max_tokens replace the generation options of the stage
+        and the token budget of the agent, as when replaying a recorded
+        call.
+        """
+        call_stats = {} if call_stats is None else call_stats
+        if options is None:
+            options = self.backend_options(schema, stage)
+        max_tokens = max_tokens or self.max_tokens
+        with self.request_slot(call_stats, stage):
+            if self.backend == "hf":
+                result = _query_chat_hf(
+                    self.endpoints, messages, self.token_counter,
+                    retries=retries,
+                    request_timeout=self.request_timeout,
+                    max_tokens=max_tokens, extra_options=options,
+                    transport=self.transport, call_stats=call_stats,
+                    logger=self.logger, guard=guard)
+            elif self.backend == "llama.cpp":
+                result = _query_chat_llamacpp(
+                    self.endpoints, messages, retries=retries,
+                    request_timeout=self.request_timeout,
+                    max_tokens=max_tokens, extra_options=options,
+                    transport=self.transport, call_stats=call_stats,
+                    token_counter=self.token_counter, logger=self.logger,
+                    guard=guard)
+            elif self.backend == "openai":
+                result = _query_chat_openai(
+                    self.batcher, messages, self.token_counter,
+                    max_tokens=max_tokens, extra_options=options,
+                    call_stats=call_stats, logger=self.logger, guard=guard)
+        self.record_usage(messages, result, call_stats)
+        return result
+
+    def record_usage(self, messages, result, call_stats):
+        """Counts a backend call and the tokens it generated
+
+        The completion tokens are counted with token_counter if the backend
+        did not report them.
+        """
+        if 'prompt_tokens_processed' in call_stats:
+            self.prompt_stats.append(call_stats)
+        if 'completion_tokens' in call_stats:
+            n_tokens = call_stats['completion_tokens']
+        else:
+            prefix = _join_response(messages, []).strip()
+            generated = result[len(prefix):] if result.startswith(prefix) \
+                else result
+            n_tokens = self.token_counter.count(generated) if generated else 0
+            call_stats['completion_tokens'] = n_tokens
+        with self._usage_lock:
+            self.usage['requests'] += 1
+            self.usage['completion_tokens'] += n_tokens
+
+    def stop_options(self, options):
+        """Generation options with the stop strings added"""
+        if not self.stop:
+            return options
+        return {**options, 'stop': [*options.get('stop', ()), *self.stop]}
+
+    def stage_options(self, stage=None):
+        """extra_options of a call, scene_extra_options for scenes"""
+        if stage == 'write_scenes':
+            return self.scene_extra_options
+        return self.extra_options
+
+    def backend_options(self, schema=None, stage=None):
+        """Generation options of a call as sent to the backend
+
+        The stop strings, the llama.cpp prompt cache settings and the JSON
+        schema of a structured call are added to the options of the stage.
+        """
+        if self.backend == "llama.cpp":
+            options = self.llamacpp_options(stage)
+        else:
+            options = self.stop_options(self.stage_options(stage))
+        if schema is not None:
+            options = {**options,
+                       **structured.schema_options(self.backend, schema)}
+        return options
+
+    def llamacpp_options(self, stage=None):
+        """Generation options with server-side prompt caching settings"""
+        options = self.stop_options(self.stage_options(stage))
+        if not self.prompt_cache:
+            return options
+        options = {'cache_prompt': True, **options}
+        if self.slot_id is not None:
+            # pin the story to one server slot to keep its KV cache warm
+            options['id_slot'] = self.slot_id
+        return options
+
+    def prompt_cache_stats(self):
+        """Prompt tokens processed vs. reused by the llama.cpp server
+
+        Returns
+        -------
+        Dict
+            Per-call records under 'calls' and their totals
+        """
+        calls = list(self.prompt_stats)
+        totals = {key: sum(call[key] for call in calls)
+                  for key in ('prompt_tokens', 'prompt_tokens_processed',
+                              'prompt_tokens_reused', 'completion_tokens')}
+        return {'calls': calls, **totals}
+
+    def stream_chat(self, messages, retries=3, use_cache=True, stage=None,
+                    validators=()):
+        """Yields text deltas of the response as they are generated
 
-    def query_chat(self, messages, retries=3):
+        Only the generated continuation is streamed, without the started
+        assistant message. None is yielded when a broken stream is retried,
+        deltas received before it must be discarded. A cached response is
+        yielded as a single delta. Text that validators are still deciding
+        on is held back, see `stopping.StreamGuard`.
+        """
+        start_time, start = time.time(), time.monotonic()
+        key = self.cache_key(messages, use_cache, stage)
+        if key is not None:
+            cached = self.cached_delta(messages, self.cache.get(key), stage,
+                                       start_time, start)
+            if cached is not None:
+                yield cached
+                return
+
+        call_stats = {}
+        stream = self.open_stream(messages, retries, stage, call_stats)
+        guard = self.make_guard(messages, stage, validators)
+        if guard is not None:
+            stream = _guard_stream(stream, guard, call_stats)
+        deltas = []
+        with self.request_slot(call_stats, stage):
+            for delta in stream:
+                if delta is None:
+                    deltas.clear()
+                else:
+                    deltas.append(delta)
+                yield delta
+        result = self.finish_stream(messages, deltas, stage, start_time,
+                                    start, call_stats)
+        if key is not None and deltas:
+            self.cache.put(key, result)
+
+    def open_stream(self, messages, retries, stage, call_stats):
+        """Delta stream of a chat call from the backend"""
+        options = self.backend_options(stage=stage)
         if self.backend == "hf":
-            result = _query_chat_hf(
-                self.backend_uri, messages, self.tokenizer, retries=retries,
+            return _stream_chat_hf(
+                self.endpoints, messages, self.token_counter,
+                retries=retries,
                 request_timeout=self.request_timeout,
-                max_tokens=self.max_tokens, extra_options=self.extra_options)
+                max_tokens=self.max_tokens, extra_options=options,
+                transport=self.transport, call_stats=call_stats,
+                logger=self.logger)
         elif self.backend == "llama.cpp":
-            result = _query_chat_llamacpp(
-                self.backend_uri, messages, retries=retries,
+            return _stream_chat_llamacpp(
+                self.endpoints, messages, retries=retries,
                 request_timeout=self.request_timeout,
-                max_tokens=self.max_tokens, extra_options=self.extra_options)
+                max_tokens=self.max_tokens, extra_options=options,
+                transport=self.transport, call_stats=call_stats,
+                token_counter=self.token_counter, logger=self.logger)
+        elif self.backend == "openai":
+            return _stream_chat_openai(
+                self.batcher, messages, self.token_counter,
+                max_tokens=self.max_tokens, extra_options=options,
+                call_stats=call_stats)
+
+    def cached_delta(self, messages, result, stage, start_time, start):
+        """Cached response of a streamed call as its single delta
+
+        The started assistant message is cut off. None on a cache miss,
+        when result is None.
+        """
+        if result is None:
+            return None
+        self.record_call(stage, start_time, start, {}, cache_hit=True,
+                         messages=messages, result=result)
+        prefix = _join_response(messages, [])
+        if result.startswith(prefix):
+            result = result[len(prefix):]
         return result
 
+    def join_stream(self, messages, deltas):
+        """Response of a streamed call, as `query_chat` returns it"""
+        result = _join_response(messages, deltas)
+        if self.backend in ("llama.cpp", "openai"):
+            result = result.strip()
+        return result
+
+    def finish_stream(self, messages, deltas, stage, start_time, start,
+                      call_stats):
+        """Records a finished streamed call and returns its response"""
+        result = self.join_stream(messages, deltas)
+        self.record_usage(messages, result, call_stats)
+        self.record_call(stage, start_time, start, call_stats,
+                         ok=bool(deltas), messages=messages, result=result)
+        return result
+
+    def retry_stats(self):
+        """Retry budget usage of the parse loops of the current story"""
+        return self.retry_tracker.stats()
+
+    def connection_stats(self):
+        """Connection reuse counters of the pooled transport per endpoint"""
+        return self.transport.stats()
+
+    def endpoint_stats(self):
+        """Requests, failures, load and circuit state of every endpoint"""
+        return self.endpoints.stats()
+
     def parse_book_spec(self, text_spec):
-        # Initialize book spec dict with empty fields
-        fields = self.prompt_engine.book_spec_fields
-        spec_dict = {field: '' for field in fields}
-        last_field = None
-        if "\"\"\"" in text_spec[:int(len(text_spec)/2)]:
-            header, sep, text_spec = text_spec.partition("\"\"\"")
-        text_spec = text_spec.strip()
-
-        # Process raw spec into dict
-        for line in text_spec.split('\n'):
-            pseudokey, sep, value = line.partition(':')
-            pseudokey = pseudokey.lower().strip()
-            matched_key = [key for key in fields
-                           if (key.lower().strip() in pseudokey)
-                           and (len(pseudokey) < (2 * len(key.strip())))]
-            if (':' in line) and (len(matched_key) == 1):
-                last_field = matched_key[0]
-                if last_field in spec_dict:
-                    spec_dict[last_field] += value.strip()
-            elif ':' in line:
-                last_field = 'other'
-                spec_dict[last_field] = ''
-            else:
-                if last_field:
-                    # If line does not contain ':' it should be
-                    # the continuation of the last field's value
-                    spec_dict[last_field] += ' ' + line.strip()
-        spec_dict.pop('other', None)
-        return spec_dict
+        return self.spec_parser.parse(text_spec).value
+
+    def record_parse(self, stage, parser, result):
+        """Records a `parsing.ParseResult` and returns its value
+
+        Issues of answers that are not usable go to the logger.
+        """
+        self.metrics.record_parse({
+            'story_id': self.story_id, 'stage': stage, 'parser': parser,
+            'ok': result.ok, 'issues': result.issues})
+        if not result.ok:
+            self.logger.error(
+                f"Parse {parser} in {stage}: {'; '.join(result.issues)}")
+        return result.value
+
+    def answer_schema(self, parser, act_chapters=()):
+        """JSON schema of the answers read by parser, None unless structured
+
+        parser is 'book_spec', 'plan', 'act' or 'act_scenes', the latter
+        for the chapter numbers act_chapters.
+        """
+        if not self.structured:
+            return None
+        if parser == 'book_spec':
+            return structured.book_spec_schema(
+                self.prompt_engine.book_spec_fields)
+        if parser == 'plan':
+            return structured.plan_schema()
+        if parser == 'act':
+            return structured.act_schema()
+        from goat_storytelling_agent import prompts
+
+        return structured.act_scenes_schema(
+            act_chapters, getattr(self.prompt_engine, 'scene_spec_fields',
+                                  prompts.scene_spec_fields))
+
+    def parse_answer(self, stage, parser, text, *args):
+        """Parses and records an answer, read as JSON if structured"""
+        if parser == 'book_spec' and self.structured:
+            result = parsing.parse_json_book_spec(
+                text, self.spec_parser.fields)
+        elif parser == 'book_spec':
+            result = self.spec_parser.parse(text)
+        else:
+            parsers = _JSON_PARSERS if self.structured else _TEXT_PARSERS
+            result = parsers[parser](text, *args)
+        return self.record_parse(stage, parser, result)
+
+    def accept_plan(self, text_plan):
+        """Plan of an outline answer, empty if it does not parse"""
+        if not text_plan:
+            return []
+        return Plan(self.parse_answer(
+            'create_plot_chapters', 'plan', text_plan))
+
+    def accept_act(self, act):
+        """Act dict of a rewritten act, None if it has under 2 chapters"""
+        act_dict = self.parse_answer('enhance_plot_chapters', 'act', act)
+        return act_dict if len(act_dict['chapters']) >= 2 else None
+
+    @staticmethod
+    def book_spec_2_str(spec_dict):
+        return "\n".join(f"{key}: {value}"
+                         for key, value in spec_dict.items())
+
+    @staticmethod
+    def parse_missing_field(field, missing_part):
+        key, sep, value = missing_part.partition(':')
+        if key.lower().strip() == field.lower().strip():
+            return value.strip()
+        return ''
+
+    def merge_book_spec(self, book_spec, text_spec):
+        """Takes fields of the new spec, falling back to the old ones"""
+        spec_dict_old = self.parse_book_spec(book_spec)
+        spec_dict_new = self.parse_answer(
+            'enhance_book_spec', 'book_spec', text_spec)
+
+        # Check and fill in missing fields
+        for field in self.prompt_engine.book_spec_fields:
+            if not spec_dict_new[field]:
+                spec_dict_new[field] = spec_dict_old[field]
+        return self.book_spec_2_str(spec_dict_new)
 
     def init_book_spec(self, topic):
         """Creates initial book specification
@@ -215,25 +1148,42 @@ class StoryAgent:
         str
             Book specification text
         """
+        return self.run_steps(self.init_book_spec_steps(topic))
+
+    def init_book_spec_steps(self, topic):
+        """Steps of `init_book_spec`"""
         messages = self.prompt_engine.init_book_spec_messages(topic, self.form)
-        text_spec = self.query_chat(messages)
-        spec_dict = self.parse_book_spec(text_spec)
+        text_spec = yield Query(messages, stage='init_book_spec',
+                                schema=self.answer_schema('book_spec'))
+        spec_dict = self.parse_answer('init_book_spec', 'book_spec', text_spec)
 
-        text_spec = "\n".join(f"{key}: {value}"
-                              for key, value in spec_dict.items())
-        # Check and fill in missing fields
-        for field in self.prompt_engine.book_spec_fields:
-            while not spec_dict[field]:
-                messages = self.prompt_engine.missing_book_spec_messages(
-                    field, text_spec)
-                missing_part = self.query_chat(messages)
-                key, sep, value = missing_part.partition(':')
-                if key.lower().strip() == field.lower().strip():
-                    spec_dict[field] = value.strip()
-        text_spec = "\n".join(f"{key}: {value}"
-                              for key, value in spec_dict.items())
+        text_spec = self.book_spec_2_str(spec_dict)
+        # Check and fill in missing fields, all of them are requested
+        # against the same partial spec so they can go out concurrently
+        missing_fields = [field for field in self.prompt_engine.book_spec_fields
+                          if not spec_dict[field]]
+        filled = yield Map(
+            lambda field: self.fill_missing_field_steps(field, text_spec),
+            missing_fields)
+        for field, (messages, value) in zip(missing_fields, filled):
+            spec_dict[field] = value
+        text_spec = self.book_spec_2_str(spec_dict)
         return messages, text_spec
 
+    def fill_missing_field_steps(self, field, text_spec):
+        """Queries the model until it returns a value for the field"""
+        messages = self.prompt_engine.missing_book_spec_messages(
+            field, text_spec)
+        loop = self.retry_tracker.loop('init_book_spec')
+        value = ''
+        # the field is left empty if the budget runs out
+        while not value and loop.next():
+            missing_part = yield Query(
+                messages, refresh=loop.requery, stage='init_book_spec',
+                retry_loop=loop)
+            value = self.parse_missing_field(field, missing_part)
+        return messages, value
+
     def enhance_book_spec(self, book_spec):
         """Make book specification more detailed
 
@@ -249,19 +1199,15 @@ class StoryAgent:
         str
             Book specification text
         """
+        return self.run_steps(self.enhance_book_spec_steps(book_spec))
+
+    def enhance_book_spec_steps(self, book_spec):
+        """Steps of `enhance_book_spec`"""
         messages = self.prompt_engine.enhance_book_spec_messages(
             book_spec, self.form)
-        text_spec = self.query_chat(messages)
-        spec_dict_old = self.parse_book_spec(book_spec)
-        spec_dict_new = self.parse_book_spec(text_spec)
-
-        # Check and fill in missing fields
-        for field in self.prompt_engine.book_spec_fields:
-            if not spec_dict_new[field]:
-                spec_dict_new[field] = spec_dict_old[field]
-
-        text_spec = "\n".join(f"{key}: {value}"
-                              for key, value in spec_dict_new.items())
+        text_spec = yield Query(messages, stage='enhance_book_spec',
+                                schema=self.answer_schema('book_spec'))
+        text_spec = self.merge_book_spec(book_spec, text_spec)
         return messages, text_spec
 
     def create_plot_chapters(self, book_spec):
@@ -276,15 +1222,30 @@ class StoryAgent:
         -------
         List[Dict]
             Used messages for logging
-        dict
-            Dict with book plan
+        Plan
+            Book plan
         """
+        return self.run_steps(self.create_plot_chapters_steps(book_spec))
+
+    def create_plot_chapters_steps(self, book_spec):
+        """Steps of `create_plot_chapters`"""
         messages = self.prompt_engine.create_plot_chapters_messages(book_spec, self.form)
-        plan = []
-        while not plan:
-            text_plan = self.query_chat(messages)
-            if text_plan:
-                plan = Plan.parse_text_plan(text_plan)
+        loop = self.retry_tracker.loop('create_plot_chapters')
+        schema = self.answer_schema('plan')
+        if self.race_samples > 1:
+            plan = yield Race(messages, self.accept_plan,
+                              'create_plot_chapters', loop, schema)
+        else:
+            plan = []
+            while not plan and loop.next():
+                text_plan = yield Query(
+                    messages, refresh=loop.requery,
+                    stage='create_plot_chapters', retry_loop=loop,
+                    schema=schema)
+                plan = self.accept_plan(text_plan)
+        if not plan:
+            raise RetryBudgetExceeded(
+                "No parsable plot outline within the retry budget")
         return messages, plan
 
     def enhance_plot_chapters(self, book_spec, plan):
@@ -294,48 +1255,98 @@ class StoryAgent:
         ----------
         book_spec : str
             Book specification
-        plan : Dict
-            Dict with book plan
+        plan : Plan
+            Book plan, a list of act dicts is converted
 
         Returns
         -------
         List[Dict]
             Used messages for logging
-        dict
-            Dict with updated book plan
+        Plan
+            Updated book plan
         """
+        return self.run_steps(self.enhance_plot_chapters_steps(book_spec, plan))
+
+    def enhance_plot_chapters_steps(self, book_spec, plan):
+        """Steps of `enhance_plot_chapters`"""
+        plan = Plan.wrap(plan)
         text_plan = Plan.plan_2_str(plan)
+        if self.max_in_flight > 1:
+            # Every act is rewritten against the original outline
+            # instead of the one updated by the previous acts
+            all_messages = [
+                self.prompt_engine.enhance_plot_chapters_messages(
+                    act_num, text_plan, book_spec, self.form)
+                for act_num in range(3)]
+            act_dicts = yield Map(self.enhance_act_steps, all_messages)
+            for act_num, act_dict in enumerate(act_dicts):
+                if act_dict is not None:
+                    plan[act_num] = act_dict
+            return all_messages, plan
+
         all_messages = []
         for act_num in range(3):
             messages = self.prompt_engine.enhance_plot_chapters_messages(
                 act_num, text_plan, book_spec, self.form)
-            act = self.query_chat(messages)
-            if act:
-                act_dict = Plan.parse_act(act)
-                while len(act_dict['chapters']) < 2:
-                    act = self.query_chat(messages)
-                    act_dict = Plan.parse_act(act)
-                else:
-                    plan[act_num] = act_dict
+            act_dict = yield from self.enhance_act_steps(messages)
+            if act_dict is not None:
+                plan[act_num] = act_dict
                 text_plan = Plan.plan_2_str(plan)
             all_messages.append(messages)
         return all_messages, plan
 
-    def split_chapters_into_scenes(self, plan):
+    def enhance_act_steps(self, messages):
+        """Queries a rewritten act, None if the backend returned nothing
+
+        An act that does not parse into 2 chapters or more is queried
+        again, or raced with race_samples, until the budget runs out.
+        """
+        loop = self.retry_tracker.loop('enhance_plot_chapters')
+        schema = self.answer_schema('act')
+        if self.race_samples > 1:
+            # the act keeps its previous outline if no answer parses
+            return (yield Race(messages, self.accept_act,
+                               'enhance_plot_chapters', loop, schema))
+        loop.next()
+        act = yield Query(messages, stage='enhance_plot_chapters',
+                          retry_loop=loop, schema=schema)
+        if not act:
+            return None
+        act_dict = self.parse_answer('enhance_plot_chapters', 'act', act)
+        while len(act_dict['chapters']) < 2:
+            if not loop.next():
+                # the act keeps its previous outline
+                return None
+            act = yield Query(messages, refresh=True,
+                              stage='enhance_plot_chapters',
+                              retry_loop=loop, schema=schema)
+            act_dict = self.parse_answer('enhance_plot_chapters', 'act', act)
+        return act_dict
+
+    def split_chapters_into_scenes(self, plan, done_acts={}):
         """Creates a by-scene breakdown of all chapters
 
         Parameters
         ----------
-        plan : Dict
-            Dict with book plan
+        plan : Plan
+            Book plan, a list of act dicts is converted
+        done_acts : Dict[int, Act], optional
+            Acts by number whose breakdown is kept instead of queried,
+            see `done_acts`
 
         Returns
         -------
         List[Dict]
             Used messages for logging
-        dict
-            Dict with updated book plan
+        Plan
+            Updated book plan
         """
+        return self.run_steps(
+            self.split_chapters_into_scenes_steps(plan, done_acts))
+
+    def split_chapters_into_scenes_steps(self, plan, done_acts={}):
+        """Steps of `split_chapters_into_scenes`"""
+        plan = Plan.wrap(plan)
         all_messages = []
         act_chapters = {}
         for i, act in enumerate(plan, start=1):
@@ -343,41 +1354,38 @@ class StoryAgent:
             act_chapters[i] = chs
             messages = self.prompt_engine.split_chapters_into_scenes_messages(
                 i, text_act, self.form)
-            act_scenes = self.query_chat(messages)
-            act['act_scenes'] = act_scenes
             all_messages.append(messages)
 
-        for i, act in enumerate(plan, start=1):
-            act_scenes = act['act_scenes']
-            act_scenes = re.split(r'Chapter (\d+)', act_scenes.strip())
-
-            act['chapter_scenes'] = {}
-            chapters = [text.strip() for text in act_scenes[:]
-                        if (text and text.strip())]
-            current_ch = None
-            merged_chapters = {}
-            for snippet in chapters:
-                if snippet.isnumeric():
-                    ch_num = int(snippet)
-                    if ch_num != current_ch:
-                        current_ch = snippet
-                        merged_chapters[ch_num] = ''
-                    continue
-                if merged_chapters:
-                    merged_chapters[ch_num] += snippet
-            ch_nums = list(merged_chapters.keys()) if len(
-                merged_chapters) <= len(act_chapters[i]) else act_chapters[i]
-            merged_chapters = {ch_num: merged_chapters[ch_num]
-                               for ch_num in ch_nums}
-            for ch_num, chapter in merged_chapters.items():
-                scenes = re.split(r'Scene \d+.{0,10}?:', chapter)
-                scenes = [text.strip() for text in scenes[1:]
-                          if (text and (len(text.split()) > 3))]
-                if not scenes:
-                    continue
-                act['chapter_scenes'][ch_num] = scenes
+        # acts are independent, so they can be queried concurrently
+        act_nums = [i for i in act_chapters if i not in done_acts]
+        all_act_scenes = yield Map(
+            lambda i: self.query_act_scenes_steps(all_messages[i - 1],
+                                                  act_chapters[i]),
+            act_nums)
+        for i, act_scenes in zip(act_nums, all_act_scenes):
+            act = plan[i - 1]
+            act['act_scenes'] = act_scenes
+            act['chapter_scenes'] = self.parse_answer(
+                'split_chapters_into_scenes', 'act_scenes',
+                act['act_scenes'], act_chapters[i])
+        for i, act in done_acts.items():
+            plan[i - 1] = act
         return all_messages, plan
 
+    def query_act_scenes_steps(self, messages, act_chapters):
+        """Queries the by-scene breakdown of the act chapters"""
+        schema = self.answer_schema('act_scenes', act_chapters)
+        # the schema already keeps the answer to the chapters of the act
+        validators = [ActChapterScope(act_chapters)] if schema is None else []
+        return (yield Query(
+            messages, stage='split_chapters_into_scenes',
+            validators=validators, schema=schema))
+
+    @staticmethod
+    def parse_act_scenes(act_scenes, act_chapters):
+        """Splits by-scene breakdown of an act into {chapter: [scenes]}"""
+        return parsing.parse_act_scenes(act_scenes, act_chapters).value
+
     @staticmethod
     def prepare_scene_text(text):
         lines = text.split('\n')
@@ -401,6 +1409,46 @@ class StoryAgent:
         text = '\n'.join(lines)
         return text
 
+    def count_prompt_tokens(self, messages):
+        return self.token_counter.count_parts(generate_prompt_parts(messages))
+
+    def scene_messages(self, scene, sc_num, ch_num, plan, snippet, intro):
+        """Builds scene prompt with an optional cropped text snippet
+
+        The plan, the snippet and as a last resort the scene spec are
+        narrowed until the prompt leaves min_scene_tokens for the scene,
+        see `SceneContext`. The snippet is a text or a `utils.RollingTail`
+        of it.
+
+        Raises
+        ------
+        SceneContextOverflow
+            If no prompt of the scene leaves min_scene_tokens
+        """
+        plan = Plan.wrap(plan)
+        if isinstance(snippet, str):
+            snippet = utils.RollingTail(self.n_crop_previous, snippet)
+
+        def build(details, n_words, spec_words=None):
+            text_plan = Plan.plan_2_str(plan, details)
+            spec = scene if spec_words is None \
+                else utils.keep_first_n_words(scene, spec_words)
+            if self.prompt_cache:
+                messages = self.prompt_engine.scene_messages(
+                    spec, sc_num, ch_num, text_plan, self.form,
+                    plan_first=True)
+            else:
+                messages = self.prompt_engine.scene_messages(
+                    spec, sc_num, ch_num, text_plan, self.form)
+            if snippet and n_words:
+                messages[1]['content'] += (
+                    f'{intro}\"\"\"{snippet.text(n_words)}\"\"\"')
+            return messages
+
+        messages, _ = self.scene_context.assemble(
+            build, plan, ch_num, self.n_crop_previous, len(scene.split()))
+        return messages
+
     def write_a_scene(
             self, scene, sc_num, ch_num, plan, previous_scene=None):
         """Generates a scene text for a form
@@ -413,10 +1461,10 @@ class StoryAgent:
             Scene number
         ch_num : int
             Chapter number
-        plan : Dict
-            Dict with book plan
-        previous_scene : str, optional
-            Previous scene text, by default None
+        plan : Plan
+            Book plan, a list of act dicts is converted
+        previous_scene : str or utils.RollingTail, optional
+            Previous scene text or its tail, by default None
 
         Returns
         -------
@@ -425,16 +1473,29 @@ class StoryAgent:
         str
             Generated scene text
         """
-        text_plan = Plan.plan_2_str(plan)
-        messages = self.prompt_engine.scene_messages(
-            scene, sc_num, ch_num, text_plan, self.form)
-        if previous_scene:
-            previous_scene = utils.keep_last_n_words(previous_scene,
-                                                     n=self.n_crop_previous)
-            messages[1]['content'] += f'{self.prompt_engine.prev_scene_intro}\"\"\"{previous_scene}\"\"\"'
-        generated_scene = self.query_chat(messages)
+        return self.run_steps(self.scene_steps(
+            scene, sc_num, ch_num, plan, previous_scene,
+            self.prompt_engine.prev_scene_intro))
+
+    def scene_steps(self, scene, sc_num, ch_num, plan, snippet, intro):
+        """Steps of a scene prompt from `scene_messages` and its text"""
+        messages = self.scene_messages(
+            scene, sc_num, ch_num, plan, snippet, intro)
+        return messages, (yield from self.query_scene_steps(messages))
+
+    def query_scene_steps(self, messages):
+        """Scene text generated from assembled scene messages
+
+        Raises RuntimeError if no scene text came back, e.g. when the
+        backend failed after its retries, so that a failed scene is never
+        saved to a checkpoint as written.
+        """
+        generated_scene = yield Query(
+            messages, stage='write_scenes', validators=[next_scene_heading])
         generated_scene = self.prepare_scene_text(generated_scene)
-        return messages, generated_scene
+        if not generated_scene.strip():
+            raise RuntimeError("Scene query returned no text")
+        return generated_scene
 
     def continue_a_scene(self, scene, sc_num, ch_num,
                          plan, current_scene=None):
@@ -448,10 +1509,11 @@ class StoryAgent:
             Scene number
         ch_num : int
             Chapter number
-        plan : Dict
-            Dict with book plan
-        current_scene : str, optional
-            Text of the current scene so far, by default None
+        plan : Plan
+            Book plan, a list of act dicts is converted
+        current_scene : str or utils.RollingTail, optional
+            Text of the current scene so far or a tail updated as the
+            scene grows, by default None
 
         Returns
         -------
@@ -460,34 +1522,334 @@ class StoryAgent:
         str
             Generated scene continuation text
         """
-        text_plan = Plan.plan_2_str(plan)
-        messages = self.prompt_engine.scene_messages(
-            scene, sc_num, ch_num, text_plan, self.form)
-        if current_scene:
-            current_scene = utils.keep_last_n_words(current_scene,
-                                                    n=self.n_crop_previous)
-            messages[1]['content'] += f'{self.prompt_engine.cur_scene_intro}\"\"\"{current_scene}\"\"\"'
-        generated_scene = self.query_chat(messages)
-        generated_scene = self.prepare_scene_text(generated_scene)
-        return messages, generated_scene
-
-    def generate_story(self, topic):
-        """Example pipeline for a novel creation"""
-        _, book_spec = self.init_book_spec(topic)
-        _, book_spec = self.enhance_book_spec(book_spec)
-        _, plan = self.create_plot_chapters(book_spec)
-        _, plan = self.enhance_plot_chapters(book_spec, plan)
-        _, plan = self.split_chapters_into_scenes(plan)
-
-        form_text = []
-        for act in plan:
-            for ch_num, chapter in act['chapter_scenes'].items():
-                sc_num = 1
-                for scene in chapter:
-                    previous_scene = form_text[-1] if form_text else None
-                    _, generated_scene = self.write_a_scene(
-                        scene, sc_num, ch_num, plan,
-                        previous_scene=previous_scene)
-                    form_text.append(generated_scene)
-                    sc_num += 1
-        return form_text
+        return self.run_steps(self.scene_steps(
+            scene, sc_num, ch_num, plan, current_scene,
+            self.prompt_engine.cur_scene_intro))
+
+    def input_fingerprint(self, stage, *inputs):
+        """Fingerprint of the inputs of a stage or a scene
+
+        Besides inputs it covers the prompt engine version, the form, the
+        backend, max_tokens and the generation options of the stage, and
+        structured mode for the planning stages.
+        """
+        settings = [getattr(self.prompt_engine, 'version', None), self.form,
+                    self.backend, self.max_tokens,
+                    self.stop_options(self.stage_options(stage))]
+        if stage != 'write_scenes':
+            settings.append(self.structured)
+        return fingerprint(stage, settings, *inputs)
+
+    def act_fingerprints(self, plan):
+        """Input fingerprints of the by-scene breakdowns of the acts"""
+        plan = Plan.wrap(plan)
+        return [self.input_fingerprint('split_chapters_into_scenes',
+                                       *Plan.act_2_str(plan, act_num))
+                for act_num in range(1, len(plan) + 1)]
+
+    def scene_fingerprint(self, messages):
+        """Input fingerprint of a scene from its assembled prompt
+
+        The prompt holds the plan text and the previous scene tail exactly
+        as narrowed to fit the context, see `scene_messages`.
+        """
+        return self.input_fingerprint('write_scenes', messages)
+
+    @staticmethod
+    def done_acts(checkpoint, fingerprints):
+        """Acts of the saved by-scene breakdown made from the same inputs
+
+        Parameters
+        ----------
+        checkpoint : RunCheckpoint, optional
+            Run the breakdown was saved to
+        fingerprints : List[str]
+            Current `act_fingerprints` of the plan
+
+        Returns
+        -------
+        Dict[int, Act]
+            Saved acts by number
+        """
+        stage = 'split_chapters_into_scenes'
+        if checkpoint is None or not checkpoint.has_stage(stage):
+            return {}
+        saved = checkpoint.stage_fingerprint(stage) or []
+        plan = checkpoint.load_stage(stage)
+        return {act_num: plan[act_num - 1]
+                for act_num, (old, new)
+                in enumerate(zip(saved, fingerprints), start=1)
+                if old == new and act_num <= len(plan)}
+
+    def stage_steps(self, checkpoint, stage, steps, fingerprint=None,
+                    recompute=False):
+        """Runs a pipeline stage or loads its output from the checkpoint
+
+        steps() makes the steps of the stage. The output is saved with the
+        fingerprint of its inputs. With recompute a saved output is only
+        loaded if that fingerprint is the same.
+        """
+        resumed = checkpoint is not None and checkpoint.has_stage(stage) and (
+            not recompute
+            or checkpoint.stage_fingerprint(stage) == fingerprint)
+        with self.metrics.track_stage(self.story_id, stage, resumed=resumed):
+            if resumed:
+                return checkpoint.load_stage(stage)
+            _, output = yield from steps()
+        if checkpoint is not None:
+            checkpoint.save_stage(stage, output, fingerprint)
+        return output
+
+    def generate_story(self, topic, run_id=None, run_dir='runs'):
+        """Example pipeline for a novel creation
+
+        With run_id set, every stage output and finished scene is saved to
+        run_dir/run_id, and a restarted run with the same run_id continues
+        from the last completed step.
+        """
+        return self.run_steps(self.story_steps(topic, run_id, run_dir))
+
+    def story_steps(self, topic, run_id=None, run_dir='runs'):
+        """Steps of `generate_story`"""
+        checkpoint = None
+        if run_id is not None:
+            checkpoint = RunCheckpoint(run_dir, run_id)
+            checkpoint.check_topic(topic)
+        return (yield from self.pipeline_steps(topic, checkpoint))
+
+    def recompute(self, run_id, run_dir='runs'):
+        """Updates a saved run, regenerating only what its edits changed
+
+        Saved stage outputs and scenes are kept if they were made from the
+        current inputs, by the fingerprints saved with them. Editing a
+        saved stage output, e.g. a chapter of enhance_plot_chapters.json,
+        keeps the edit and regenerates the by-scene breakdowns of the acts
+        it changed, their scenes and the scenes after them in their
+        chains. Changed generation options or prompts regenerate what was
+        made with them, e.g. all scenes for new scene_extra_options.
+
+        Parameters
+        ----------
+        run_id : str
+            Run of `generate_story`
+        run_dir : str
+            Directory of the runs
+
+        Returns
+        -------
+        List[str]
+            Scene texts in story order
+        """
+        return self.run_steps(self.recompute_steps(run_id, run_dir))
+
+    def recompute_steps(self, run_id, run_dir='runs'):
+        """Steps of `recompute`"""
+        checkpoint = RunCheckpoint(run_dir, run_id)
+        return (yield from self.pipeline_steps(
+            checkpoint.load_topic(), checkpoint, recompute=True))
+
+    def pipeline_steps(self, topic, checkpoint=None, recompute=False):
+        """Steps of all stages of `generate_story`, see `recompute`"""
+        self.retry_tracker.reset()
+        self.progress = 0.0
+
+        book_spec = yield from self.stage_steps(
+            checkpoint, 'init_book_spec',
+            lambda: self.init_book_spec_steps(topic),
+            self.input_fingerprint('init_book_spec', topic), recompute)
+        book_spec = yield from self.stage_steps(
+            checkpoint, 'enhance_book_spec',
+            lambda: self.enhance_book_spec_steps(book_spec),
+            self.input_fingerprint('enhance_book_spec', book_spec), recompute)
+        plan = yield from self.stage_steps(
+            checkpoint, 'create_plot_chapters',
+            lambda: self.create_plot_chapters_steps(book_spec),
+            self.input_fingerprint('create_plot_chapters', book_spec),
+            recompute)
+        plan = yield from self.stage_steps(
+            checkpoint, 'enhance_plot_chapters',
+            lambda: self.enhance_plot_chapters_steps(book_spec, plan),
+            self.input_fingerprint('enhance_plot_chapters', book_spec,
+                                   Plan.wrap(plan).to_json()), recompute)
+        act_fingerprints = self.act_fingerprints(plan)
+        plan = yield from self.stage_steps(
+            checkpoint, 'split_chapters_into_scenes',
+            lambda: self.split_chapters_into_scenes_steps(
+                plan, self.done_acts(checkpoint, act_fingerprints)),
+            act_fingerprints, recompute)
+
+        done_scenes = checkpoint.load_scenes() if checkpoint else []
+        scenes = yield from self.write_scenes_steps(
+            plan, done_scenes, checkpoint, recompute)
+        if recompute:
+            checkpoint.compact_scenes(
+                [key[:3] for key in Plan.wrap(plan).scenes()])
+        return scenes
+
+    def scene_chains(self, plan):
+        """Splits scenes into chains according to scene_dependency
+
+        Every scene gets the previous scene of its chain as context, the
+        first scene of a chain is written from its description only.
+
+        Returns
+        -------
+        List[List[Tuple]]
+            Chains of (act_num, ch_num, sc_num, scene) in story order
+        """
+        chains = []
+        for act_num, ch_num, sc_num, scene in Plan.wrap(plan).scenes():
+            new_chain = (
+                not chains
+                or (self.scene_dependency == 'chapter' and sc_num == 1)
+                or (self.scene_dependency == 'act'
+                    and chains[-1][-1][0] != act_num))
+            if new_chain:
+                chains.append([])
+            chains[-1].append((act_num, ch_num, sc_num, scene))
+        return chains
+
+    def scene_done(self, n_scenes):
+        """Advances progress by one of the n_scenes scenes of the story"""
+        with self._usage_lock:
+            self.progress = min(self.progress + 1 / n_scenes, 1.0)
+
+    def write_scenes(self, plan, done_scenes=[], checkpoint=None,
+                     recompute=False):
+        """Writes all scenes of the plan, up to scene_parallelism chains at once
+
+        Parameters
+        ----------
+        plan : Plan
+            Book plan, a list of act dicts is converted
+        done_scenes : List[Dict], optional
+            Finished scene records from a checkpoint, they are not rewritten
+        checkpoint : RunCheckpoint, optional
+            Run checkpoint to append finished scenes to
+        recompute : bool
+            Rewrite the done scenes whose fingerprint differs, see
+            `recompute`
+
+        Returns
+        -------
+        List[str]
+            Scene texts in story order
+        """
+        return self.run_steps(self.write_scenes_steps(
+            plan, done_scenes, checkpoint, recompute))
+
+    def write_scenes_steps(self, plan, done_scenes=[], checkpoint=None,
+                           recompute=False):
+        """Steps of `write_scenes`"""
+        plan = Plan.wrap(plan)
+        done = {(record.get('act_num'), record['ch_num'], record['sc_num']):
+                record for record in done_scenes}
+        chains = self.scene_chains(plan)
+        n_scenes = sum(map(len, chains))
+
+        def write_chain(chain):
+            texts = []
+            previous_tail = utils.RollingTail(self.n_crop_previous)
+            for act_num, ch_num, sc_num, scene in chain:
+                record = done.get((act_num, ch_num, sc_num))
+                if record is not None and not recompute:
+                    generated_scene = record['text']
+                else:
+                    messages = self.scene_messages(
+                        scene, sc_num, ch_num, plan, previous_tail,
+                        self.prompt_engine.prev_scene_intro)
+                    fingerprint = self.scene_fingerprint(messages)
+                    if (record is not None
+                            and record.get('fingerprint') == fingerprint):
+                        generated_scene = record['text']
+                    else:
+                        generated_scene = yield from self.query_scene_steps(
+                            messages)
+                        if checkpoint is not None:
+                            checkpoint.append_scene(
+                                act_num, ch_num, sc_num, generated_scene,
+                                fingerprint)
+                texts.append(generated_scene)
+                previous_tail.reset(generated_scene)
+                self.scene_done(n_scenes)
+            return texts
+
+        with self.metrics.track_stage(self.story_id, 'write_scenes'):
+            chain_texts = yield Map(write_chain, chains,
+                                    max_workers=self.scene_parallelism)
+        return [text for texts in chain_texts for text in texts]
+
+    def stream_story(self, topic):
+        """Generates a story like `generate_story`, yielding progress events
+
+        Scene text is streamed token by token from the backend, only the
+        previous scene is kept in memory.
+
+        Parameters
+        ----------
+        topic : str
+            Short initial topic
+
+        Yields
+        ------
+        StageFinished
+            After each planning stage, with its output
+        SceneStarted
+            Before a scene is requested, with its description
+        TokenDelta
+            For every piece of generated scene text
+        SceneFinished
+            With the final scene text, as `write_a_scene` returns it
+        """
+        return self.iter_steps(self.stream_story_steps(topic))
+
+    def stream_story_steps(self, topic):
+        """Steps of `stream_story`"""
+        self.retry_tracker.reset()
+        self.progress = 0.0
+        book_spec = yield from self.stage_steps(
+            None, 'init_book_spec', lambda: self.init_book_spec_steps(topic))
+        yield Emit(StageFinished('init_book_spec', book_spec))
+        book_spec = yield from self.stage_steps(
+            None, 'enhance_book_spec',
+            lambda: self.enhance_book_spec_steps(book_spec))
+        yield Emit(StageFinished('enhance_book_spec', book_spec))
+        plan = yield from self.stage_steps(
+            None, 'create_plot_chapters',
+            lambda: self.create_plot_chapters_steps(book_spec))
+        yield Emit(StageFinished('create_plot_chapters', plan))
+        plan = yield from self.stage_steps(
+            None, 'enhance_plot_chapters',
+            lambda: self.enhance_plot_chapters_steps(book_spec, plan))
+        yield Emit(StageFinished('enhance_plot_chapters', plan))
+        plan = yield from self.stage_steps(
+            None, 'split_chapters_into_scenes',
+            lambda: self.split_chapters_into_scenes_steps(plan))
+        yield Emit(StageFinished('split_chapters_into_scenes', plan))
+
+        with self.metrics.track_stage(self.story_id, 'write_scenes'):
+            yield from self.stream_scenes_steps(plan)
+
+    def stream_scenes_steps(self, plan):
+        """Steps streaming the scenes of the plan one after another
+
+        Every scene gets the tail of the previous one as context, whatever
+        the scene_dependency, and progress advances as each is finished.
+        """
+        plan = Plan.wrap(plan)
+        previous_tail = utils.RollingTail(self.n_crop_previous)
+        scenes = list(plan.scenes())
+        for act_num, ch_num, sc_num, scene in scenes:
+            yield Emit(SceneStarted(act_num, ch_num, sc_num, scene))
+            messages = self.scene_messages(
+                scene, sc_num, ch_num, plan, previous_tail,
+                self.prompt_engine.prev_scene_intro)
+            generated_scene = yield Stream(
+                messages, functools.partial(TokenDelta, act_num, ch_num,
+                                            sc_num),
+                stage='write_scenes', validators=[next_scene_heading])
+            generated_scene = self.prepare_scene_text(generated_scene)
+            self.scene_done(len(scenes))
+            yield Emit(SceneFinished(act_num, ch_num, sc_num,
+                                     generated_scene))
+            previous_tail.reset(generated_scene)
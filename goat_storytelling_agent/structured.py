@@ -0,0 +1,76 @@
+"""JSON schemas constraining the answers of the planning stages.
+
+In structured mode the book spec, the plot outline, the rewritten acts
+and the scene breakdowns are generated under a JSON schema that the
+backend compiles into a grammar: `json_schema` of the llama.cpp
+/completion endpoint, the `grammar` parameter of TGI and `response_format`
+of OpenAI-compatible servers. The answers then always have the shape that
+the `parsing.parse_json_*` parsers read into the plan, instead of free
+text that may not parse and is queried again.
+"""
+import json
+
+
+SCHEMA_NOTE = "\nAnswer with a JSON object following this schema:\n"
+
+
+def _strings(fields):
+    return {field: {'type': 'string', 'minLength': 1} for field in fields}
+
+
+def _object(properties):
+    return {'type': 'object', 'properties': properties,
+            'required': list(properties), 'additionalProperties': False}
+
+
+def book_spec_schema(fields):
+    """Object with a non-empty string per book spec field"""
+    return _object(_strings(fields))
+
+
+def act_schema(min_chapters=2):
+    """Act description and its chapter outlines"""
+    return _object({
+        'description': {'type': 'string', 'minLength': 1},
+        'chapters': {'type': 'array', 'minItems': min_chapters,
+                     'items': {'type': 'string', 'minLength': 1}}})
+
+
+def plan_schema(n_acts=3, min_chapters=2):
+    """By-chapter outline of n_acts acts"""
+    return _object({
+        'acts': {'type': 'array', 'minItems': n_acts, 'maxItems': n_acts,
+                 'items': act_schema(min_chapters)}})
+
+
+def act_scenes_schema(act_chapters, scene_fields):
+    """Scene specs of every chapter of an act, keyed 'Chapter <number>'"""
+    scene = _object(_strings(scene_fields))
+    return _object({f'Chapter {ch_num}': {'type': 'array', 'minItems': 1,
+                                          'items': scene}
+                    for ch_num in act_chapters})
+
+
+def schema_options(backend, schema):
+    """Generation options asking the backend to follow the schema"""
+    if backend == 'llama.cpp':
+        return {'json_schema': schema}
+    if backend == 'hf':
+        return {'grammar': {'type': 'json', 'value': schema}}
+    return {'response_format': {
+        'type': 'json_schema',
+        'json_schema': {'name': 'answer', 'schema': schema}}}
+
+
+def schema_messages(messages, schema):
+    """Messages with the schema appended to the last user message
+
+    The grammar only constrains the tokens, the model is told the format
+    as well so that it does not fight it.
+    """
+    messages = [dict(message) for message in messages]
+    for message in reversed(messages):
+        if message['role'] == 'user':
+            message['content'] += SCHEMA_NOTE + json.dumps(schema)
+            break
+    return messages
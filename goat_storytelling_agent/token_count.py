@@ -0,0 +1,142 @@
+"""Token counting used to size the completion budget of a request.
+
+Prompts are counted part by part (system prompt, every message) and the
+count of each part is memoized, so the parts repeated between calls, like
+the system prompt and the plan, are only tokenized once.
+"""
+import math
+import json
+import threading
+from collections import OrderedDict
+
+import requests
+
+from goat_storytelling_agent.transport import EndpointPool
+
+
+class TokenCounter:
+    def __init__(self, max_memo_entries=4096):
+        self.max_memo_entries = max_memo_entries
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, text):
+        """Number of tokens in text without special tokens"""
+        raise NotImplementedError
+
+    def count_cached(self, text):
+        with self._lock:
+            if text in self._memo:
+                self._memo.move_to_end(text)
+                return self._memo[text]
+        n_tokens = self.count(text)
+        with self._lock:
+            self._memo[text] = n_tokens
+            while len(self._memo) > self.max_memo_entries:
+                self._memo.popitem(last=False)
+        return n_tokens
+
+    def count_parts(self, prompt_parts):
+        """Number of tokens in a prompt built from parts, with BOS token"""
+        return 1 + sum(self.count_cached(part) for part in prompt_parts)
+
+
+class EstimateTokenCounter(TokenCounter):
+    """Cheap estimate from text length, no tokenizer needed
+
+    The default ratio slightly overestimates Llama tokenization of English
+    prose, so that the completion budget stays within the context window.
+    """
+    def __init__(self, chars_per_token=3.5, max_memo_entries=0):
+        super().__init__(max_memo_entries=max_memo_entries)
+        self.chars_per_token = chars_per_token
+
+    def count(self, text):
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def count_cached(self, text):
+        return self.count(text)
+
+
+class HFTokenCounter(TokenCounter):
+    """Counts with a `transformers` tokenizer loaded on first use
+
+    Parameters
+    ----------
+    name_or_path : str
+        Local tokenizer directory or hub model id
+    local_files_only : bool
+        Do not try to download the tokenizer
+    """
+    def __init__(self, name_or_path, local_files_only=False,
+                 max_memo_entries=4096):
+        super().__init__(max_memo_entries=max_memo_entries)
+        self.name_or_path = name_or_path
+        self.local_files_only = local_files_only
+        self._tokenizer = None
+        self._load_lock = threading.Lock()
+
+    @property
+    def tokenizer(self):
+        with self._load_lock:
+            if self._tokenizer is None:
+                from transformers import AutoTokenizer
+                self._tokenizer = AutoTokenizer.from_pretrained(
+                    self.name_or_path, local_files_only=self.local_files_only)
+        return self._tokenizer
+
+    def count(self, text):
+        return len(self.tokenizer(text, add_special_tokens=False,
+                                  truncation=False)['input_ids'])
+
+
+class ServerTokenCounter(TokenCounter):
+    """Counts with the /tokenize endpoint of a llama.cpp server
+
+    Exact but costs a round trip, so the whole prompt is counted in one
+    request and memoized as a unit, e.g. for re-queries of the same prompt.
+    """
+    def __init__(self, endpoint, transport=None, request_timeout=120,
+                 max_memo_entries=4096):
+        super().__init__(max_memo_entries=max_memo_entries)
+        self.endpoints = EndpointPool.wrap(endpoint)
+        self.transport = transport
+        self.request_timeout = request_timeout
+
+    def count(self, text):
+        post = (self.transport.post if self.transport is not None
+                else requests.post)
+        response = self.endpoints.post(
+            post, "/tokenize", headers={'Content-Type': 'application/json'},
+            data=json.dumps({"content": text}), timeout=self.request_timeout)
+        return len(response.json()["tokens"])
+
+    def count_parts(self, prompt_parts):
+        return 1 + self.count_cached(''.join(prompt_parts))
+
+
+def make_token_counter(token_counter, backend, endpoint,
+                       transport=None, request_timeout=120):
+    """Builds a counter from the StoryAgent token_counter option
+
+    Parameters
+    ----------
+    token_counter : str or TokenCounter or None
+        'estimate', 'server' (llama.cpp only), a tokenizer path or hub id,
+        or a ready counter. None picks the default of the backend: the
+        lazily loaded model tokenizer for hf, the estimate for llama.cpp
+        and openai.
+    """
+    if isinstance(token_counter, TokenCounter):
+        return token_counter
+    if token_counter is None:
+        token_counter = ("GOAT-AI/GOAT-70B-Storytelling" if backend == "hf"
+                         else "estimate")
+    if token_counter == "estimate":
+        return EstimateTokenCounter()
+    if token_counter == "server":
+        if backend != "llama.cpp":
+            raise ValueError("Server token counting needs llama.cpp backend")
+        return ServerTokenCounter(endpoint, transport=transport,
+                                  request_timeout=request_timeout)
+    return HFTokenCounter(token_counter)
@@ -0,0 +1,330 @@
+"""Recording and timed replay of the backend traffic of story generation.
+
+A `TrafficRecorder` passed as `StoryAgent(recorder=...)` appends every
+chat call of the agent to a JSONL trace, one JSON object per line:
+    story_id, stage, start (unix time), wall_time, queue_time, ttft,
+    prompt_tokens, completion_tokens, attempts, retries, requery,
+    cache_hit, ok, early_stop (as the call records of `Metrics`), backend,
+    options (generation options sent), prompt_hash, response_chars and,
+    unless recorded with content=False, messages and response
+
+A `TrafficReplayer` sends the calls of a trace to a backend at their
+recorded offsets, at the original rate or sped up, with a cap on the calls
+in flight, and reports the throughput and latency percentiles next to
+the recorded ones. Calls are replayed through a `StoryAgent`, so request
+limiters, prompt caching and the response cache of the agent can be tried
+on the recorded workload. Calls recorded without content are replayed
+with synthetic prompts of the recorded length.
+
+Usage: python -m goat_storytelling_agent.traffic trace.jsonl --backend-uri URL
+       python -m goat_storytelling_agent.traffic trace.jsonl --mock --slots 4
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from goat_storytelling_agent.checkpoint import fingerprint
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.storytelling_agent import (
+    StoryAgent, SUPPORTED_BACKENDS, generate_prompt_parts)
+
+
+PERCENTILES = (50, 90, 99)
+_FILLER_WORDS = ("river map camp rain night trail boat forest shadow fire "
+                 "water stone path light voice hand mud jungle old").split()
+
+
+class TrafficRecorder:
+    """Appends the chat calls of one or more agents to a JSONL trace
+
+    Parameters
+    ----------
+    fpath : str
+        Trace file, appended to
+    content : bool
+        Keep the messages and responses, otherwise only the prompt hash
+        and the sizes are written
+    """
+    def __init__(self, fpath, content=True):
+        self.fpath = fpath
+        self.content = content
+        self._lock = threading.Lock()
+
+    def record(self, call, backend, messages, options, response):
+        record = {
+            **call, 'backend': backend, 'options': options,
+            'prompt_hash': fingerprint(
+                ''.join(generate_prompt_parts(messages))),
+            'response_chars': len(response or '')}
+        if self.content:
+            record['messages'] = messages
+            record['response'] = response
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.fpath, 'a') as fp:
+                fp.write(line)
+
+
+def load_trace(fpath):
+    """Recorded calls of a trace file in the order of their start"""
+    with open(fpath) as fp:
+        calls = [json.loads(line) for line in fp if line.strip()]
+    return sorted(calls, key=lambda call: call['start'])
+
+
+def percentiles(values, points=PERCENTILES):
+    """Nearest-rank percentiles and the max of values, None if empty"""
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    stats = {f'p{point}': values[min(len(values) - 1,
+                                     int(len(values) * point / 100))]
+             for point in points}
+    stats['max'] = values[-1]
+    return stats
+
+
+def synthetic_messages(call, token_counter):
+    """Stand-in messages for a call recorded without content
+
+    The prompt has about the recorded number of tokens, calls with the
+    same prompt hash get the same prompt.
+    """
+    n_tokens = max(call['prompt_tokens'], 1)
+    words = random.Random(call['prompt_hash']).choices(
+        _FILLER_WORDS, k=2 * n_tokens)
+
+    def messages(n_words):
+        return [{'role': 'user', 'content': ' '.join(words[:n_words])}]
+    # scaled once to the token counter of the replaying agent
+    n_counted = token_counter.count_parts(
+        generate_prompt_parts(messages(n_tokens)))
+    return messages(max(n_tokens * n_tokens // max(n_counted, 1), 1))
+
+
+class TrafficReplayer:
+    """Sends the calls of a trace to a backend on the recorded schedule
+
+    Parameters
+    ----------
+    backend_uri : str or List[str]
+        Backend endpoint or replicas, as for `StoryAgent`
+    speed : float
+        Rate of the replay relative to the recording, 2 sends the calls
+        twice as fast, 0 sends them all at once
+    concurrency : int
+        Max number of calls in flight, calls due while all are busy wait
+        and the wait counts into their latency
+    cache_hits : bool
+        Also replay the calls that the response cache answered when they
+        were recorded
+    recorded_options : bool
+        Send the recorded generation options, otherwise those of the stages
+        of the replaying agent. Options recorded for another backend are
+        never sent.
+    agent_kwargs : Dict
+        `StoryAgent` arguments, e.g. backend, request_limiter, cache and
+        prompt_cache. The backend defaults to that of the trace.
+    """
+    def __init__(self, backend_uri, speed=1.0, concurrency=8,
+                 cache_hits=False, recorded_options=True, agent_kwargs={}):
+        self.backend_uri = backend_uri
+        self.speed = speed
+        self.concurrency = concurrency
+        self.cache_hits = cache_hits
+        self.recorded_options = recorded_options
+        self.agent_kwargs = agent_kwargs
+
+    def make_agent(self, backend):
+        return StoryAgent(self.backend_uri, **{
+            'backend': backend, 'logger': AgentLogger(),
+            'pool_size': self.concurrency, **self.agent_kwargs})
+
+    def replay(self, trace):
+        """Replays the recorded calls and waits for all of them
+
+        Parameters
+        ----------
+        trace : List[Dict]
+            Recorded calls, see `load_trace`
+
+        Returns
+        -------
+        Dict
+            Throughput and latency report of the replay and the recording
+        """
+        calls = [call for call in trace
+                 if self.cache_hits or not call['cache_hit']]
+        if not calls:
+            raise ValueError("No calls to replay")
+        calls.sort(key=lambda call: call['start'])
+        agent = self.make_agent(calls[0]['backend'])
+        first = calls[0]['start']
+        begin = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                futures = []
+                for call in calls:
+                    offset = ((call['start'] - first) / self.speed
+                              if self.speed else 0.0)
+                    delay = begin + offset - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    futures.append(pool.submit(
+                        self.send, agent, call, begin + offset))
+                results = [future.result() for future in futures]
+        finally:
+            agent.transport.close()
+        return self.report(calls, results, time.monotonic() - begin)
+
+    def send(self, agent, call, scheduled):
+        """Sends one recorded call, scheduled is its monotonic due time"""
+        start = time.monotonic()
+        stage = call['stage']
+        messages = call.get('messages') or synthetic_messages(
+            call, agent.token_counter)
+        result = {'stage': stage, 'lag': start - scheduled, 'ttft': None,
+                  'completion_tokens': 0, 'cache_hit': False}
+        key = agent.cache_key(messages, stage=stage)
+        if key is not None and agent.cache.get(key) is not None:
+            result.update(cache_hit=True, ok=True,
+                          latency=time.monotonic() - scheduled)
+            return result
+        if self.recorded_options and call['backend'] == agent.backend:
+            options = call['options']
+        else:
+            options = agent.backend_options(stage=stage)
+        # the same number of tokens is generated as recorded
+        max_tokens = None
+        if call['completion_tokens']:
+            max_tokens = (agent.count_prompt_tokens(messages)
+                          + call['completion_tokens'])
+        call_stats = {}
+        try:
+            response = agent.query_backend(
+                messages, call_stats=call_stats, stage=stage,
+                options=options, max_tokens=max_tokens)
+        except Exception as exc:
+            agent.logger.error(f"Replayed call failed: {exc!r}")
+            response = ''
+        if key is not None and response:
+            agent.cache.put(key, response)
+        result.update(ok=bool(response),
+                      latency=time.monotonic() - scheduled,
+                      ttft=call_stats.get('ttft'),
+                      completion_tokens=call_stats.get('completion_tokens', 0))
+        return result
+
+    def report(self, calls, results, elapsed):
+        sent = [result for result in results if not result['cache_hit']]
+        n_tokens = sum(result['completion_tokens'] for result in results)
+        recorded_elapsed = max(call['start'] + call['wall_time']
+                               for call in calls) - calls[0]['start']
+        stages = {}
+        for result in results:
+            stages.setdefault(result['stage'] or '', []).append(result)
+        return {
+            'calls': len(results),
+            'ok': sum(result['ok'] for result in results),
+            'failed': sum(not result['ok'] for result in results),
+            'cache_hits': len(results) - len(sent),
+            'speed': self.speed,
+            'concurrency': self.concurrency,
+            'elapsed': elapsed,
+            'requests_per_second': len(sent) / elapsed if elapsed else 0.0,
+            'completion_tokens': n_tokens,
+            'tokens_per_second': n_tokens / elapsed if elapsed else 0.0,
+            'latency': percentiles(result['latency'] for result in results),
+            'ttft': percentiles(result['ttft'] for result in sent),
+            'lag': percentiles(result['lag'] for result in results),
+            'stages': {
+                stage: {'calls': len(stage_results),
+                        'latency': percentiles(result['latency']
+                                               for result in stage_results)}
+                for stage, stage_results in sorted(stages.items())},
+            'recorded': {
+                'elapsed': recorded_elapsed,
+                'completion_tokens': sum(call['completion_tokens']
+                                         for call in calls),
+                'latency': percentiles(call['wall_time'] for call in calls),
+                'ttft': percentiles(call['ttft'] for call in calls),
+            },
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded backend traffic trace")
+    parser.add_argument('trace', help="JSONL trace of a TrafficRecorder")
+    parser.add_argument('--backend-uri', action='append',
+                        help="backend endpoint, repeat for replicas")
+    parser.add_argument('--backend', default=None, choices=SUPPORTED_BACKENDS,
+                        help="defaults to the backend of the trace")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="replay rate relative to the recording, "
+                             "0 sends all calls at once")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="calls in flight at most")
+    parser.add_argument('--cache-hits', action='store_true',
+                        help="also replay calls answered from the cache")
+    parser.add_argument('--stage-options', action='store_true',
+                        help="send the generation options of the agent "
+                             "instead of the recorded ones")
+    parser.add_argument('--prompt-cache', action='store_true')
+    parser.add_argument('--token-counter', default=None)
+    parser.add_argument('--report', default=None,
+                        help="file the JSON report is written to")
+    parser.add_argument('--mock', action='store_true',
+                        help="replay against a local mock server")
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--tokens-per-second', type=float, default=None)
+    parser.add_argument('--slots', type=int, default=None)
+    args = parser.parse_args(argv)
+    if not args.mock and not args.backend_uri:
+        parser.error("either --backend-uri or --mock is required")
+
+    agent_kwargs = {'prompt_cache': args.prompt_cache,
+                    'token_counter': args.token_counter}
+    if args.backend is not None:
+        agent_kwargs['backend'] = args.backend
+    mock = None
+    if args.mock:
+        from goat_storytelling_agent.mock_server import MockBackend
+
+        mock = MockBackend(latency=args.latency,
+                           tokens_per_second=args.tokens_per_second,
+                           slots=args.slots).start()
+        backend_uri = mock.url
+    else:
+        backend_uri = args.backend_uri
+        if len(backend_uri) == 1:
+            backend_uri = backend_uri[0]
+    replayer = TrafficReplayer(
+        backend_uri, speed=args.speed, concurrency=args.concurrency,
+        cache_hits=args.cache_hits,
+        recorded_options=not args.stage_options, agent_kwargs=agent_kwargs)
+    try:
+        report = replayer.replay(load_trace(args.trace))
+    finally:
+        if mock is not None:
+            mock.stop()
+    if args.report is not None:
+        with open(args.report, 'w') as fp:
+            json.dump(report, fp, indent=4)
+    latency = report['latency']
+    print(f"Replayed {report['calls']} calls ({report['failed']} failed) "
+          f"in {report['elapsed']:.1f}s, recorded in "
+          f"{report['recorded']['elapsed']:.1f}s: "
+          f"{report['requests_per_second']:.2f} requests/sec, "
+          f"{report['tokens_per_second']:.1f} tokens/sec, latency "
+          f"p50 {latency['p50']:.2f}s p90 {latency['p90']:.2f}s "
+          f"p99 {latency['p99']:.2f}s")
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
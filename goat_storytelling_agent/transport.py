@@ -0,0 +1,247 @@
+"""Pooled keep-alive HTTP transport shared by all generation backends."""
+import time
+import random
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def endpoint_key(url):
+    """Returns scheme://host:port part of the url used to pick a session"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class Transport:
+    """Keeps one pooled `requests.Session` per endpoint.
+
+    Connections are kept alive between calls, so the `/tokenize`,
+    `/completion` and `/generate` requests of a story reuse the same
+    sockets instead of opening a new TCP connection every time.
+
+    Parameters
+    ----------
+    pool_size : int
+        Max number of connections kept open per endpoint
+    pool_block : bool
+        Block when all pooled connections to an endpoint are busy instead
+        of opening a throwaway one
+    """
+    def __init__(self, pool_size=10, pool_block=False):
+        self.pool_size = pool_size
+        self.pool_block = pool_block
+        self._sessions = {}
+        self._adapters = {}
+        self._n_requests = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        key = endpoint_key(url)
+        with self._lock:
+            if key not in self._sessions:
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size,
+                                      pool_block=self.pool_block)
+                session = requests.Session()
+                session.mount(key, adapter)
+                self._sessions[key] = session
+                self._adapters[key] = adapter
+                self._n_requests[key] = 0
+            self._n_requests[key] += 1
+            return self._sessions[key]
+
+    def post(self, url, **kwargs):
+        return self.session(url).post(url, **kwargs)
+
+    def stats(self):
+        """Connection reuse counters per endpoint
+
+        Returns
+        -------
+        Dict[str, Dict]
+            For every endpoint: number of requests sent, connections opened
+            and requests served over an already open connection
+        """
+        stats = {}
+        with self._lock:
+            for key, adapter in self._adapters.items():
+                pools = adapter.poolmanager.pools
+                n_connections = sum(pools[pool_key].num_connections
+                                    for pool_key in pools.keys())
+                n_requests = self._n_requests[key]
+                stats[key] = {
+                    'requests': n_requests,
+                    'connections': n_connections,
+                    'reused': max(n_requests - n_connections, 0)}
+        return stats
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._adapters.clear()
+            self._n_requests.clear()
+
+
+class Endpoint:
+    """Health state of one backend replica"""
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.n_requests = 0
+        self.n_failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trial_in_flight = False
+        self.latency = None
+
+
+class Lease:
+    """One request routed to an endpoint by `EndpointPool.acquire`
+
+    Only the trial request of a half-open endpoint has trial set, the
+    other requests in flight do not decide whether the endpoint recovered.
+    """
+    __slots__ = ('endpoint', 'trial')
+
+    def __init__(self, endpoint, trial=False):
+        self.endpoint = endpoint
+        self.trial = trial
+
+    @property
+    def url(self):
+        return self.endpoint.url
+
+
+class EndpointPool:
+    """Routes requests over backend replicas
+
+    Every request goes to the available endpoint with the fewest requests
+    in flight. An endpoint failing failure_threshold times in a row is taken
+    out of rotation (circuit open) for recovery_time seconds, then a single
+    trial request decides whether it comes back. Requests that were in
+    flight when the circuit opened do not change its state.
+
+    Parameters
+    ----------
+    urls : List[str]
+        Backend endpoints
+    failure_threshold : int
+        Consecutive failures that open the circuit of an endpoint
+    recovery_time : float
+        Seconds before an open endpoint gets a trial request
+    backoff_base : float
+        Base of the exponential backoff between retries, in seconds
+    backoff_max : float
+        Upper bound of the backoff, in seconds
+    """
+    def __init__(self, urls, failure_threshold=3, recovery_time=30.0,
+                 backoff_base=0.5, backoff_max=30.0):
+        if not urls:
+            raise ValueError("No backend endpoints")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+
+    @classmethod
+    def wrap(cls, endpoint):
+        """Makes a pool from a url, a list of urls or returns a pool as is"""
+        if isinstance(endpoint, cls):
+            return endpoint
+        if isinstance(endpoint, str):
+            return cls([endpoint])
+        return cls(list(endpoint))
+
+    def acquire(self):
+        now = time.monotonic()
+        with self._lock:
+            available = [endpoint for endpoint in self.endpoints
+                         if endpoint.open_until <= now
+                         and not endpoint.trial_in_flight]
+            if not available:
+                # every circuit is open, try the one that recovers first
+                available = [min(self.endpoints,
+                                 key=lambda endpoint: endpoint.open_until)]
+            endpoint = min(available, key=lambda endpoint: (
+                endpoint.outstanding, endpoint.consecutive_failures,
+                endpoint.latency or 0.0))
+            trial = (endpoint.consecutive_failures >= self.failure_threshold
+                     and not endpoint.trial_in_flight)
+            if trial:
+                endpoint.trial_in_flight = True
+            endpoint.outstanding += 1
+            endpoint.n_requests += 1
+            return Lease(endpoint, trial)
+
+    def release(self, lease, ok, latency=None):
+        """Records the outcome of a request taken with `acquire`"""
+        endpoint = lease.endpoint
+        with self._lock:
+            endpoint.outstanding -= 1
+            if lease.trial:
+                endpoint.trial_in_flight = False
+            elif endpoint.consecutive_failures >= self.failure_threshold:
+                # open or half-open, only the trial request decides
+                endpoint.n_failures += not ok
+                return
+            if ok:
+                endpoint.consecutive_failures = 0
+                endpoint.open_until = 0.0
+                if latency is None:
+                    return
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency = 0.8 * endpoint.latency + 0.2 * latency
+                return
+            endpoint.n_failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.failure_threshold:
+                endpoint.open_until = time.monotonic() + self.recovery_time
+
+    def backoff(self, attempt):
+        """Jittered exponential delay before retry number attempt"""
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def post(self, post, path, retries=3, **kwargs):
+        """Sends a short request, failing over to other endpoints
+
+        Parameters
+        ----------
+        post : Callable
+            `requests.post` or `Transport.post`
+        path : str
+            Path appended to the endpoint url
+        """
+        for attempt in range(retries):
+            endpoint = self.acquire()
+            start = time.monotonic()
+            try:
+                response = post(f"{endpoint.url}{path}", **kwargs)
+                response.raise_for_status()
+            except requests.RequestException:
+                self.release(endpoint, ok=False)
+                if attempt + 1 == retries:
+                    raise
+                time.sleep(self.backoff(attempt))
+                continue
+            self.release(endpoint, ok=True, latency=time.monotonic() - start)
+            return response
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {endpoint.url: {
+                'requests': endpoint.n_requests,
+                'failures': endpoint.n_failures,
+                'outstanding': endpoint.outstanding,
+                'circuit_open': endpoint.open_until > now,
+                'latency': endpoint.latency,
+            } for endpoint in self.endpoints}
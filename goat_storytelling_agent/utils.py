@@ -4,45 +4,89 @@ def split_into_words_w_newline(text):
     return split_text
 
 
-def remove_last_n_words(text, n):
-    split_text = split_into_words_w_newline(text)
-    i = 1
-    lines_to_slice = 0
-    while True:
-        line = split_text[-i]
-        if line:
-            n_words = len(line)
-            if n_words < n:
-                n -= n_words
-                lines_to_slice += 1
-            else:
-                split_text[-i] = line[:-n]
-                break
-        i += 1
-        if i > len(split_text):
+def join_words_w_newline(text):
+    # single spaces between words, one newline between non-empty lines
+    lines = map(str.split, text.split('\n'))
+    return '\n'.join(' '.join(words) for words in lines if words)
+
+
+def last_n_words_start(text, n):
+    """Offset in text where its last n words start, 0 if it has fewer
+
+    Lines are scanned backward from the end and only the words of the
+    lines that hold the last n words are split.
+    """
+    if n <= 0:
+        return len(text)
+    end = len(text)
+    while end > 0:
+        start = text.rfind('\n', 0, end) + 1
+        words = text[start:end].rsplit(None, n)
+        if len(words) > n:
+            # the first item is the rest of the line before the n words
+            return start + len(words[0])
+        n -= len(words)
+        if n == 0:
+            return start
+        end = start - 1
+    return 0
+
+
+def keep_first_n_words(text, n):
+    """First n words of text, lines joined as `join_words_w_newline`"""
+    lines = []
+    for line in text.split('\n'):
+        if n <= 0:
             break
-    split_text = split_text[:-lines_to_slice]
-    text = "\n".join([" ".join(line) for line in split_text])
-    return text.strip()
+        words = line.split()[:n]
+        if words:
+            lines.append(' '.join(words))
+            n -= len(words)
+    return '\n'.join(lines)
+
+
+def remove_last_n_words(text, n):
+    return join_words_w_newline(text[:last_n_words_start(text, n)])
 
 
 def keep_last_n_words(text, n):
-    split_text = split_into_words_w_newline(text)
-    i = 1
-    lines_to_slice = 0
-    while True:
-        line = split_text[-i]
-        if line:
-            n_words = len(line)
-            if n_words < n:
-                n -= n_words
-                lines_to_slice += 1
-            else:
-                split_text[i] = line[-n:]
-                break
-        i += 1
-        if i > len(split_text):
-            break
-    split_text = split_text[-(lines_to_slice+1):]
-    text = "\n".join([" ".join(line) for line in split_text])
-    return text.strip()
+    return join_words_w_newline(text[last_n_words_start(text, n):])
+
+
+class RollingTail:
+    """Last n words of a growing text, e.g. a scene as it is written
+
+    Appended text is buffered and the buffer is cut back to its last n
+    words whenever it has doubled, so appends cost the same however long
+    the whole text is.
+
+    Parameters
+    ----------
+    n : int
+        Number of last words kept
+    text : str
+        Initial text
+    """
+    def __init__(self, n, text=''):
+        self.n = n
+        self.reset(text)
+
+    def reset(self, text=''):
+        """Starts over from text"""
+        self._buffer = text[last_n_words_start(text, self.n):]
+        self._trimmed_len = len(self._buffer)
+
+    def append(self, text):
+        self._buffer += text
+        if len(self._buffer) > 2 * self._trimmed_len + 1024:
+            self._buffer = self._buffer[
+                last_n_words_start(self._buffer, self.n):]
+            self._trimmed_len = len(self._buffer)
+
+    def text(self, n=None):
+        """Last n words, all kept words by default, as `keep_last_n_words`"""
+        n = self.n if n is None else min(n, self.n)
+        return keep_last_n_words(self._buffer, n)
+
+    def __bool__(self):
+        return bool(self._buffer) and not self._buffer.isspace()
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from goat_storytelling_agent.batch import (
+    AIMDController, AdaptiveLimiter, AsyncFairLimiter)
+
+
+def test_aimd_decreases_on_failure_and_slow_first_token():
+    controller = AIMDController(8, initial=8)
+    assert controller.update(8, latency=0.0, ttft=0.1) == 8
+    assert controller.update(8, failed=True) == 6
+    assert controller.update(6, latency=0.0, ttft=1.0) == 4
+    assert controller.decreases == 2
+    for _ in range(20):
+        controller.update(8, latency=0.0, ttft=0.1)
+    assert controller.current > 4
+
+
+def test_aimd_respects_floor():
+    controller = AIMDController(4, initial=1, min_limit=1)
+    controller.update(1, failed=True)
+    assert controller.current == 1
+    with pytest.raises(ValueError):
+        AIMDController(2, min_limit=3)
+
+
+def test_adaptive_limiter_follows_controller():
+    limiter = AdaptiveLimiter(8)
+    assert limiter.max_in_flight == 4
+    limiter.acquire('a')
+    limiter.release('a', latency=0.0, failed=True)
+    assert limiter.max_in_flight == 3
+    assert limiter.stats()['controller']['decreases'] == 1
+
+
+def test_cancelled_waiter_leaves_queue_and_wakes_next():
+    async def main():
+        limiter = AsyncFairLimiter(1)
+        await limiter.acquire('a')
+        admitted = []
+
+        async def acquire(story_id):
+            await limiter.acquire(story_id)
+            admitted.append(story_id)
+
+        waiting_b = asyncio.ensure_future(acquire('b'))
+        waiting_c = asyncio.ensure_future(acquire('c'))
+        await asyncio.sleep(0.01)
+        assert limiter.stats()['waiting'] == 2
+        waiting_b.cancel()
+        await asyncio.sleep(0.01)
+        assert waiting_b.cancelled()
+        assert limiter.stats()['waiting'] == 1
+
+        await limiter.release('a')
+        await asyncio.wait_for(waiting_c, 1)
+        assert admitted == ['c']
+        stats = limiter.stats()
+        assert (stats['waiting'], stats['in_flight']) == (0, 1)
+
+    asyncio.run(main())
+
+
+def test_cancelled_head_passes_slot_on():
+    async def main():
+        limiter = AsyncFairLimiter(1)
+        await limiter.acquire('a')
+        waiting_b = asyncio.ensure_future(limiter.acquire('b'))
+        waiting_c = asyncio.ensure_future(limiter.acquire('c'))
+        await asyncio.sleep(0.01)
+        # b is woken by the release but cancelled before it runs
+        await limiter.release('a')
+        waiting_b.cancel()
+        await asyncio.wait_for(waiting_c, 1)
+        assert waiting_b.cancelled()
+        stats = limiter.stats()
+        assert (stats['waiting'], stats['in_flight']) == (0, 1)
+
+    asyncio.run(main())
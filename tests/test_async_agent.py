@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+from goat_storytelling_agent.async_agent import AsyncStoryAgent
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+def agent_kwargs(backend):
+    return {'backend': backend, 'token_counter': 'estimate',
+            'logger': AgentLogger()}
+
+
+@pytest.mark.parametrize('backend', ['hf', 'llama.cpp', 'openai'])
+def test_async_story_matches_sync(backend):
+    async def generate(url):
+        async with AsyncStoryAgent(url, **agent_kwargs(backend)) as agent:
+            return await agent.generate_story('jungle')
+
+    with MockBackend(scene_words=20) as mock:
+        agent = StoryAgent(mock.url, **agent_kwargs(backend))
+        scenes = agent.generate_story('jungle')
+        agent.transport.close()
+        async_scenes = asyncio.run(generate(mock.url))
+    assert scenes and async_scenes == scenes
+
+
+def test_async_stages_match_sync():
+    async def stages(url):
+        async with AsyncStoryAgent(url, **agent_kwargs('llama.cpp')) \
+                as agent:
+            _, book_spec = await agent.init_book_spec('jungle')
+            _, plan = await agent.create_plot_chapters(book_spec)
+            return book_spec, plan
+
+    with MockBackend() as mock:
+        agent = StoryAgent(mock.url, **agent_kwargs('llama.cpp'))
+        _, book_spec = agent.init_book_spec('jungle')
+        _, plan = agent.create_plot_chapters(book_spec)
+        assert asyncio.run(stages(mock.url)) == (book_spec, plan)
@@ -0,0 +1,80 @@
+import json
+import time
+import threading
+
+import pytest
+
+from goat_storytelling_agent.batch import BatchRunner, FairLimiter
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.traffic import load_trace
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def acquire_in_thread(limiter, story_id, admitted):
+    def run():
+        limiter.acquire(story_id)
+        admitted.append(story_id)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_fair_limiter_caps_and_prefers_idle_stories():
+    limiter = FairLimiter(2)
+    limiter.acquire('a')
+    limiter.acquire('a')
+    admitted = []
+    threads = [acquire_in_thread(limiter, 'a', admitted)]
+    wait_for(lambda: limiter.stats()['waiting'] == 1)
+    threads.append(acquire_in_thread(limiter, 'b', admitted))
+    wait_for(lambda: limiter.stats()['waiting'] == 2)
+    assert limiter.stats()['in_flight'] == 2
+
+    # b has nothing in flight, so it goes before the older waiter of a
+    limiter.release('a')
+    wait_for(lambda: admitted == ['b'])
+    limiter.release('b')
+    wait_for(lambda: admitted == ['b', 'a'])
+    for thread in threads:
+        thread.join()
+    stats = limiter.stats()
+    assert stats['max_observed_in_flight'] == 2
+    assert (stats['requests'], stats['waited']) == (4, 2)
+
+
+def test_limiter_rejects_empty_cap():
+    with pytest.raises(ValueError):
+        FairLimiter(0)
+
+
+def read_jsonl(fpath):
+    with open(fpath) as fp:
+        return [json.loads(line) for line in fp]
+
+
+@pytest.mark.parametrize('mode', ['thread', 'async', 'process'])
+def test_stories_share_metrics_and_recorder(tmp_path, mode):
+    topics = ['jungle', 'desert', 'ocean']
+    with MockBackend(scene_words=20) as mock:
+        runner = BatchRunner(
+            mock.url, output_dir=str(tmp_path), mode=mode, workers=3,
+            record=True, agent_kwargs={'backend': 'llama.cpp',
+                                       'token_counter': 'estimate'})
+        report = runner.run(topics)
+    assert report['finished'] == 3
+    records = read_jsonl(str(tmp_path / 'metrics.jsonl'))
+    calls = [record for record in records if record['type'] == 'call']
+    assert {call['story_id'] for call in calls} \
+        == {runner.story_id(idx) for idx in range(3)}
+    assert len(load_trace(str(tmp_path / 'traffic.jsonl'))) == len(calls)
+    if mode == 'process':
+        assert runner.metrics is None
+    else:
+        assert list(runner.metrics.records) == records
+        assert runner.recorder is not None
@@ -0,0 +1,162 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from goat_storytelling_agent.async_agent import AsyncStoryAgent
+from goat_storytelling_agent.cache import ResponseCache
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+MESSAGES = [{'role': 'user', 'content': 'Write a scene in the jungle.'}]
+
+
+def test_make_key_depends_on_all_inputs():
+    key = ResponseCache.make_key('prompt', 'hf', 100, {'top_k': 5})
+    assert key == ResponseCache.make_key('prompt', 'hf', 100, {'top_k': 5})
+    assert key != ResponseCache.make_key('prompt!', 'hf', 100, {'top_k': 5})
+    assert key != ResponseCache.make_key('prompt', 'llama.cpp', 100,
+                                         {'top_k': 5})
+    assert key != ResponseCache.make_key('prompt', 'hf', 101, {'top_k': 5})
+    assert key != ResponseCache.make_key('prompt', 'hf', 100, {'top_k': 6})
+
+
+@pytest.mark.parametrize('backend, options, sampling', [
+    ('hf', {}, False),
+    ('hf', {'temperature': None}, False),
+    ('hf', {'temperature': 0.7}, True),
+    ('hf', {'do_sample': True}, True),
+    ('hf', {'do_sample': False, 'top_p': 0.9}, False),
+    # llama.cpp and OpenAI-compatible servers sample by default
+    ('llama.cpp', {}, True),
+    ('llama.cpp', {'temperature': None}, True),
+    ('llama.cpp', {'top_k': 40}, True),
+    ('llama.cpp', {'temperature': 0}, False),
+    ('openai', {}, True),
+    ('openai', {'temperature': 0.0}, False),
+    ('openai', {'do_sample': False}, False),
+])
+def test_is_sampling(backend, options, sampling):
+    assert ResponseCache.is_sampling(options, backend) == sampling
+
+
+def test_memory_lru_eviction():
+    cache = ResponseCache(max_memory_entries=2)
+    cache.put('a', 'A')
+    cache.put('b', 'B')
+    assert cache.get('a') == 'A'
+    cache.put('c', 'C')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A'
+    assert cache.get('c') == 'C'
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['memory_entries'] == 2
+    assert (stats['hits'], stats['misses']) == (3, 1)
+    assert stats['hit_rate'] == 0.75
+
+
+def test_disk_level_survives_restart(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = ResponseCache(path, max_disk_entries=2)
+    for key in 'abc':
+        cache.put(key, key.upper())
+    assert cache.stats()['disk_entries'] == 2
+    cache.close()
+
+    cache = ResponseCache(path)
+    assert cache.get('a') is None
+    assert cache.get('c') == 'C'
+    assert cache.get('c') == 'C'
+    stats = cache.stats()
+    assert (stats['disk_hits'], stats['memory_hits']) == (1, 1)
+    cache.close()
+
+
+def test_expired_entries_are_missing():
+    cache = ResponseCache(max_age=0.05)
+    cache.put('a', 'A')
+    assert cache.get('a') == 'A'
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert cache.stats()['evictions'] == 1
+
+
+@pytest.mark.parametrize('backend', ['hf', 'llama.cpp'])
+def test_agent_bypasses_cache_when_sampling(backend):
+    with MockBackend(scene_words=20) as mock:
+        def requests(**kwargs):
+            agent = StoryAgent(mock.url, backend=backend,
+                               token_counter='estimate', logger=AgentLogger(),
+                               cache=ResponseCache(), **kwargs)
+            for _ in range(2):
+                agent.query_chat(MESSAGES, stage='write_scenes')
+            return agent.usage['requests']
+
+        greedy = {'hf': {'do_sample': False}, 'llama.cpp': {'temperature': 0}}
+        assert requests(scene_extra_options=greedy[backend]) == 1
+        assert requests(scene_extra_options={'temperature': 0.8}) == 2
+        assert requests(scene_extra_options={'temperature': 0.8},
+                        cache_sampling=True) == 1
+
+
+def test_llamacpp_server_defaults_bypass_cache():
+    with MockBackend(scene_words=20) as mock:
+        agent = StoryAgent(mock.url, backend='llama.cpp',
+                           token_counter='estimate', logger=AgentLogger(),
+                           cache=ResponseCache())
+        for _ in range(2):
+            agent.query_chat(MESSAGES, stage='write_scenes')
+    assert agent.usage['requests'] == 2
+    assert agent.cache_stats()['stores'] == 0
+
+
+def test_cache_key_of_sampled_stage_is_none():
+    agent = StoryAgent('http://127.0.0.1:1', backend='llama.cpp',
+                       token_counter='estimate', logger=AgentLogger(),
+                       cache=ResponseCache(),
+                       extra_options={'temperature': 0},
+                       scene_extra_options={'temperature': 0.8})
+    assert agent.cache_key(MESSAGES, stage='write_scenes') is None
+    assert agent.cache_key(MESSAGES) is not None
+    assert agent.cache_key(MESSAGES, use_cache=False) is None
+
+
+class _ThreadRecordingCache(ResponseCache):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threads = set()
+
+    def get(self, key):
+        self.threads.add(threading.get_ident())
+        return super().get(key)
+
+    def put(self, key, value):
+        self.threads.add(threading.get_ident())
+        super().put(key, value)
+
+
+def test_async_agent_keeps_cache_off_the_loop(tmp_path):
+    cache = _ThreadRecordingCache(str(tmp_path / 'cache.db'))
+
+    async def main():
+        async with AsyncStoryAgent(
+                mock.url, backend='llama.cpp', token_counter='estimate',
+                logger=AgentLogger(), cache=cache,
+                extra_options={'temperature': 0}) as agent:
+            first = await agent.query_chat(MESSAGES)
+            assert await agent.query_chat(MESSAGES) == first
+            deltas = [delta async for delta in agent.stream_chat(
+                MESSAGES + [{'role': 'assistant', 'content': 'Once'}])]
+            return threading.get_ident(), agent.usage['requests'], deltas
+
+    with MockBackend(scene_words=20) as mock:
+        loop_thread, n_requests, deltas = asyncio.run(main())
+    assert n_requests == 2
+    assert deltas
+    assert cache.stats()['stores'] == 2
+    assert cache.threads and loop_thread not in cache.threads
+    cache.close()
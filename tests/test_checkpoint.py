@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from goat_storytelling_agent.checkpoint import RunCheckpoint
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+def make_agent(url, backend='llama.cpp', **kwargs):
+    return StoryAgent(url, backend=backend, token_counter='estimate',
+                      logger=AgentLogger(), **kwargs)
+
+
+def test_stage_roundtrip(tmp_path):
+    checkpoint = RunCheckpoint(str(tmp_path), 'run')
+    spec = {'Genre': 'Adventure'}
+    checkpoint.save_stage('init_book_spec', spec)
+    assert checkpoint.has_stage('init_book_spec')
+    assert not checkpoint.has_stage('enhance_book_spec')
+    assert checkpoint.load_stage('init_book_spec') == spec
+
+
+def test_topic_of_resumed_run_must_match(tmp_path):
+    checkpoint = RunCheckpoint(str(tmp_path), 'run')
+    checkpoint.check_topic('jungle')
+    RunCheckpoint(str(tmp_path), 'run').check_topic('jungle')
+    try:
+        RunCheckpoint(str(tmp_path), 'run').check_topic('desert')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("topic mismatch not detected")
+    assert checkpoint.load_topic() == 'jungle'
+
+
+def test_torn_scene_line_is_dropped(tmp_path):
+    checkpoint = RunCheckpoint(str(tmp_path), 'run')
+    checkpoint.append_scene(1, 1, 1, "First scene.")
+    checkpoint.append_scene(1, 1, 2, "Second scene.")
+    with open(checkpoint.scenes_path, 'a') as fp:
+        fp.write('{"act_num": 1, "ch_num": 2, "sc_')
+    scenes = checkpoint.load_scenes()
+    assert [scene['text'] for scene in scenes] \
+        == ["First scene.", "Second scene."]
+    with open(checkpoint.scenes_path) as fp:
+        assert len(fp.readlines()) == 2
+    checkpoint.append_scene(1, 2, 1, "Third scene.")
+    assert len(checkpoint.load_scenes()) == 3
+
+
+def test_resume_after_partial_writes(tmp_path):
+    run_dir = str(tmp_path)
+    with MockBackend(scene_words=30) as mock:
+        scenes = make_agent(mock.url).generate_story(
+            'jungle', run_id='run', run_dir=run_dir)
+        checkpoint = RunCheckpoint(run_dir, 'run')
+        # a crash while writing a stage leaves only its temporary file and
+        # a crash while appending a scene a torn last line
+        stage_path = os.path.join(checkpoint.path,
+                                  'split_chapters_into_scenes.json')
+        os.replace(stage_path, stage_path + '.tmp')
+        with open(checkpoint.scenes_path) as fp:
+            lines = fp.readlines()
+        with open(checkpoint.scenes_path, 'w') as fp:
+            fp.writelines(lines[:-1])
+            fp.write(lines[-1][:len(lines[-1]) // 2])
+
+        agent = make_agent(mock.url)
+        resumed = agent.generate_story('jungle', run_id='run',
+                                       run_dir=run_dir)
+        stages = {record['stage'] for record in agent.metrics.records
+                  if record['type'] == 'call'}
+    assert resumed == scenes
+    assert stages == {'split_chapters_into_scenes', 'write_scenes'}
+    assert len(checkpoint.load_scenes()) == len(scenes)
+
+
+@pytest.mark.parametrize('backend', ['hf', 'llama.cpp'])
+def test_failed_scene_is_not_checkpointed(tmp_path, backend):
+    run_dir = str(tmp_path)
+    with MockBackend(scene_words=30) as mock:
+        scenes = make_agent(mock.url, backend).generate_story(
+            'jungle', run_id='run', run_dir=run_dir)
+    checkpoint = RunCheckpoint(run_dir, 'run')
+    with open(checkpoint.scenes_path) as fp:
+        lines = fp.readlines()
+    with open(checkpoint.scenes_path, 'w') as fp:
+        fp.writelines(lines[:-1])
+
+    # the planning stages are resumed, the last scene fails
+    with MockBackend(error_rate=1.0) as mock:
+        with pytest.raises(RuntimeError):
+            make_agent(mock.url, backend).generate_story(
+                'jungle', run_id='run', run_dir=run_dir)
+    assert len(checkpoint.load_scenes()) == len(scenes) - 1
+
+    with MockBackend(scene_words=30) as mock:
+        resumed = make_agent(mock.url, backend).generate_story(
+            'jungle', run_id='run', run_dir=run_dir)
+    assert resumed == scenes
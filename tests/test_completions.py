@@ -0,0 +1,140 @@
+import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+from goat_storytelling_agent.completions import (
+    AsyncCompletionBatcher, CompletionBatcher)
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+
+
+MALFORMED_LINES = {
+    # a choice for a prompt that was never sent
+    IndexError: b'data: {"choices": [{"index": 7, "text": "x"}]}',
+    json.JSONDecodeError: b'data: {"choices": [',
+    ValueError: b'data: {"error": {"message": "overloaded"}}',
+}
+
+
+class _MalformedHandler(BaseHTTPRequestHandler):
+    """Streams the malformed line of the server"""
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        self.wfile.write(self.server.line + b'\n\n')
+        self.wfile.flush()
+
+
+@pytest.fixture(params=list(MALFORMED_LINES))
+def malformed(request):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _MalformedHandler)
+    server.daemon_threads = True
+    server.line = MALFORMED_LINES[request.param]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", request.param
+    server.shutdown()
+    server.server_close()
+
+
+def collect(batcher, args):
+    return ''.join(delta for delta in batcher.stream(*args, {})
+                   if delta is not None)
+
+
+def test_prompts_are_batched():
+    prompts = [f'Write a long detailed scene {idx}' for idx in range(4)]
+    with MockBackend() as mock:
+        batcher = CompletionBatcher(mock.url, max_wait=0.2,
+                                    logger=AgentLogger())
+        with ThreadPoolExecutor(len(prompts)) as pool:
+            texts = list(pool.map(lambda prompt: collect(
+                batcher, (prompt, 20)), prompts))
+        assert mock.stats()['batched_prompts'] == 4
+    assert all(len(text.split()) == 20 for text in texts)
+    assert batcher.stats() == {'batches': 1, 'prompts': 4,
+                               'max_batch_size': 4}
+
+
+def test_prompts_of_different_lengths_share_a_batch():
+    calls = [('Write a scene', 50),
+             ('Write a long detailed scene in the jungle at night', 5),
+             ('Write a long detailed scene on the river with Helen and '
+              'Ignacio', 30)]
+    with MockBackend() as mock:
+        batcher = CompletionBatcher(mock.url, max_wait=0.2,
+                                    logger=AgentLogger())
+        with ThreadPoolExecutor(len(calls)) as pool:
+            texts = list(pool.map(lambda args: collect(batcher, args), calls))
+        assert mock.stats()['batches'] == 1
+    # each prompt stops at its own budget
+    assert [len(text.split()) for text in texts] == [50, 5, 30]
+    assert batcher.stats() == {'batches': 1, 'prompts': 3,
+                               'max_batch_size': 3}
+
+
+def test_prompt_without_budget_is_rejected():
+    batcher = CompletionBatcher('http://127.0.0.1:1', logger=AgentLogger())
+    with pytest.raises(ValueError):
+        collect(batcher, ('Write a scene', -12))
+    assert batcher.stats()['batches'] == 0
+
+
+def test_failed_attempts_raise_in_every_caller():
+    with MockBackend(error_rate=1.0) as mock:
+        batcher = CompletionBatcher(mock.url, max_wait=0.2, retries=2,
+                                    logger=AgentLogger())
+
+        def call(prompt):
+            with pytest.raises(requests.HTTPError):
+                collect(batcher, (prompt, 16))
+
+        with ThreadPoolExecutor(2) as pool:
+            for future in [pool.submit(call, prompt) for prompt in 'ab']:
+                future.result(timeout=10)
+        assert mock.stats()['requests'] == 2
+
+
+def test_malformed_stream_fails_every_caller(malformed):
+    url, error = malformed
+    batcher = CompletionBatcher(url, max_wait=0.2, retries=2,
+                                logger=AgentLogger())
+
+    def call(prompt):
+        with pytest.raises(error):
+            collect(batcher, (prompt, 16))
+
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(call, prompt) for prompt in 'ab']
+        for future in futures:
+            future.result(timeout=10)
+    assert batcher.stats()['prompts'] == 2
+
+
+def test_async_malformed_stream_fails_every_caller(malformed):
+    url, error = malformed
+
+    async def main():
+        batcher = AsyncCompletionBatcher(url, max_wait=0.2, retries=2,
+                                         logger=AgentLogger())
+
+        async def call(prompt):
+            with pytest.raises(error):
+                async for _ in batcher.stream(prompt, 16, {}):
+                    pass
+        try:
+            await asyncio.wait_for(asyncio.gather(call('a'), call('b')), 10)
+        finally:
+            await batcher.aclose()
+        assert batcher.stats()['batches'] == 1
+
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+import pytest
+
+from goat_storytelling_agent.context import (
+    SceneContext, SceneContextOverflow, context_variants)
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+DETAIL_TOKENS = {'full': 100, 'summary': 20, None: 0}
+
+
+class FakePlan:
+    """Plan of n_acts acts, chapter numbers are act indices"""
+    def __init__(self, n_acts):
+        self.n_acts = n_acts
+
+    def __len__(self):
+        return self.n_acts
+
+    def chapter_act(self, ch_num):
+        return ch_num
+
+
+class Prompts:
+    """Scene prompts whose token counts follow their parts"""
+    def __init__(self, spec_tokens=30):
+        self.spec_tokens = spec_tokens
+        self.counted = []
+
+    def build(self, details, n_words, spec_words=None):
+        return [{'details': details, 'n_words': n_words,
+                 'spec': self.spec_tokens if spec_words is None
+                 else spec_words}]
+
+    def count(self, messages):
+        message = messages[0]
+        self.counted.append(message)
+        return (sum(DETAIL_TOKENS[detail] for detail in message['details'])
+                + message['n_words'] + message['spec'])
+
+
+def test_far_acts_lose_detail_first():
+    variants = list(context_variants(3, 0, 200))
+    assert variants[:5] == [
+        (['full', 'full', 'full'], 200),
+        (['full', 'full', 'summary'], 200),
+        (['full', 'summary', 'summary'], 200),
+        (['full', 'summary', None], 200),
+        (['full', None, None], 200)]
+    assert [n_words for _, n_words in variants[4:]] == [200, 100, 50, 0]
+    # at the same distance the later act goes first
+    assert list(context_variants(3, 1, 0))[1] == (['full', 'full',
+                                                   'summary'], 0)
+
+
+def test_full_prompt_is_counted_once():
+    prompts = Prompts()
+    context = SceneContext(prompts.count, max_tokens=1100,
+                           min_new_tokens=500)
+    _, n_tokens = context.assemble(prompts.build, FakePlan(3), 1, 200)
+    assert n_tokens == 300 + 200 + 30
+    assert len(prompts.counted) == 1
+
+
+@pytest.mark.parametrize('budget', [520, 450, 380, 300, 160, 140])
+def test_binary_search_finds_largest_prompt(budget):
+    prompts = Prompts()
+    context = SceneContext(prompts.count, max_tokens=budget + 100,
+                           min_new_tokens=100)
+    plan = FakePlan(4)
+    messages, n_tokens = context.assemble(prompts.build, plan, 1, 200)
+    variants = list(context_variants(4, 1, 200))
+    expected = next(prompts.build(*variant) for variant in variants
+                    if prompts.count(prompts.build(*variant)) <= budget)
+    assert messages == expected
+    assert n_tokens == prompts.count(messages) <= budget
+
+
+def test_binary_search_counts_few_prompts():
+    prompts = Prompts()
+    context = SceneContext(prompts.count, max_tokens=400, min_new_tokens=100)
+    context.assemble(prompts.build, FakePlan(6), 2, 400)
+    n_variants = len(list(context_variants(6, 2, 400)))
+    assert len(prompts.counted) <= 2 + n_variants.bit_length()
+
+
+def test_max_prompt_tokens_caps_budget():
+    context = SceneContext(len, max_tokens=1000, min_new_tokens=100,
+                           max_prompt_tokens=300)
+    assert context.budget == 300
+
+
+def test_spec_is_cut_when_only_act_is_left():
+    prompts = Prompts(spec_tokens=200)
+    context = SceneContext(prompts.count, max_tokens=260, min_new_tokens=100,
+                           min_spec_words=20)
+    messages, n_tokens = context.assemble(prompts.build, FakePlan(3), 0,
+                                          100, n_spec_words=200)
+    assert messages[0]['details'] == ['full', None, None]
+    assert (messages[0]['n_words'], messages[0]['spec']) == (0, 50)
+    assert n_tokens == 150
+
+
+def test_overflow_when_spec_cannot_be_cut_further():
+    prompts = Prompts(spec_tokens=200)
+    context = SceneContext(prompts.count, max_tokens=200, min_new_tokens=100,
+                           min_spec_words=20)
+    with pytest.raises(SceneContextOverflow):
+        context.assemble(prompts.build, FakePlan(3), 0, 100,
+                         n_spec_words=200)
+
+
+def test_story_with_tight_context():
+    with MockBackend(scene_words=20) as mock:
+        roomy = StoryAgent(mock.url, backend='llama.cpp',
+                           token_counter='estimate', logger=AgentLogger())
+        _, book_spec = roomy.init_book_spec('jungle')
+        _, plan = roomy.create_plot_chapters(book_spec)
+        _, plan = roomy.split_chapters_into_scenes(plan)
+        _, ch_num, sc_num, scene = list(plan.scenes())[0]
+        full = roomy.scene_messages(scene, sc_num, ch_num, plan, '', '')
+        n_full = roomy.count_prompt_tokens(full)
+
+        tight = StoryAgent(mock.url, backend='llama.cpp',
+                           token_counter='estimate', logger=AgentLogger(),
+                           max_tokens=n_full + 50, min_scene_tokens=100)
+        messages = tight.scene_messages(scene, sc_num, ch_num, plan, '', '')
+        assert tight.count_prompt_tokens(messages) <= n_full - 50
+        assert tight.write_scenes(plan)
+
+        cramped = StoryAgent(mock.url, backend='llama.cpp',
+                             token_counter='estimate', logger=AgentLogger(),
+                             max_tokens=150, min_scene_tokens=100)
+        with pytest.raises(SceneContextOverflow):
+            cramped.write_scenes(plan)
@@ -0,0 +1,99 @@
+import time
+
+import pytest
+import requests
+
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+from goat_storytelling_agent.transport import EndpointPool, Transport
+
+
+def is_open(pool, url):
+    return pool.stats()[url]['circuit_open']
+
+
+def test_least_outstanding_endpoint_is_picked():
+    pool = EndpointPool(['http://a', 'http://b/'])
+    first, second = pool.acquire(), pool.acquire()
+    assert (first.url, second.url) == ('http://a', 'http://b')
+    pool.release(first, ok=True, latency=0.1)
+    assert pool.acquire().url == 'http://a'
+
+
+def test_circuit_opens_after_consecutive_failures():
+    pool = EndpointPool(['http://a'], failure_threshold=2)
+    pool.release(pool.acquire(), ok=False)
+    pool.release(pool.acquire(), ok=True)
+    pool.release(pool.acquire(), ok=False)
+    assert not is_open(pool, 'http://a')
+    pool.release(pool.acquire(), ok=False)
+    assert is_open(pool, 'http://a')
+    assert pool.stats()['http://a']['failures'] == 3
+
+
+def test_open_endpoint_is_taken_out_of_rotation():
+    pool = EndpointPool(['http://a', 'http://b'], failure_threshold=1)
+    pool.release(pool.acquire(), ok=False)
+    leases = [pool.acquire() for _ in range(3)]
+    assert [lease.url for lease in leases] == ['http://b'] * 3
+    for lease in leases:
+        pool.release(lease, ok=False)
+    # every circuit is open, the one recovering first gets the trial
+    lease = pool.acquire()
+    assert (lease.url, lease.trial) == ('http://a', True)
+
+
+def test_single_trial_decides_recovery():
+    pool = EndpointPool(['http://a'], failure_threshold=1,
+                        recovery_time=0.05)
+    straggler = pool.acquire()
+    pool.release(pool.acquire(), ok=False)
+    # requests in flight when the circuit opened do not close it
+    pool.release(straggler, ok=True)
+    assert is_open(pool, 'http://a')
+
+    time.sleep(0.06)
+    trial = pool.acquire()
+    other = pool.acquire()
+    assert (trial.trial, other.trial) == (True, False)
+    pool.release(other, ok=True)
+    pool.release(trial, ok=False)
+    assert is_open(pool, 'http://a')
+
+    time.sleep(0.06)
+    trial = pool.acquire()
+    assert trial.trial
+    pool.release(trial, ok=True)
+    assert not is_open(pool, 'http://a')
+    assert not pool.acquire().trial
+
+
+def test_post_fails_over_to_healthy_endpoint():
+    with MockBackend(error_rate=1.0) as bad, MockBackend() as good:
+        pool = EndpointPool([bad.url, good.url], failure_threshold=1,
+                            backoff_base=0.0)
+        transport = Transport()
+        for _ in range(3):
+            response = pool.post(transport.post, '/tokenize',
+                                 json={'content': 'a b'})
+            assert response.json()['tokens']
+        assert bad.stats()['requests'] == 1
+        assert is_open(pool, bad.url)
+
+        with pytest.raises(requests.HTTPError):
+            EndpointPool([bad.url], backoff_base=0.0).post(
+                transport.post, '/tokenize', retries=2,
+                json={'content': 'a b'})
+        transport.close()
+
+
+def test_story_fails_over_to_healthy_replica():
+    with MockBackend(error_rate=1.0) as bad, \
+            MockBackend(scene_words=20) as good:
+        agent = StoryAgent([bad.url, good.url], backend='llama.cpp',
+                           token_counter='estimate', logger=AgentLogger())
+        assert agent.generate_story('jungle')
+        stats = agent.endpoint_stats()
+    assert stats[bad.url]['failures'] >= 1
+    assert stats[good.url]['requests'] == good.stats()['requests']
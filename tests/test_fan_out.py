@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from goat_storytelling_agent.async_agent import AsyncStoryAgent
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+def make_agent(url, max_in_flight, cls=StoryAgent):
+    return cls(url, backend='llama.cpp', token_counter='estimate',
+               logger=AgentLogger(), max_in_flight=max_in_flight)
+
+
+def split_acts(url, max_in_flight):
+    agent = make_agent(url, max_in_flight)
+    _, book_spec = agent.init_book_spec('jungle')
+    _, plan = agent.create_plot_chapters(book_spec)
+    return agent.split_chapters_into_scenes(plan)
+
+
+@pytest.mark.parametrize('max_in_flight, overlapping', [(1, False),
+                                                        (3, True)])
+def test_acts_are_split_concurrently(max_in_flight, overlapping):
+    # one generation slot: concurrent requests queue in the server
+    with MockBackend(slots=1, tokens_per_second=2000) as mock:
+        plan = split_acts(mock.url, max_in_flight)
+        assert (mock.stats()['queued'] > 0) == overlapping
+    with MockBackend() as mock:
+        assert split_acts(mock.url, 1) == plan
+
+
+def test_async_fan_out_matches_sequential():
+    async def story(url, max_in_flight):
+        async with make_agent(url, max_in_flight, AsyncStoryAgent) as agent:
+            return await agent.generate_story('jungle')
+
+    with MockBackend(scene_words=20, slots=1, tokens_per_second=2000) \
+            as mock:
+        fanned_out = asyncio.run(story(mock.url, 3))
+        assert mock.stats()['queued'] > 0
+    with MockBackend(scene_words=20) as mock:
+        sequential = asyncio.run(story(mock.url, 1))
+    assert fanned_out
+    assert len(fanned_out) == len(sequential)
@@ -0,0 +1,109 @@
+import json
+
+from goat_storytelling_agent.instrumentation import AgentLogger, Metrics
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+def call_record(stage='write_scenes', story_id='s', wall_time=0.3, **kwargs):
+    return {'story_id': story_id, 'stage': stage, 'start': 0.0,
+            'wall_time': wall_time, 'queue_time': 0.1, 'ttft': 0.05,
+            'prompt_tokens': 10, 'completion_tokens': 20, 'attempts': 1,
+            'retries': 0, 'requery': False, 'cache_hit': False, 'ok': True,
+            'early_stop': None, **kwargs}
+
+
+def samples(text):
+    """Prometheus samples by name and labels, comments skipped"""
+    values = {}
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+def test_prometheus_aggregates_calls():
+    metrics = Metrics()
+    metrics.record_call(call_record(wall_time=0.3))
+    metrics.record_call(call_record(wall_time=3.0, ok=False, retries=2,
+                                    requery=True, early_stop='stop'))
+    metrics.record_call(call_record(stage='init_book_spec', cache_hit=True,
+                                    ttft=None))
+    text = metrics.prometheus()
+    assert '# TYPE goat_call_seconds histogram' in text
+    values = samples(text)
+    assert values['goat_calls_total{stage="write_scenes"}'] == 2
+    assert values['goat_call_failures_total{stage="write_scenes"}'] == 1
+    assert values['goat_retries_total{stage="write_scenes"}'] == 2
+    assert values['goat_requeries_total{stage="write_scenes"}'] == 1
+    assert values['goat_early_stops_total{stage="write_scenes"}'] == 1
+    assert values['goat_completion_tokens_total{stage="write_scenes"}'] == 40
+    assert values['goat_cache_hits_total{stage="init_book_spec"}'] == 1
+    # buckets are cumulative
+    assert values['goat_call_seconds_bucket{stage="write_scenes",le="0.1"}'] \
+        == 0
+    assert values['goat_call_seconds_bucket{stage="write_scenes",le="0.5"}'] \
+        == 1
+    assert values['goat_call_seconds_bucket{stage="write_scenes",le="5"}'] \
+        == 2
+    assert values['goat_call_seconds_bucket{stage="write_scenes",le="+Inf"}'] \
+        == 2
+    assert values['goat_call_seconds_sum{stage="write_scenes"}'] == 3.3
+    assert values['goat_ttft_seconds_count{stage="init_book_spec"}'] == 0
+    assert values['goat_queue_seconds_count{stage="write_scenes"}'] == 2
+
+
+def test_stage_totals_cover_calls_made_during_it():
+    metrics = Metrics()
+    metrics.record_call(call_record(story_id='a'))
+    with metrics.track_stage('a', 'write_scenes'):
+        metrics.record_call(call_record(story_id='a'))
+        metrics.record_call(call_record(story_id='b'))
+    stage = metrics.records[-1]
+    assert stage['type'] == 'stage'
+    assert (stage['calls'], stage['completion_tokens']) == (1, 20)
+    values = samples(metrics.prometheus())
+    assert values['goat_stage_seconds_count{stage="write_scenes"}'] == 1
+    assert values['goat_stages_resumed_total{stage="write_scenes"}'] == 0
+
+
+def test_records_go_to_jsonl(tmp_path):
+    fpath = str(tmp_path / 'metrics.jsonl')
+    metrics = Metrics(fpath, max_records=2)
+    for idx in range(3):
+        metrics.record_call(call_record(story_id=str(idx)))
+    metrics.record_parse({'story_id': '2', 'stage': 'init_book_spec',
+                          'parser': 'book_spec', 'ok': False, 'issues': []})
+    with open(fpath) as fp:
+        appended = [json.loads(line) for line in fp]
+    assert [record['type'] for record in appended] == ['call'] * 3 + ['parse']
+    # only the latest records are kept in memory, aggregates cover all
+    export_path = str(tmp_path / 'export.jsonl')
+    metrics.export_jsonl(export_path)
+    with open(export_path) as fp:
+        assert [json.loads(line) for line in fp] == appended[2:]
+    values = samples(metrics.prometheus())
+    assert values['goat_calls_total{stage="write_scenes"}'] == 3
+    assert values['goat_parse_failures_total{stage="init_book_spec",'
+                  'parser="book_spec"}'] == 1
+
+
+def test_story_records_every_call_and_stage():
+    with MockBackend(scene_words=20) as mock:
+        agent = StoryAgent(mock.url, backend='llama.cpp',
+                           token_counter='estimate', logger=AgentLogger())
+        agent.generate_story('jungle')
+        n_completions = mock.stats()['requests']
+    calls = [record for record in agent.metrics.records
+             if record['type'] == 'call']
+    stages = [record for record in agent.metrics.records
+              if record['type'] == 'stage']
+    assert len(calls) == n_completions
+    assert [stage['stage'] for stage in stages] == [
+        'init_book_spec', 'enhance_book_spec', 'create_plot_chapters',
+        'enhance_plot_chapters', 'split_chapters_into_scenes',
+        'write_scenes']
+    assert sum(stage['calls'] for stage in stages) == len(calls)
+    assert sum(stage['completion_tokens'] for stage in stages) \
+        == agent.usage['completion_tokens']
@@ -0,0 +1,93 @@
+import os
+import json
+import threading
+import importlib.util
+
+import requests
+
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+BENCH_PATH = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks', 'bench.py')
+
+
+def complete(url, prompt, **options):
+    response = requests.post(url + '/completion',
+                             json={'prompt': prompt, **options})
+    response.raise_for_status()
+    return response.json()['content']
+
+
+def make_agent(url):
+    return StoryAgent(url, backend='llama.cpp', token_counter='estimate',
+                      logger=AgentLogger())
+
+
+def test_replies_are_seeded_by_prompt():
+    with MockBackend(scene_words=40) as first, \
+            MockBackend(scene_words=40) as second:
+        prompt = '### USER: Write the next scene.\n### ASSISTANT:'
+        assert complete(first.url, prompt) == complete(second.url, prompt)
+        assert complete(first.url, prompt) \
+            != complete(first.url, prompt + ' Go on.')
+        assert len(complete(first.url, prompt, n_predict=5).split()) <= 5
+
+
+def test_story_parses_canned_replies():
+    with MockBackend(scene_words=20, chapters_per_act=2,
+                     scenes_per_chapter=3) as mock:
+        scenes = make_agent(mock.url).generate_story('jungle')
+    assert len(scenes) == 3 * 2 * 3
+
+
+def test_injected_errors():
+    with MockBackend(error_rate=1.0) as mock:
+        response = requests.post(mock.url + '/completion',
+                                 json={'prompt': 'x'})
+        assert response.status_code == 503
+        assert mock.stats()['errors'] == 1
+    with MockBackend(scene_words=20, stream_error_rate=1.0) as mock:
+        response = requests.post(mock.url + '/completion', json={
+            'prompt': '### USER: Write a scene.\n### ASSISTANT:',
+            'stream': True})
+        events = [line for line in response.iter_lines() if line]
+        # the stream breaks halfway through the scene
+        assert events[-1].startswith(b'error: ')
+        assert 5 <= len(events) - 1 <= 15
+        assert mock.stats()['stream_errors'] == 1
+
+
+def test_requests_queue_for_slots():
+    with MockBackend(slots=1, tokens_per_second=500, scene_words=50) \
+            as mock:
+        threads = [threading.Thread(target=complete, args=(
+            mock.url, f'### USER: Scene {idx}\n### ASSISTANT:'))
+            for idx in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert mock.stats()['queued'] == 1
+
+
+def test_compare_reports_regressions(tmp_path, capsys):
+    spec = importlib.util.spec_from_file_location('bench', BENCH_PATH)
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+
+    def write(name, elapsed, us_per_call):
+        fpath = str(tmp_path / name)
+        with open(fpath, 'w') as fp:
+            json.dump({'micro': {'parse': {'us_per_call': us_per_call}},
+                       'e2e': {'mock': {
+                           'elapsed': elapsed, 'tokens_per_second': 1.0,
+                           'stories_per_hour': 1.0, 'stages': {}}}}, fp)
+        return fpath
+
+    old = write('old.json', 10.0, 5.0)
+    assert bench.compare(old, write('same.json', 10.5, 5.0), 0.1) == 0
+    assert bench.compare(old, write('slow.json', 10.0, 6.0), 0.1) == 1
+    assert 'micro.parse' in capsys.readouterr().out
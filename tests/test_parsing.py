@@ -0,0 +1,120 @@
+from goat_storytelling_agent.parsing import (
+    BookSpecParser, parse_act, parse_act_scenes, parse_text_plan, split_acts)
+
+
+def test_act_scenes_repeated_chapter_heading():
+    text = ("Chapter 4:\n"
+            "Scene 1:\n"
+            "Characters: Helen, Ignacio\n"
+            "Event: They cross the river at night.\n"
+            "Chapter 4, Scene 2:\n"
+            "Characters: Helen\n"
+            "Event: Helen reads the map by the fire.\n")
+    result = parse_act_scenes(text, [4, 5, 6])
+    assert result.ok
+    assert result.value == {4: [
+        "Characters: Helen, Ignacio\nEvent: They cross the river at night.",
+        "Characters: Helen\nEvent: Helen reads the map by the fire."]}
+
+
+PLAN = ("Act 1:\n"
+        "The crew gathers at the river port.\n"
+        "Chapter 1: Helen finds an old map in the archive.\n"
+        "Chapter 2: Ignacio agrees to guide the expedition.\n"
+        "Act 2:\n"
+        "The jungle tests the crew.\n"
+        "Chapter 3: A storm sinks one of the boats.\n"
+        "Chapter 4: The crew reaches the ruined temple.\n"
+        "Act 3:\n"
+        "The treasure is found and lost.\n"
+        "Chapter 5: Helen opens the sealed chamber.\n"
+        "Chapter 6: The river carries the gold away.\n")
+
+
+def test_text_plan_three_acts():
+    result = parse_text_plan(PLAN)
+    assert result.ok
+    assert result.issues == []
+    assert [act['act_descr'] for act in result.value] == [
+        "Act 1:\nThe crew gathers at the river port.",
+        "Act 2:\nThe jungle tests the crew.",
+        "Act 3:\nThe treasure is found and lost."]
+    assert result.value[1]['chapters'] == [
+        "A storm sinks one of the boats.",
+        "The crew reaches the ruined temple."]
+
+
+def test_text_plan_drops_act_without_chapters():
+    text = PLAN.replace(
+        "Chapter 5: Helen opens the sealed chamber.\n"
+        "Chapter 6: The river carries the gold away.\n", '')
+    result = parse_text_plan(text)
+    assert result.ok
+    assert len(result.value) == 2
+    assert result.issues == ["act 3 has no chapters"]
+
+
+def test_text_plan_without_acts_fails():
+    result = parse_text_plan("Chapter 1: Helen finds an old map here.")
+    assert not result.ok
+    assert result.value == []
+    assert "0 'Act ' occurrences, expected 3" in result.issues
+
+
+def test_split_acts():
+    result = split_acts(PLAN)
+    assert result.ok
+    assert [act.split(':')[0] for act in result.value] == [
+        'Act 1', 'Act 2', 'Act 3']
+
+
+def test_parse_act_needs_chapters():
+    result = parse_act("The crew gathers at the river port.")
+    assert not result.ok
+    assert result.issues == ['no chapters']
+    result = parse_act("Descr of the act.\n"
+                       "Chapter 1: Helen finds an old map.\n"
+                       "Chapter 2: Too short\n")
+    assert result.ok
+    # chapters of 3 words or less are dropped
+    assert result.value['chapters'] == ["Helen finds an old map."]
+
+
+def test_book_spec_parser():
+    parser = BookSpecParser(['Genre', 'Setting', 'Characters'])
+    result = parser.parse('Here is the spec:\n"""\n'
+                          'Genre: adventure\n'
+                          'Setting: a jungle river\n'
+                          'in the rainy season\n'
+                          'Mood: grim\n'
+                          'more mood\n'
+                          '"""')
+    assert result.value == {'Genre': 'adventure',
+                            'Setting': 'a jungle river in the rainy season',
+                            'Characters': ''}
+    assert not result.ok
+    assert result.issues == ['missing field Characters']
+
+
+def test_book_spec_parser_ignores_long_keys():
+    parser = BookSpecParser(['Genre'])
+    result = parser.parse('The genre of this long novel: romance\n'
+                          'Genre: adventure')
+    assert result.value == {'Genre': 'adventure'}
+    assert result.ok
+
+
+def test_act_scenes_keeps_act_chapters():
+    text = ("Chapter 1:\nScene 1:\nHelen reads the old map.\n"
+            "Chapter 2:\nScene 1:\nIgnacio packs the boat.\n"
+            "Chapter 3:\nScene 1:\nA storm sinks the boat.\n")
+    result = parse_act_scenes(text, [1, 2])
+    assert result.value == {1: ["Helen reads the old map."],
+                            2: ["Ignacio packs the boat."]}
+    assert result.issues == ["3 chapters, expected [1, 2]"]
+
+
+def test_act_scenes_without_headings():
+    result = parse_act_scenes("Helen reads the old map.", [1])
+    assert not result.ok
+    assert result.issues == ["no chapter headings"]
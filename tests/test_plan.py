@@ -0,0 +1,75 @@
+import pytest
+
+from goat_storytelling_agent.plan import Act, Plan
+
+
+ACTS = [
+    {'act_descr': 'Act 1: The call.',
+     'chapters': ['Ana finds a map.', 'Ana leaves home.'],
+     'act_scenes': 'raw breakdown',
+     'chapter_scenes': {1: ['Ana in the attic.', 'The map glows.'],
+                        2: ['Ana packs.']}},
+    {'act_descr': 'The jungle.',
+     'chapters': ['Ana is lost.'],
+     # the model numbered the chapters of the act from 1
+     'chapter_scenes': {1: ['A stray scene.'], 3: ['Ana meets a guide.']}},
+    {'act_descr': 'The return.', 'chapters': ['Ana comes home.']},
+]
+
+
+def test_plan_round_trips_through_json(tmp_path):
+    plan = Plan(ACTS)
+    fpath = str(tmp_path / 'plan.json')
+    Plan.save_plan(plan, fpath)
+    loaded = Plan.load_plan(fpath)
+    assert loaded == plan
+    assert loaded.to_json() == ACTS
+    assert list(loaded.scenes()) == list(plan.scenes()) == [
+        (1, 1, 1, 'Ana in the attic.'), (1, 1, 2, 'The map glows.'),
+        (1, 2, 1, 'Ana packs.'), (2, 1, 1, 'A stray scene.'),
+        (2, 3, 1, 'Ana meets a guide.')]
+
+
+def test_chapters_are_numbered_through_the_plan():
+    plan = Plan(ACTS)
+    text, chapters = Plan.act_2_str(plan, 2)
+    assert chapters == [3]
+    assert text == ('Act 1: The call.\n\n'
+                    'Act 2:\nThe jungle.\n- Chapter 3: Ana is lost.')
+    plan[0]['chapters'] = ['Ana finds a map.']
+    assert Plan.act_2_str(plan, 2)[1] == [2]
+    assert plan.chapter_act(2) == 1
+    assert plan.chapter_act(99) == 2
+
+
+def test_rendered_text_follows_edits():
+    plan = Plan(ACTS)
+    full = Plan.plan_2_str(plan)
+    assert '- Chapter 4: Ana comes home.' in full
+    plan[2].chapters[0].outline = 'Ana stays.'
+    assert Plan.plan_2_str(plan) == full.replace('Ana comes home.',
+                                                 'Ana stays.')
+    assert Plan.plan_2_str(plan, ['summary', None, 'full']) \
+        == 'Act 1: The call.\n\nAct 3:\nThe return.\n- Chapter 4: Ana stays.'
+
+
+def test_act_dict_facade():
+    act = Plan(ACTS)[1]
+    assert act['act_descr'] == 'The jungle.'
+    assert 'act_scenes' not in act
+    assert act.get('act_scenes') is None
+    assert act['chapter_scenes'] == {1: ['A stray scene.'],
+                                     3: ['Ana meets a guide.']}
+    act['act_descr'] = 'The deep jungle.'
+    assert act.descr == 'The deep jungle.'
+    with pytest.raises(KeyError):
+        act['title'] = 'x'
+    assert isinstance(act, Act)
+
+
+def test_acts_of_another_plan_are_copied():
+    plan = Plan(ACTS)
+    other = Plan([plan[0]])
+    other[0]['act_descr'] = 'Changed.'
+    assert plan[0]['act_descr'] == 'Act 1: The call.'
+    assert other[0]['chapter_scenes'] == plan[0]['chapter_scenes']
@@ -0,0 +1,37 @@
+import pytest
+
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+def story_cache_stats(prompt_cache):
+    with MockBackend(scene_words=20) as mock:
+        agent = StoryAgent(mock.url, backend='llama.cpp',
+                           token_counter='estimate', logger=AgentLogger(),
+                           prompt_cache=prompt_cache, slot_id=0)
+        agent.generate_story('jungle')
+    return agent.prompt_cache_stats()
+
+
+@pytest.mark.parametrize('prompt_cache', [False, True])
+def test_prompt_cache_stats_add_up(prompt_cache):
+    stats = story_cache_stats(prompt_cache)
+    calls = stats['calls']
+    assert calls
+    for key in ('prompt_tokens', 'prompt_tokens_processed',
+                'prompt_tokens_reused', 'completion_tokens'):
+        assert stats[key] == sum(call[key] for call in calls)
+    for call in calls:
+        assert call['prompt_tokens_processed'] \
+            + call['prompt_tokens_reused'] == call['prompt_tokens']
+    assert (stats['prompt_tokens_reused'] > 0) == prompt_cache
+
+
+def test_scene_prompts_share_the_plan_prefix():
+    calls = story_cache_stats(True)['calls']
+    scenes = calls[-4:]
+    # the plan put first is reused, only the scene part is processed
+    for call in scenes:
+        assert call['prompt_tokens_reused'] \
+            > call['prompt_tokens_processed']
@@ -0,0 +1,95 @@
+import pytest
+
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.retry_budget import RetryBudget, RetryPolicy
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+from goat_storytelling_agent.traffic import TrafficRecorder, load_trace
+
+
+MESSAGES = [{'role': 'user', 'content': 'Write a long detailed scene.'}]
+
+
+def make_agent(url, backend='llama.cpp', **kwargs):
+    return StoryAgent(url, backend=backend, token_counter='estimate',
+                      logger=AgentLogger(), race_samples=3, **kwargs)
+
+
+def stage_calls(agent, stage):
+    return [record for record in agent.metrics.records
+            if record['type'] == 'call' and record['stage'] == stage]
+
+
+def test_first_accepted_answer_wins():
+    answers = []
+
+    def accept(answer):
+        answers.append(answer)
+        # the first answer to finish is rejected
+        return len(answers) if len(answers) > 1 else None
+
+    # the third sample waits for a slot and is still running at the end
+    with MockBackend(scene_words=60, tokens_per_second=400, slots=2) as mock:
+        agent = make_agent(mock.url)
+        loop = agent.retry_tracker.loop('create_plot_chapters')
+        assert agent.race_chat(MESSAGES, accept, 'create_plot_chapters',
+                               loop) == 2
+    calls = stage_calls(agent, 'create_plot_chapters')
+    assert len(calls) == 3
+    assert sum(call['early_stop'] == 'cancelled' for call in calls) == 1
+
+
+def test_race_stops_when_budget_runs_out():
+    policy = RetryPolicy({'create_plot_chapters': RetryBudget(max_attempts=5)})
+    with MockBackend(scene_words=20) as mock:
+        agent = make_agent(mock.url, retry_policy=policy)
+        loop = agent.retry_tracker.loop('create_plot_chapters')
+        assert agent.race_chat(MESSAGES, lambda answer: None,
+                               'create_plot_chapters', loop) is None
+    usage = agent.retry_stats()['stages']['create_plot_chapters']
+    assert (usage['queries'], usage['exhausted']) == (5, 1)
+
+
+@pytest.mark.parametrize('backend, greedy, sampling', [
+    ('hf', {}, {'do_sample': True}),
+    ('llama.cpp', {'temperature': 0}, {'temperature': 0.8}),
+])
+def test_raced_queries_sample_with_own_seed(tmp_path, backend, greedy,
+                                            sampling):
+    fpath = str(tmp_path / 'trace.jsonl')
+    with MockBackend(scene_words=20) as mock:
+        agent = make_agent(mock.url, backend, extra_options=greedy,
+                           recorder=TrafficRecorder(fpath))
+        loop = agent.retry_tracker.loop('create_plot_chapters')
+        agent.race_chat(MESSAGES, lambda answer: None,
+                        'create_plot_chapters', loop)
+    options = sorted((call['options'] for call in load_trace(fpath)),
+                     key=lambda options: options.get('seed', 0))
+    assert options[0] == greedy
+    assert [option['seed'] for option in options[1:]] == [2, 3, 4, 5]
+    for option in options[1:]:
+        assert sampling.items() <= option.items()
+
+
+def test_samples_are_charged_by_their_own_attempt():
+    with MockBackend(scene_words=20) as mock:
+        agent = make_agent(mock.url)
+        loop = agent.retry_tracker.loop('create_plot_chapters')
+        agent.race_chat(MESSAGES, lambda answer: answer,
+                        'create_plot_chapters', loop)
+    usage = agent.retry_stats()['stages']['create_plot_chapters']
+    first = [call for call in stage_calls(agent, 'create_plot_chapters')
+             if not call['requery']]
+    assert len(first) == 1
+    assert usage['requeries'] == 2
+    assert usage['tokens'] - usage['requery_tokens'] \
+        == first[0]['completion_tokens']
+
+
+def test_story_with_malformed_answers_completes():
+    with MockBackend(scene_words=20, malformed_rate=0.5, seed=3) as mock:
+        agent = make_agent(mock.url)
+        scenes = agent.generate_story('jungle')
+    assert scenes
+    assert agent.retry_stats()['stages']['create_plot_chapters']['loops'] \
+        == 1
@@ -0,0 +1,59 @@
+import json
+
+from goat_storytelling_agent.checkpoint import RunCheckpoint, fingerprint
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+def make_agent(url, **kwargs):
+    return StoryAgent(url, backend='llama.cpp', token_counter='estimate',
+                      logger=AgentLogger(), **kwargs)
+
+
+def test_stage_fingerprint_roundtrip(tmp_path):
+    checkpoint = RunCheckpoint(str(tmp_path), 'run')
+    checkpoint.save_stage('init_book_spec', {'Genre': 'Adventure'},
+                          fingerprint=fingerprint('jungle'))
+    assert checkpoint.stage_fingerprint('init_book_spec') \
+        == fingerprint('jungle')
+    assert checkpoint.stage_fingerprint('enhance_book_spec') is None
+    checkpoint.append_scene(1, 1, 1, "First scene.", fingerprint='a')
+    assert checkpoint.load_scenes()[0]['fingerprint'] == 'a'
+
+
+def test_compact_keeps_last_record_in_plan_order(tmp_path):
+    checkpoint = RunCheckpoint(str(tmp_path), 'run')
+    checkpoint.append_scene(1, 1, 2, "old second")
+    checkpoint.append_scene(1, 1, 1, "first")
+    checkpoint.append_scene(1, 1, 2, "new second")
+    checkpoint.append_scene(2, 5, 1, "dropped")
+    checkpoint.compact_scenes([(1, 1, 1), (1, 1, 2)])
+    assert [scene['text'] for scene in checkpoint.load_scenes()] \
+        == ["first", "new second"]
+
+
+def test_recompute_regenerates_only_edited_parts(tmp_path):
+    run_dir = str(tmp_path)
+    with MockBackend(scene_words=30) as mock:
+        agent = make_agent(mock.url, scene_dependency='chapter')
+        scenes = agent.generate_story('jungle', run_id='run',
+                                      run_dir=run_dir)
+        agent = make_agent(mock.url, scene_dependency='chapter')
+        assert agent.recompute('run', run_dir=run_dir) == scenes
+        assert agent.usage['requests'] == 0
+
+        checkpoint = RunCheckpoint(run_dir, 'run')
+        plan = checkpoint.load_stage('enhance_plot_chapters')
+        plan[-1].chapters[0].outline = 'Ana burns the map.'
+        checkpoint.save_stage('enhance_plot_chapters', plan)
+        agent = make_agent(mock.url, scene_dependency='chapter')
+        updated = agent.recompute('run', run_dir=run_dir)
+    stages = [record['stage'] for record in agent.metrics.records
+              if record['type'] == 'call']
+    # only the edited act is split into scenes again
+    assert stages.count('split_chapters_into_scenes') == 1
+    assert set(stages) == {'split_chapters_into_scenes', 'write_scenes'}
+    assert len(updated) == len(scenes)
+    with open(checkpoint.fingerprints_path) as fp:
+        assert 'enhance_plot_chapters' in json.load(fp)
@@ -0,0 +1,69 @@
+import pytest
+
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.retry_budget import (
+    RetryBudget, RetryPolicy, RetryTracker, RetryBudgetExceeded)
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+def test_loop_stops_at_max_attempts():
+    tracker = RetryTracker(RetryPolicy(
+        {'init_book_spec': RetryBudget(max_attempts=3)}))
+    loop = tracker.loop('init_book_spec')
+    attempts = 0
+    while loop.next():
+        attempts += 1
+        assert loop.requery == (attempts > 1)
+        loop.charge(10, 0.5)
+    assert attempts == 3
+    usage = tracker.stats()['stages']['init_book_spec']
+    assert usage == {'loops': 1, 'queries': 3, 'requeries': 2, 'tokens': 30,
+                     'requery_tokens': 20, 'seconds': 1.5, 'exhausted': 1}
+
+
+def test_first_query_ignores_exhausted_budgets():
+    tracker = RetryTracker(RetryPolicy(
+        default=RetryBudget(max_attempts=0), story=RetryBudget(max_attempts=0)))
+    loop = tracker.loop('enhance_act')
+    assert loop.next()
+    assert not loop.next()
+
+
+def test_token_budget():
+    tracker = RetryTracker(RetryPolicy(default=RetryBudget(max_tokens=25)))
+    loop = tracker.loop('create_plot_chapters')
+    attempts = 0
+    while loop.next():
+        attempts += 1
+        loop.charge(10, 0.1)
+    assert attempts == 3
+
+
+def test_story_budget_is_shared_by_loops():
+    tracker = RetryTracker(RetryPolicy(story=RetryBudget(max_attempts=3)))
+    first = tracker.loop('fill_missing_field')
+    assert first.start(3) == 3
+    second = tracker.loop('enhance_act')
+    assert second.start(5) == 2
+    assert not second.next()
+    stats = tracker.stats()
+    assert stats['story']['requeries'] == 3
+    assert stats['story']['budget']['max_attempts'] == 3
+    assert stats['stages']['enhance_act']['exhausted'] == 1
+    tracker.reset()
+    assert tracker.stats()['story']['requeries'] == 0
+    assert tracker.loop('enhance_act').start(5) == 4
+
+
+def test_outline_that_never_parses_fails_the_story():
+    policy = RetryPolicy(default=RetryBudget(max_attempts=2))
+    with MockBackend(scene_words=20, malformed_rate=1.0) as mock:
+        agent = StoryAgent(mock.url, backend='llama.cpp',
+                           token_counter='estimate', logger=AgentLogger(),
+                           retry_policy=policy)
+        with pytest.raises(RetryBudgetExceeded):
+            agent.generate_story('jungle')
+    usage = agent.retry_stats()['stages']['create_plot_chapters']
+    assert usage['queries'] == 2
+    assert usage['exhausted'] == 1
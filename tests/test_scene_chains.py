@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from goat_storytelling_agent.async_agent import AsyncStoryAgent
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.plan import Plan
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+def make_agent(url, cls=StoryAgent, **kwargs):
+    return cls(url, backend='llama.cpp', token_counter='estimate',
+               logger=AgentLogger(), **kwargs)
+
+
+def story_plan(url):
+    agent = make_agent(url)
+    _, book_spec = agent.init_book_spec('jungle')
+    _, plan = agent.create_plot_chapters(book_spec)
+    _, plan = agent.split_chapters_into_scenes(plan)
+    return plan
+
+
+@pytest.mark.parametrize('dependency', ['story', 'act', 'chapter'])
+def test_scene_chains_restart(dependency):
+    with MockBackend() as mock:
+        plan = story_plan(mock.url)
+        chains = make_agent(mock.url,
+                            scene_dependency=dependency).scene_chains(plan)
+    scenes = list(Plan.wrap(plan).scenes())
+    assert [scene for chain in chains for scene in chain] == scenes
+    starts = [chain[0][:3] for chain in chains]
+    if dependency == 'story':
+        assert starts == [scenes[0][:3]]
+    elif dependency == 'act':
+        first_of_act = {}
+        for scene in scenes:
+            first_of_act.setdefault(scene[0], scene[:3])
+        assert starts == list(first_of_act.values())
+    else:
+        assert starts == [scene[:3] for scene in scenes if scene[2] == 1]
+
+@pytest.mark.parametrize('dependency', ['act', 'chapter'])
+def test_parallel_chains_match_sequential(dependency):
+    with MockBackend(scene_words=20) as mock:
+        plan = story_plan(mock.url)
+        sequential = make_agent(mock.url, scene_dependency=dependency) \
+            .write_scenes(plan)
+        parallel = make_agent(mock.url, scene_dependency=dependency,
+                              scene_parallelism=4).write_scenes(plan)
+
+        async def write():
+            async with make_agent(mock.url, AsyncStoryAgent,
+                                  scene_dependency=dependency,
+                                  scene_parallelism=4) as agent:
+                return await agent.write_scenes(plan)
+        async_parallel = asyncio.run(write())
+    assert len(sequential) == len(list(Plan.wrap(plan).scenes()))
+    assert parallel == sequential
+    assert async_parallel == sequential
+
+
+def test_parallel_chains_resume_by_act(tmp_path):
+    with MockBackend(scene_words=20) as mock:
+        agent = make_agent(mock.url, scene_dependency='chapter',
+                           scene_parallelism=4)
+        scenes = agent.generate_story('jungle', run_id='run',
+                                      run_dir=str(tmp_path))
+        n_requests = mock.stats()['requests']
+        resumed = make_agent(mock.url, scene_dependency='chapter',
+                             scene_parallelism=4).generate_story(
+            'jungle', run_id='run', run_dir=str(tmp_path))
+        assert mock.stats()['requests'] == n_requests
+    assert resumed == scenes
@@ -0,0 +1,108 @@
+import threading
+
+from goat_storytelling_agent.stopping import (
+    StreamGuard, ActChapterScope, next_scene_heading)
+
+
+def run_guard(guard, deltas):
+    out = ''.join(guard.feed(delta) for delta in deltas)
+    return out + guard.finish()
+
+
+def test_stop_string_across_deltas():
+    guard = StreamGuard(stop=['THE END'])
+    assert run_guard(guard, ["They ran. TH", "E E", "ND and more"]) \
+        == "They ran. "
+    assert guard.stopped
+    assert guard.reason == 'stop'
+    assert guard.feed("later") == ''
+
+
+def test_held_tail_released_at_finish():
+    guard = StreamGuard(stop=['THE END'])
+    assert guard.feed("They ran. TH") == "They ran. "
+    assert guard.finish() == "TH"
+    assert not guard.stopped
+
+
+def test_no_stop_passes_text():
+    guard = StreamGuard()
+    assert run_guard(guard, ["one ", "two\n", "three"]) == "one two\nthree"
+    assert not guard.stopped
+
+
+def test_next_scene_heading_stops_scene():
+    text = ("Chapter 1\nScene 1\n"
+            "Helen ran to the river.\nShe swam.\nThe boat was gone.\n"
+            "Ignacio shouted.\nNight fell.\n"
+            "Scene 2\nThe next morning...")
+    guard = StreamGuard(validators=[next_scene_heading])
+    out = run_guard(guard, [text[i:i + 7] for i in range(0, len(text), 7)])
+    assert out == text[:text.index("\nScene 2")]
+    assert guard.reason == 'next_scene_heading'
+
+
+def test_scene_heading_at_start_kept():
+    text = "Scene 1\nHelen ran.\nScene 2 was never written"
+    guard = StreamGuard(validators=[next_scene_heading])
+    # within the first five lines a heading is the scene's own
+    assert run_guard(guard, [text]) == text
+    assert not guard.stopped
+
+
+def test_prefix_is_seen_not_passed_on():
+    seen = []
+
+    def validator(lines, line, complete):
+        seen.append((list(lines), line))
+        return True
+
+    guard = StreamGuard(validators=[validator], prefix="Chapter 1\nHel")
+    assert run_guard(guard, ["en ran.\nShe swam."]) == "en ran.\nShe swam."
+    assert seen[0] == (["Chapter 1"], "Helen ran.")
+
+
+def test_undecided_line_held_until_complete():
+    guard = StreamGuard(validators=[next_scene_heading])
+    # 'Sc' may start a scene heading
+    assert guard.feed("Sc") == ''
+    assert guard.feed("ared, she ran.\n") == "Scared, she ran."
+    assert guard.finish() == "\n"
+
+
+def test_reset_starts_over():
+    guard = StreamGuard(stop=['END'])
+    guard.feed("a b END")
+    assert guard.stopped
+    guard.reset()
+    assert not guard.stopped
+    assert run_guard(guard, ["c d"]) == "c d"
+
+
+def test_cancel_event():
+    cancel = threading.Event()
+    guard = StreamGuard(cancel=cancel)
+    assert guard.feed("one ") == "one "
+    cancel.set()
+    assert guard.feed("two") == ''
+    assert guard.reason == 'cancelled'
+
+
+def test_act_chapter_scope():
+    scope = ActChapterScope([4, 5])
+    lines = ["Chapter 4:", "Scene 1: ...", "Chapter 5:", "Scene 1: ..."]
+    assert scope(lines, "Chapter 6:", False) is None
+    assert scope(lines, "Chapter 5, Scene 2:", True) is True
+    # a chapter of the next act after all chapters of this one
+    assert scope(lines, "Chapter 6:", True) is False
+    # but not before them, e.g. a reference back to an earlier chapter
+    assert scope(lines[:2], "As in Chapter 2:", True) is True
+
+
+def test_act_chapter_scope_in_guard():
+    text = ("Chapter 4:\nScene 1:\nHelen swims.\n"
+            "Chapter 5:\nScene 1:\nThe boat sinks.\n"
+            "Chapter 6:\nScene 1:\nThe gold is lost.")
+    guard = StreamGuard(validators=[ActChapterScope([4, 5])])
+    assert run_guard(guard, [text]) == text[:text.index("\nChapter 6")]
+    assert guard.reason == 'ActChapterScope'
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from goat_storytelling_agent.async_agent import AsyncStoryAgent
+from goat_storytelling_agent.events import (
+    SceneFinished, SceneStarted, StageFinished, TokenDelta)
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.plan import Plan
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+
+
+STAGES = ['init_book_spec', 'enhance_book_spec', 'create_plot_chapters',
+          'enhance_plot_chapters', 'split_chapters_into_scenes']
+
+
+def agent_kwargs():
+    return {'backend': 'llama.cpp', 'token_counter': 'estimate',
+            'logger': AgentLogger()}
+
+
+def collect(agent, topic):
+    """Events of a sync stream with the progress seen at each"""
+    return [(event, agent.progress) for event in agent.stream_story(topic)]
+
+
+async def acollect(agent, topic):
+    return [(event, agent.progress)
+            async for event in agent.stream_story(topic)]
+
+
+def check_events(agent, events):
+    stages = [event for event, _ in events if isinstance(event, StageFinished)]
+    assert [event.stage for event in stages] == STAGES
+    scene_events = events[len(STAGES):]
+    assert not any(isinstance(event, StageFinished)
+                   for event, _ in scene_events)
+    scenes = list(Plan.wrap(stages[-1].output).scenes())
+
+    finished = []
+    deltas = []
+    current = None
+    for event, progress in scene_events:
+        if isinstance(event, SceneStarted):
+            assert current is None
+            current = (event.act_num, event.ch_num, event.sc_num)
+            assert scenes[len(finished)] == (*current, event.scene)
+            deltas = []
+        elif isinstance(event, TokenDelta):
+            assert (event.act_num, event.ch_num, event.sc_num) == current
+            deltas = [] if event.reset else deltas + [event.text]
+        else:
+            assert isinstance(event, SceneFinished)
+            assert (event.act_num, event.ch_num, event.sc_num) == current
+            assert event.text.strip()
+            assert event.text == agent.prepare_scene_text(''.join(deltas))
+            finished.append(event)
+            assert progress == pytest.approx(len(finished) / len(scenes))
+            current = None
+    assert len(finished) == len(scenes)
+
+
+def test_stream_story_events():
+    with MockBackend(scene_words=20) as mock:
+        agent = StoryAgent(mock.url, **agent_kwargs())
+        check_events(agent, collect(agent, 'jungle'))
+        # progress starts over with every story
+        check_events(agent, collect(agent, 'desert'))
+
+
+def test_async_stream_story_events():
+    async def run(url):
+        async with AsyncStoryAgent(url, **agent_kwargs()) as agent:
+            check_events(agent, await acollect(agent, 'jungle'))
+            check_events(agent, await acollect(agent, 'desert'))
+
+    with MockBackend(scene_words=20) as mock:
+        asyncio.run(run(mock.url))
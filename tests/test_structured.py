@@ -0,0 +1,85 @@
+import json
+import types
+
+import pytest
+
+from goat_storytelling_agent import prompts
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.parsing import (
+    parse_json_act_scenes, parse_json_book_spec, parse_json_plan)
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+from goat_storytelling_agent.traffic import TrafficRecorder, load_trace
+
+
+SCHEMA_KEYS = {'hf': 'grammar', 'llama.cpp': 'json_schema',
+               'openai': 'response_format'}
+
+
+def make_agent(url, backend='llama.cpp', **kwargs):
+    return StoryAgent(url, backend=backend, token_counter='estimate',
+                      logger=AgentLogger(), structured=True, **kwargs)
+
+
+@pytest.mark.parametrize('backend', ['hf', 'llama.cpp', 'openai'])
+def test_structured_story_follows_schemas(tmp_path, backend):
+    fpath = str(tmp_path / 'trace.jsonl')
+    with MockBackend(scene_words=20) as mock:
+        agent = make_agent(mock.url, backend,
+                           recorder=TrafficRecorder(fpath))
+        scenes = agent.generate_story('jungle')
+    assert scenes and all(scene.strip() for scene in scenes)
+    constrained = {call['stage'] for call in load_trace(fpath)
+                   if SCHEMA_KEYS[backend] in call['options']}
+    assert {'init_book_spec', 'create_plot_chapters',
+            'split_chapters_into_scenes'} <= constrained
+    parses = [record for record in agent.metrics.records
+              if record['type'] == 'parse']
+    assert parses and all(record['ok'] for record in parses)
+
+
+def test_prompt_engine_without_scene_fields():
+    engine = types.SimpleNamespace(**{
+        name: value for name, value in vars(prompts).items()
+        if name != 'scene_spec_fields'})
+    with MockBackend(scene_words=20) as mock:
+        agent = make_agent(mock.url, prompt_engine=engine)
+        scenes = agent.generate_story('jungle')
+    assert scenes
+
+
+def test_json_plan():
+    act = {'description': 'The crew gathers.',
+           'chapters': ['Helen finds a map.', '']}
+    result = parse_json_plan('Sure: ' + json.dumps({'acts': [act] * 3}))
+    assert result.ok
+    assert result.value == [{'act_descr': 'The crew gathers.',
+                             'chapters': ['Helen finds a map.']}] * 3
+
+
+def test_json_plan_invalid():
+    result = parse_json_plan('{"acts": [')
+    assert not result.ok
+    assert result.issues[0].startswith('invalid JSON')
+    result = parse_json_plan('{"acts": []}')
+    assert result.issues == ['0 acts, expected 3']
+
+
+def test_json_act_scenes():
+    text = json.dumps({
+        'Chapter 4': [{'Characters': 'Helen', 'Event': 'She swims.'}],
+        'Chapter 9': ['Out of the act']})
+    result = parse_json_act_scenes(text, [4, 5])
+    assert result.value == {4: ["Characters: Helen\nEvent: She swims."]}
+    assert result.issues == ["chapter key 'Chapter 9' not in [4, 5]",
+                             "chapter 5 has no scenes"]
+
+
+def test_json_book_spec():
+    result = parse_json_book_spec(
+        '{"Genre": "adventure", "Setting": {"place": "jungle"}}',
+        ['Genre', 'Setting', 'Characters'])
+    assert result.value == {'Genre': 'adventure',
+                            'Setting': '{"place": "jungle"}',
+                            'Characters': ''}
+    assert result.issues == ['missing field Characters']
@@ -0,0 +1,86 @@
+import re
+
+import pytest
+
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import (
+    StoryAgent, generate_prompt_parts)
+from goat_storytelling_agent.token_count import (
+    EstimateTokenCounter, HFTokenCounter, ServerTokenCounter, TokenCounter,
+    make_token_counter)
+
+
+MESSAGES = [{'role': 'system', 'content': 'You are a writer.'},
+            {'role': 'user', 'content': 'Write about a jungle.'}]
+
+
+class WordCounter(TokenCounter):
+    """Tokenizes like the mock backend, into words and whitespace runs"""
+    def __init__(self, max_memo_entries=4096):
+        super().__init__(max_memo_entries=max_memo_entries)
+        self.counted = []
+
+    def count(self, text):
+        self.counted.append(text)
+        return len(re.findall(r'\s+|\S+', text))
+
+
+def test_estimate_rounds_up():
+    counter = EstimateTokenCounter(chars_per_token=4)
+    assert [counter.count('x' * n) for n in (0, 1, 4, 5)] == [0, 1, 1, 2]
+    assert counter.count_parts(['abcd', 'ef']) == 3
+
+
+def test_parts_are_memoized():
+    counter = WordCounter(max_memo_entries=2)
+    assert counter.count_parts(['a b', 'c']) == 1 + 3 + 1
+    assert counter.count_parts(['a b', 'd e']) == 1 + 3 + 3
+    assert counter.counted == ['a b', 'c', 'd e']
+    # 'c' was the least recently used part and got evicted
+    counter.count_parts(['c'])
+    assert counter.counted == ['a b', 'c', 'd e', 'c']
+
+
+def test_server_counter_matches_server_tokenizer():
+    prompt_parts = list(generate_prompt_parts(MESSAGES))
+    with MockBackend() as mock:
+        counter = ServerTokenCounter(mock.url)
+        n_tokens = counter.count_parts(prompt_parts)
+        assert n_tokens == 1 + len(mock.tokenize(''.join(prompt_parts)))
+        n_requests = mock.stats()['requests']
+        assert counter.count_parts(prompt_parts) == n_tokens
+        assert mock.stats()['requests'] == n_requests
+    assert WordCounter().count_parts(prompt_parts) == n_tokens
+
+
+@pytest.mark.parametrize('backend', ['hf', 'llama.cpp'])
+def test_agent_counts_with_its_counter(backend):
+    counter = WordCounter()
+    with MockBackend(scene_words=20) as mock:
+        agent = StoryAgent(mock.url, backend=backend, token_counter=counter,
+                           logger=AgentLogger())
+        assert agent.token_counter is counter
+        assert agent.count_prompt_tokens(MESSAGES) == 1 + len(
+            mock.tokenize(''.join(generate_prompt_parts(MESSAGES))))
+        agent.query_chat(MESSAGES)
+    call = agent.metrics.records[-1]
+    if backend == 'hf':
+        # llama.cpp reports the prompt tokens it evaluated instead
+        assert call['prompt_tokens'] == agent.count_prompt_tokens(MESSAGES)
+    assert agent.usage['completion_tokens'] == call['completion_tokens'] > 0
+
+
+def test_make_token_counter():
+    counter = WordCounter()
+    assert make_token_counter(counter, 'hf', 'http://x') is counter
+    assert isinstance(make_token_counter(None, 'llama.cpp', 'http://x'),
+                      EstimateTokenCounter)
+    assert isinstance(make_token_counter('server', 'llama.cpp', 'http://x'),
+                      ServerTokenCounter)
+    with pytest.raises(ValueError):
+        make_token_counter('server', 'hf', 'http://x')
+    # the model tokenizer is only loaded when first used
+    default = make_token_counter(None, 'hf', 'http://x')
+    assert isinstance(default, HFTokenCounter)
+    assert default._tokenizer is None
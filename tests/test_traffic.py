@@ -0,0 +1,80 @@
+import json
+
+from goat_storytelling_agent.cache import ResponseCache
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+from goat_storytelling_agent.traffic import (
+    TrafficRecorder, TrafficReplayer, load_trace, main, percentiles)
+
+
+def record_story(url, fpath, content=True):
+    agent = StoryAgent(url, backend='llama.cpp', token_counter='estimate',
+                       logger=AgentLogger(),
+                       recorder=TrafficRecorder(fpath, content=content))
+    agent.generate_story('jungle')
+    return load_trace(fpath)
+
+
+def test_percentiles():
+    assert percentiles([]) is None
+    stats = percentiles([None, *range(1, 101)])
+    assert stats == {'p50': 51, 'p90': 91, 'p99': 100, 'max': 100}
+
+
+def test_record_and_replay(tmp_path):
+    with MockBackend(scene_words=30) as mock:
+        trace = record_story(mock.url, str(tmp_path / 'trace.jsonl'))
+        requests = mock.stats()['requests']
+        report = TrafficReplayer(
+            mock.url, speed=0, concurrency=4,
+            agent_kwargs={'token_counter': 'estimate'}).replay(trace)
+        assert mock.stats()['requests'] == 2 * requests
+    assert len(trace) == requests
+    assert {'messages', 'response', 'prompt_hash'} <= set(trace[0])
+    assert (report['calls'], report['ok'], report['failed']) \
+        == (len(trace), len(trace), 0)
+    assert report['completion_tokens'] \
+        == report['recorded']['completion_tokens']
+    assert 'write_scenes' in report['stages']
+
+
+def test_replay_without_content_uses_cache(tmp_path):
+    with MockBackend(scene_words=30) as mock:
+        trace = record_story(mock.url, str(tmp_path / 'trace.jsonl'),
+                             content=False)
+        assert 'messages' not in trace[0]
+        # the duplicate makes the synthetic prompt of the call a cache hit
+        trace.append(dict(trace[-1], start=trace[-1]['start'] + 1))
+        report = TrafficReplayer(
+            mock.url, speed=0, concurrency=1,
+            agent_kwargs={'token_counter': 'estimate',
+                          'cache': ResponseCache(),
+                          'extra_options': {'temperature': 0},
+                          'scene_extra_options': {'temperature': 0}}
+        ).replay(trace)
+    assert report['calls'] == len(trace)
+    assert report['failed'] == 0
+    assert report['cache_hits'] == 1
+
+
+def test_failed_calls_are_reported(tmp_path):
+    with MockBackend(scene_words=30) as mock:
+        trace = record_story(mock.url, str(tmp_path / 'trace.jsonl'))
+    with MockBackend(error_rate=1.0) as mock:
+        report = TrafficReplayer(
+            mock.url, speed=0, concurrency=4,
+            agent_kwargs={'token_counter': 'estimate'}).replay(trace[:3])
+    assert (report['calls'], report['failed']) == (3, 3)
+
+
+def test_cli_replays_against_mock(tmp_path):
+    fpath = str(tmp_path / 'trace.jsonl')
+    report_path = str(tmp_path / 'report.json')
+    with MockBackend(scene_words=30) as mock:
+        trace = record_story(mock.url, fpath)
+    assert main([fpath, '--mock', '--speed', '0', '--slots', '2',
+                 '--token-counter', 'estimate',
+                 '--report', report_path]) == 0
+    with open(report_path) as fp:
+        assert json.load(fp)['calls'] == len(trace)
@@ -0,0 +1,57 @@
+import threading
+
+from goat_storytelling_agent.instrumentation import AgentLogger
+from goat_storytelling_agent.mock_server import MockBackend
+from goat_storytelling_agent.storytelling_agent import StoryAgent
+from goat_storytelling_agent.transport import Transport, endpoint_key
+
+
+def tokenize(transport, url):
+    response = transport.post(url + '/tokenize', json={'content': 'a b'})
+    response.raise_for_status()
+    return response.json()
+
+
+def test_endpoint_key():
+    assert endpoint_key('http://host:8080/completion?x=1') \
+        == 'http://host:8080'
+
+
+def test_sequential_calls_reuse_one_connection():
+    with MockBackend() as mock:
+        transport = Transport()
+        for _ in range(5):
+            tokenize(transport, mock.url)
+        assert transport.stats() == {endpoint_key(mock.url): {
+            'requests': 5, 'connections': 1, 'reused': 4}}
+        transport.close()
+        assert transport.stats() == {}
+
+
+def test_blocking_pool_respects_pool_size():
+    with MockBackend(latency=0.1) as mock:
+        transport = Transport(pool_size=2, pool_block=True)
+        threads = [threading.Thread(target=tokenize,
+                                    args=(transport, mock.url))
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert transport.stats()[endpoint_key(mock.url)] == {
+            'requests': 6, 'connections': 2, 'reused': 4}
+        transport.close()
+
+
+def test_story_reuses_connections():
+    with MockBackend(scene_words=20) as mock:
+        agent = StoryAgent(mock.url, backend='llama.cpp', pool_size=2,
+                           logger=AgentLogger())
+        agent.generate_story('jungle')
+        stats = agent.connection_stats()[endpoint_key(mock.url)]
+        agent.transport.close()
+        backend_requests = mock.stats()['requests']
+    # tokenize and completion requests all go through the pool
+    assert stats['requests'] == backend_requests
+    assert stats['connections'] <= 2
+    assert stats['reused'] == stats['requests'] - stats['connections']
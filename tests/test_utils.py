@@ -0,0 +1,63 @@
+import pytest
+
+from goat_storytelling_agent.utils import (
+    RollingTail, keep_first_n_words, keep_last_n_words, last_n_words_start,
+    remove_last_n_words)
+
+
+@pytest.mark.parametrize('text, n, start', [
+    ('one two three', 2, 3),
+    ('one two\nthree', 2, 3),
+    ('one two\nthree\n', 1, 8),
+    ('one two\n\nthree four', 3, 3),
+    ('one two', 5, 0),
+    ('one two', 0, 7),
+    ('', 3, 0),
+])
+def test_last_n_words_start(text, n, start):
+    assert last_n_words_start(text, n) == start
+
+
+def test_last_n_words_start_matches_split():
+    text = "a b\n\nc  d e\nf\n g h  \n"
+    for n in range(10):
+        words = text[last_n_words_start(text, n):].split()
+        assert words == (text.split()[-n:] if n else [])
+
+
+def test_keep_and_remove_words():
+    text = "one  two\nthree four\n\nfive"
+    assert keep_last_n_words(text, 3) == "three four\nfive"
+    assert remove_last_n_words(text, 3) == "one two"
+    assert keep_first_n_words(text, 3) == "one two\nthree"
+
+
+def test_rolling_tail():
+    tail = RollingTail(3)
+    assert not tail
+    tail.append("one two ")
+    tail.append("three\nfour")
+    assert tail
+    assert tail.text() == "two three\nfour"
+    assert tail.text(1) == "four"
+    # n is capped at the words kept
+    assert tail.text(10) == "two three\nfour"
+
+
+def test_rolling_tail_long_text():
+    tail = RollingTail(5)
+    words = [f"w{i}" for i in range(5000)]
+    for word in words:
+        tail.append(word + ' ')
+    assert tail.text() == ' '.join(words[-5:])
+    # the buffer is cut back instead of growing with the text
+    assert len(tail._buffer) < 2100
+
+
+def test_rolling_tail_reset():
+    tail = RollingTail(2, "one two three")
+    assert tail.text() == "two three"
+    tail.reset("   ")
+    assert not tail
+    tail.reset()
+    assert tail.text() == ""